@@ -1,9 +1,23 @@
-from aiogram import Router, types
-from aiogram.filters import Command
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+import numpy as np
+from aiogram import F, Router, types
+from aiogram.types import BufferedInputFile, FSInputFile
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from sqlalchemy.ext.asyncio import AsyncSession
 from database import db
-from config import ADMIN_ID
+from config import ADMIN_ID, RETENTION_DAYS
+from availability import DAY_START_HOUR, SLOT_MINUTES
+from keyboards import BookingsPage, bookings_page_kb, day_code, day_from_code, time_from_code, DAY_NAMES
 
 admin_router = Router()
 
@@ -11,6 +25,7 @@ admin_router = Router()
 class AdminStates(StatesGroup):
     WAITING_BOOKING_ID = State()
     WAITING_NEW_INVITE = State()
+    WAITING_IMPORT_FILE = State()
 
 
 def _admin_only(user_id: int) -> bool:
@@ -24,27 +39,48 @@ async def admin_panel(message: types.Message):
 
     await message.answer(
         "Админ-панель:\n"
-        "/bookings - Все бронирования\n"
+        "/bookings [статус] [ДД.ММ.ГГГГ] [driver=ID] - Бронирования\n"
         "/drivers - Список водителей\n"
         "/cancel_booking - Отменить бронь\n"
-        "/add_invite - Создать инвайт-код\n"
-        "/cleanup - Удалить не активные"
+        "/add_invite [N] - Создать инвайт-код (или N случайных)\n"
+        "/export [csv|jsonl] [статус] [ДД.ММ.ГГГГ[-ДД.ММ.ГГГГ]] [driver=ID] - Выгрузка в файл\n"
+        "/import - Загрузить водителей или брони из CSV\n"
+        "/stats [ДД.ММ.ГГГГ-ДД.ММ.ГГГГ] - Загрузка водителей и отмены\n"
+        "/cleanup [dry] - Удалить старые неактивные\n"
+        "/cache_stats - Статистика кэша"
     )
 
 
-@admin_router.message(Command("bookings"))
-async def show_bookings(message: types.Message):
-    if not _admin_only(message.from_user.id):
-        return await message.answer("Доступ запрещён")
+BOOKINGS_PAGE_SIZE = 10
+BOOKING_STATUSES = ('active', 'canceled', 'completed')
+
+
+def _parse_bookings_filters(args):
+    """Аргументы /bookings: [active|canceled|completed] [ДД.ММ.ГГГГ] [driver=ID]"""
+    status, day, driver_id = "", 0, 0
+    for arg in (args or "").split():
+        if arg in BOOKING_STATUSES:
+            status = arg
+        elif arg.startswith("driver="):
+            driver_id = int(arg.removeprefix("driver="))
+        else:
+            day = day_code(datetime.strptime(arg, "%d.%m.%Y").date())
+    return status, day, driver_id
+
 
-    bookings = db.get_all_bookings()
+async def _bookings_page(session, status, day, driver_id, after=None, before=None):
+    date = day_from_code(day) if day else None
+    bookings, has_more = await db.get_bookings_page(
+        after=after, before=before, limit=BOOKINGS_PAGE_SIZE,
+        status=status or None, date=date, driver_id=driver_id or None, session=session
+    )
     if not bookings:
-        return await message.answer("Нет активных бронирований")
+        return "Бронирований не найдено", None
 
-    text = "Активные бронирования:\n\n"
+    text = "Бронирования:\n\n"
     for b in bookings:
-        driver = db.get_driver(b.driver_id)
-        user = b.user  # безопасно: get_all_bookings делает joinedload(User)
+        driver = b.driver
+        user = b.user  # безопасно: get_bookings_page делает joinedload(User, Driver)
         text += (
             f"🆔 ID: {b.id}\n"
             f"👤 Пользователь: {user.name if user else '—'} (@{user.username if user else '—'})\n"
@@ -54,14 +90,337 @@ async def show_bookings(message: types.Message):
             f"🔹 Статус: {b.status}\n\n"
         )
 
-    await message.answer(text[:4000])
+    # при листании назад «вперёд» есть всегда, при листании вперёд — «назад»
+    has_prev = has_more if before is not None else after is not None
+    has_next = has_more if before is None else True
+    kb = bookings_page_kb(bookings[0], bookings[-1], has_prev, has_next, status, day, driver_id)
+    return text, kb
+
+
+@admin_router.message(Command("bookings"))
+async def show_bookings(message: types.Message, command: CommandObject, session: AsyncSession):
+    if not _admin_only(message.from_user.id):
+        return await message.answer("Доступ запрещён")
+
+    try:
+        status, day, driver_id = _parse_bookings_filters(command.args)
+    except ValueError:
+        return await message.answer(
+            "Формат: /bookings [active|canceled|completed] [ДД.ММ.ГГГГ] [driver=ID]"
+        )
+
+    text, kb = await _bookings_page(session, status, day, driver_id)
+    await message.answer(text, reply_markup=kb)
+
+
+@admin_router.callback_query(BookingsPage.filter())
+async def page_bookings(callback: types.CallbackQuery, callback_data: BookingsPage, session: AsyncSession):
+    if not _admin_only(callback.from_user.id):
+        return await callback.answer("Доступ запрещён")
+
+    cursor = (time_from_code(callback_data.ts), callback_data.id)
+    text, kb = await _bookings_page(
+        session, callback_data.st, callback_data.day, callback_data.drv,
+        after=cursor if callback_data.go == "n" else None,
+        before=cursor if callback_data.go == "p" else None
+    )
+    await callback.message.edit_text(text, reply_markup=kb)
+    await callback.answer()
+
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_COLUMNS = ('id', 'booking_time', 'end_time', 'status', 'driver_id', 'driver',
+                  'tg_id', 'user', 'username', 'notes')
+# Бот может отправить файл не больше 50 МБ; файл крупнее сжимается gzip
+EXPORT_MAX_FILE_SIZE = 50 * 1024 * 1024
+
+
+def _parse_export_args(args):
+    """Аргументы /export: [csv|jsonl] [статус] [ДД.ММ.ГГГГ[-ДД.ММ.ГГГГ]] [driver=ID]"""
+    fmt, status, date_from, date_to, driver_id = 'csv', None, None, None, None
+    for arg in (args or "").split():
+        if arg in EXPORT_FORMATS:
+            fmt = arg
+        elif arg in BOOKING_STATUSES:
+            status = arg
+        elif arg.startswith("driver="):
+            driver_id = int(arg.removeprefix("driver="))
+        else:
+            first, _, last = arg.partition("-")
+            date_from = datetime.strptime(first, "%d.%m.%Y").date()
+            date_to = datetime.strptime(last, "%d.%m.%Y").date() if last else date_from
+    return fmt, status, date_from, date_to, driver_id
+
+
+async def _write_export(file, fmt, chunks):
+    """Пишет пачки из db.stream_bookings в открытый файл, возвращает число строк."""
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(EXPORT_COLUMNS)
+    async for rows in chunks:
+        if fmt == 'csv':
+            writer.writerows(rows)
+        else:
+            file.writelines(
+                json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False, default=str) + "\n"
+                for row in rows
+            )
+        count += len(rows)
+    return count
+
+
+def _gzip_file(path):
+    with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
+    return path + '.gz'
+
+
+@admin_router.message(Command("export"))
+async def export_bookings(message: types.Message, command: CommandObject):
+    if not _admin_only(message.from_user.id):
+        return await message.answer("Доступ запрещён")
+
+    try:
+        fmt, status, date_from, date_to, driver_id = _parse_export_args(command.args)
+    except ValueError:
+        return await message.answer(
+            "Формат: /export [csv|jsonl] [active|canceled|completed] "
+            "[ДД.ММ.ГГГГ[-ДД.ММ.ГГГГ]] [driver=ID]"
+        )
+
+    # строки идут из курсора пачками прямо во временный файл, а не в память
+    fd, path = tempfile.mkstemp(prefix="bookings_", suffix=f".{fmt}")
+    try:
+        with open(fd, 'w', encoding='utf-8', newline='') as file:
+            count = await _write_export(file, fmt, db.stream_bookings(
+                date_from=date_from, date_to=date_to, status=status, driver_id=driver_id
+            ))
+        if not count:
+            return await message.answer("Бронирований не найдено")
+        if os.path.getsize(path) > EXPORT_MAX_FILE_SIZE:
+            path = await asyncio.to_thread(_gzip_file, path)
+            if os.path.getsize(path) > EXPORT_MAX_FILE_SIZE:
+                return await message.answer("Выгрузка больше 50 МБ даже после сжатия, сузьте фильтр")
+        await message.answer_document(
+            FSInputFile(path, filename=f"bookings.{fmt}" + (".gz" if path.endswith(".gz") else "")),
+            caption=f"Бронирований: {count}"
+        )
+    finally:
+        os.remove(path)
+
+
+IMPORT_USAGE = (
+    "Пришлите CSV-файл с заголовком:\n"
+    "• водители: name,phone\n"
+    "• брони (как в /export): booking_time,end_time,driver_id или driver,tg_id[,notes,status]\n"
+    "Время — ГГГГ-ММ-ДД ЧЧ:ММ[:СС], вместе с запасом, как хранится в базе."
+)
+MAX_IMPORT_ERRORS = 10
+
+
+async def _import_bookings(rows):
+    """
+    Проверяет строки CSV броней и создаёт их одной пачкой через db.add_bookings.
+    Возвращает (создано, номера строк с пересечениями, ошибки); при ошибках
+    ничего не создаётся.
+    """
+    drivers = {d.name: d.id for d in await db.get_all_drivers()}
+    tg_ids = {int(r["tg_id"]) for _, r in rows if (r.get("tg_id") or "").strip().isdigit()}
+    users = await db.get_user_ids(tg_ids)
+
+    bookings, errors = [], []
+    for line, row in rows:
+        try:
+            booking_time = datetime.fromisoformat(row["booking_time"].strip())
+            end_time = datetime.fromisoformat(row["end_time"].strip())
+            if end_time <= booking_time:
+                raise ValueError("конец раньше начала")
+            if (row.get("driver_id") or "").strip():
+                driver_id = int(row["driver_id"])
+                if driver_id not in drivers.values():
+                    raise ValueError(f"неизвестный водитель {driver_id}")
+            elif (row.get("driver") or "").strip() in drivers:
+                driver_id = drivers[row["driver"].strip()]
+            else:
+                raise ValueError(f"неизвестный водитель {row.get('driver')!r}")
+            tg_id = (row.get("tg_id") or "").strip()
+            if tg_id and int(tg_id) not in users:
+                raise ValueError(f"пользователь {tg_id} не зарегистрирован")
+            status = (row.get("status") or "").strip() or 'active'
+            if status not in BOOKING_STATUSES:
+                raise ValueError(f"неизвестный статус {status!r}")
+        except (KeyError, ValueError) as e:
+            errors.append(f"строка {line}: {e}")
+            continue
+        bookings.append({
+            "driver_id": driver_id,
+            "user_id": users[int(tg_id)] if tg_id else None,
+            "booking_time": booking_time,
+            "end_time": end_time,
+            "notes": (row.get("notes") or "").strip() or None,
+            "status": status
+        })
+    if errors:
+        return 0, [], errors
+
+    ids = await db.add_bookings(bookings)
+    conflicts = [line for (line, _), booking_id in zip(rows, ids) if booking_id is None]
+    return len(ids) - len(conflicts), conflicts, []
+
+
+@admin_router.message(Command("import"))
+async def import_cmd(message: types.Message, state: FSMContext):
+    if not _admin_only(message.from_user.id):
+        return await message.answer("Доступ запрещён")
+
+    await message.answer(IMPORT_USAGE)
+    await state.set_state(AdminStates.WAITING_IMPORT_FILE)
+
+
+@admin_router.message(AdminStates.WAITING_IMPORT_FILE, F.document)
+async def process_import_file(message: types.Message, state: FSMContext):
+    if not _admin_only(message.from_user.id):
+        await state.clear()
+        return await message.answer("Доступ запрещён")
+
+    await state.clear()
+    data = await message.bot.download(message.document)
+    try:
+        text = data.read().decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return await message.answer("Файл должен быть в UTF-8")
+    reader = csv.DictReader(io.StringIO(text))
+    columns = set(reader.fieldnames or ())
+    # номера строк файла считаются с заголовком
+    rows = [(line, row) for line, row in enumerate(reader, start=2)]
+
+    if {"booking_time", "end_time"} <= columns:
+        created, conflicts, errors = await _import_bookings(rows)
+        if errors:
+            return await message.answer(
+                "Файл не импортирован:\n" + "\n".join(errors[:MAX_IMPORT_ERRORS])
+                + (f"\n… и ещё {len(errors) - MAX_IMPORT_ERRORS}" if len(errors) > MAX_IMPORT_ERRORS else "")
+            )
+        text = f"Импортировано бронирований: {created}"
+        if conflicts:
+            text += (f"\nПропущено из-за пересечений: {len(conflicts)} (строки "
+                     + ", ".join(map(str, conflicts[:20])) + ("…" if len(conflicts) > 20 else "") + ")")
+        return await message.answer(text)
+
+    if "name" in columns:
+        drivers = [
+            {"name": row["name"].strip(), "phone": (row.get("phone") or "").strip() or None}
+            for _, row in rows if (row["name"] or "").strip()
+        ]
+        ids = await db.add_drivers(drivers) if drivers else []
+        return await message.answer(f"Импортировано водителей: {len(ids)}")
+
+    await message.answer("Не распознан заголовок файла.\n\n" + IMPORT_USAGE)
+
+
+STATS_DEFAULT_DAYS = 28
+# прошедшие дни сохраняются по строке на водителя, поэтому период ограничен годом
+MAX_STATS_DAYS = 366
+STATS_TOP = 5
+# слоты, где броней меньше, в рейтинг отмен не попадают
+STATS_MIN_STARTS = 3
+
+
+def _slot_label(weekday, slot):
+    minutes = DAY_START_HOUR * 60 + slot * SLOT_MINUTES
+    return f"{DAY_NAMES[weekday]} {minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def _stats_text(stats, first_day, last_day, names):
+    weekdays = stats["weekdays"]
+    days = int(weekdays.sum())
+    text = f"📊 Загрузка {first_day.strftime('%d.%m.%Y')}–{last_day.strftime('%d.%m.%Y')} ({days} дн.)\n\n"
+
+    # доля занятых слотов за период: occupancy — доля по дням недели, взвешиваем числом дней
+    occupied = (stats["occupancy"] * weekdays[None, :, None]).sum(axis=(1, 2))
+    starts = stats["starts"].sum(axis=(1, 2))
+    canceled = stats["canceled"].sum(axis=(1, 2))
+    slots = days * stats["occupancy"].shape[2]
+    for i, driver_id in enumerate(stats["drivers"]):
+        if driver_id not in names and not starts[i]:
+            continue
+        text += (
+            f"🚗 {names.get(driver_id, f'#{driver_id}')}: занято {occupied[i] / slots:.0%} слотов, "
+            f"броней {starts[i]}, отменено {canceled[i] / starts[i] if starts[i] else 0:.0%}\n"
+        )
+
+    # самые загруженные слоты — в среднем по всем водителям
+    occupancy = stats["occupancy"].mean(axis=0)
+    occupancy[weekdays == 0] = -1
+    top = [k for k in np.argsort(occupancy, axis=None)[::-1][:STATS_TOP] if occupancy.flat[k] > 0]
+    if top:
+        text += "\n🔥 Самые загруженные слоты:\n" + "\n".join(
+            f"{_slot_label(*np.unravel_index(k, occupancy.shape))} — {occupancy.flat[k]:.0%}"
+            for k in top
+        )
+
+    starts, canceled = stats["starts"].sum(axis=0), stats["canceled"].sum(axis=0)
+    rate = np.divide(canceled, starts, out=np.zeros(starts.shape), where=starts >= STATS_MIN_STARTS)
+    top = [k for k in np.argsort(rate, axis=None)[::-1][:STATS_TOP] if rate.flat[k] > 0]
+    if top:
+        text += "\n\n❌ Чаще всего отменяют:\n" + "\n".join(
+            f"{_slot_label(*np.unravel_index(k, rate.shape))} — {rate.flat[k]:.0%} "
+            f"({canceled.flat[k]} из {starts.flat[k]})"
+            for k in top
+        )
+    return text
+
+
+@admin_router.message(Command("stats"))
+async def show_stats(message: types.Message, command: CommandObject):
+    if not _admin_only(message.from_user.id):
+        return await message.answer("Доступ запрещён")
+
+    today = datetime.now().date()
+    try:
+        if command.args:
+            first, _, last = command.args.strip().partition("-")
+            first_day = datetime.strptime(first, "%d.%m.%Y").date()
+            last_day = datetime.strptime(last, "%d.%m.%Y").date() if last else first_day
+        else:
+            first_day, last_day = today - timedelta(days=STATS_DEFAULT_DAYS - 1), today
+        if last_day < first_day:
+            raise ValueError("конец раньше начала")
+    except ValueError:
+        return await message.answer("Формат: /stats [ДД.ММ.ГГГГ-ДД.ММ.ГГГГ]")
+    if (last_day - first_day).days + 1 > MAX_STATS_DAYS:
+        return await message.answer(f"Период — не больше {MAX_STATS_DAYS} дней")
+
+    stats = await db.get_utilization(first_day, last_day)
+    if not stats["drivers"]:
+        return await message.answer("Водителей нет")
+    names = {d.id: d.name for d in await db.get_all_drivers()}
+    await message.answer(_stats_text(stats, first_day, last_day, names))
+
+
+MAX_BULK_INVITES = 10000
 
 
 @admin_router.message(Command("add_invite"))
-async def add_invite_cmd(message: types.Message, state: FSMContext):
+async def add_invite_cmd(message: types.Message, command: CommandObject, state: FSMContext):
     if not _admin_only(message.from_user.id):
         return await message.answer("Доступ запрещён")
 
+    # /add_invite N — сразу N случайных кодов одной вставкой
+    if command.args and command.args.strip().isdigit():
+        count = int(command.args)
+        if not 1 <= count <= MAX_BULK_INVITES:
+            return await message.answer(f"Можно создать от 1 до {MAX_BULK_INVITES} кодов за раз")
+        codes = await db.add_invites(count)
+        if count <= 50:
+            return await message.answer("Новые инвайт-коды:\n" + "\n".join(f"<code>{c}</code>" for c in codes))
+        return await message.answer_document(
+            BufferedInputFile("\n".join(codes).encode(), filename=f"invites_{count}.txt"),
+            caption=f"Создано инвайт-кодов: {count}"
+        )
+
     await message.answer("Введите новый инвайт-код:")
     await state.set_state(AdminStates.WAITING_NEW_INVITE)
 
@@ -73,7 +432,7 @@ async def process_new_invite(message: types.Message, state: FSMContext):
         return await message.answer("Доступ запрещён")
 
     code = message.text.strip()
-    if db.add_invite(code):
+    if await db.add_invite(code):
         await message.answer(f"Инвайт-код '{code}' успешно добавлен")
     else:
         await message.answer("Ошибка: такой код уже существует")
@@ -81,11 +440,11 @@ async def process_new_invite(message: types.Message, state: FSMContext):
 
 
 @admin_router.message(Command("drivers"))
-async def show_drivers(message: types.Message):
+async def show_drivers(message: types.Message, session: AsyncSession):
     if not _admin_only(message.from_user.id):
         return await message.answer("Доступ запрещён")
 
-    drivers = db.get_all_drivers()
+    drivers = await db.get_all_drivers(session=session)
     if not drivers:
         return await message.answer("Активных водителей нет")
 
@@ -95,6 +454,19 @@ async def show_drivers(message: types.Message):
     await message.answer(text)
 
 
+@admin_router.message(Command("cache_stats"))
+async def show_cache_stats(message: types.Message):
+    if not _admin_only(message.from_user.id):
+        return await message.answer("Доступ запрещён")
+
+    text = "Кэш:\n\n" + "\n".join(
+        f"{name}: {s['hits']} попаданий, {s['misses']} промахов "
+        f"({s['hit_rate']:.0%}), записей {s['size']}"
+        for name, s in db.cache_stats().items()
+    )
+    await message.answer(text)
+
+
 @admin_router.message(Command("cancel_booking"))
 async def cancel_booking_cmd(message: types.Message, state: FSMContext):
     if not _admin_only(message.from_user.id):
@@ -112,7 +484,7 @@ async def process_booking_id(message: types.Message, state: FSMContext):
 
     try:
         booking_id = int(message.text.strip())
-        if db.cancel_booking(booking_id):
+        if await db.cancel_booking(booking_id):
             await message.answer(f"Бронирование #{booking_id} отменено")
         else:
             await message.answer("Бронирование не найдено")
@@ -120,10 +492,20 @@ async def process_booking_id(message: types.Message, state: FSMContext):
         await message.answer("Введите корректный ID (число)")
     await state.clear()
 
-    @admin_router.message(Command("cleanup"))
-    async def cleanup_bookings(message: types.Message):
-        if not _admin_only(message.from_user.id):
-            return await message.answer("Доступ запрещён")
 
-        deleted_count = db.delete_canceled_bookings()
-        await message.answer(f"Удалено {deleted_count} отмененных бронирований")
+@admin_router.message(Command("cleanup"))
+async def cleanup_bookings(message: types.Message, command: CommandObject):
+    if not _admin_only(message.from_user.id):
+        return await message.answer("Доступ запрещён")
+
+    if not RETENTION_DAYS:
+        return await message.answer("Политика хранения не задана: удалять нечего")
+
+    dry_run = (command.args or "").strip() == "dry"
+    counts = await db.apply_retention(RETENTION_DAYS, dry_run=dry_run)
+    lines = [
+        f"{status} старше {RETENTION_DAYS[status]} дн.: {count}"
+        for status, count in counts.items()
+    ]
+    title = "Будет удалено (dry run):" if dry_run else "Удалено:"
+    await message.answer(title + "\n" + "\n".join(lines))
@@ -0,0 +1,92 @@
+"""
+Загрузка водителей по слотам сетки availability.py, посчитанная массивами NumPy.
+
+Счётчики дня водителя — массив uint16 формы (3, SLOTS_PER_DAY):
+    OCCUPIED — слот занят неотменённой бронью (с запасом, как она хранится),
+    STARTS   — сколько броней начинается в слоте (время, выбранное пользователем),
+    CANCELED — сколько из них отменено.
+"""
+from datetime import date
+
+import numpy as np
+
+from availability import BOOKING_PADDING, DAY_START_HOUR, SLOT_MINUTES, SLOTS_PER_DAY
+
+OCCUPIED, STARTS, CANCELED = range(3)
+COUNTERS = 3
+COUNTS_DTYPE = np.uint16
+
+EPOCH = date(1970, 1, 1)
+MINUTES_PER_DAY = 24 * 60
+PADDING_MINUTES = int(BOOKING_PADDING.total_seconds()) // 60
+
+
+def daily_counts(rows, first_day, days, driver_ids):
+    """
+    Счётчики по дням и водителям: массив (days, len(driver_ids), 3, SLOTS_PER_DAY),
+    водители — в порядке sorted(driver_ids). rows — (driver_id, начало, конец,
+    отменена) с временем в минутах от 1970-01-01, см. Database._stats_rows;
+    брони вне диапазона дней и чужих водителей отбрасываются.
+    """
+    counts = np.zeros((days, len(driver_ids), COUNTERS, SLOTS_PER_DAY), dtype=COUNTS_DTYPE)
+    if not rows or not driver_ids:
+        return counts
+
+    # по столбцам: np.array по списку Row разбирает каждую строку отдельно
+    driver, start, end, canceled = (np.array(column, dtype=np.int64) for column in zip(*rows))
+    canceled = canceled.astype(bool)
+    day = start // MINUTES_PER_DAY
+    # минуты от начала сетки дня (DAY_START_HOUR)
+    origin = day * MINUTES_PER_DAY + DAY_START_HOUR * 60
+    day -= (first_day - EPOCH).days
+
+    known = np.array(sorted(driver_ids), dtype=np.int64)
+    column = np.searchsorted(known, driver)
+    keep = (day >= 0) & (day < days) & (column < len(known))
+    keep[keep] = known[column[keep]] == driver[keep]
+    day, column, canceled = day[keep], column[keep], canceled[keep]
+    from_minutes, to_minutes = start[keep] - origin[keep], end[keep] - origin[keep]
+
+    # занятость: разностный массив по слотам, +1 на первом слоте брони, -1 после последнего
+    first = np.clip(from_minutes // SLOT_MINUTES, 0, SLOTS_PER_DAY)
+    last = np.clip(-(-to_minutes // SLOT_MINUTES), 0, SLOTS_PER_DAY)  # округление вверх
+    busy = ~canceled & (last > first)
+    diff = np.zeros((days, len(driver_ids), SLOTS_PER_DAY + 1), dtype=np.int32)
+    np.add.at(diff, (day[busy], column[busy], first[busy]), 1)
+    np.add.at(diff, (day[busy], column[busy], last[busy]), -1)
+    counts[:, :, OCCUPIED] = np.cumsum(diff, axis=2)[:, :, :SLOTS_PER_DAY] > 0
+
+    # начало поездки — после запаса
+    slot = (from_minutes + PADDING_MINUTES) // SLOT_MINUTES
+    on_grid = (slot >= 0) & (slot < SLOTS_PER_DAY)
+    np.add.at(counts[:, :, STARTS], (day[on_grid], column[on_grid], slot[on_grid]), 1)
+    on_grid &= canceled
+    np.add.at(counts[:, :, CANCELED], (day[on_grid], column[on_grid], slot[on_grid]), 1)
+    return counts
+
+
+def utilization(counts, first_day):
+    """
+    Сводка по счётчикам daily_counts, начиная с first_day:
+      weekdays    — (7,) сколько раз каждый день недели попал в период,
+      occupancy   — (водители, 7, слоты) доля таких дней, когда слот был занят,
+      cancellation — (водители, 7, слоты) доля отменённых среди начавшихся в слоте,
+      starts, canceled — (водители, 7, слоты) сами счётчики броней.
+    """
+    weekday = (np.arange(counts.shape[0]) + first_day.weekday()) % 7
+    weekdays = np.bincount(weekday, minlength=7)
+    by_weekday = np.zeros((7,) + counts.shape[1:], dtype=np.int64)
+    np.add.at(by_weekday, weekday, counts)
+    by_weekday = by_weekday.transpose(1, 0, 2, 3)  # (водители, 7, счётчики, слоты)
+
+    occupied = by_weekday[:, :, OCCUPIED]
+    starts = by_weekday[:, :, STARTS]
+    canceled = by_weekday[:, :, CANCELED]
+    return {
+        "weekdays": weekdays,
+        "occupancy": np.divide(occupied, weekdays[None, :, None],
+                               out=np.zeros(occupied.shape), where=weekdays[None, :, None] > 0),
+        "cancellation": np.divide(canceled, starts, out=np.zeros(starts.shape), where=starts > 0),
+        "starts": starts,
+        "canceled": canceled,
+    }
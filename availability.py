@@ -0,0 +1,142 @@
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+# Сетка слотов, которые предлагаются пользователю: 08:00–22:00 по 30 минут
+DAY_START_HOUR = 8
+DAY_END_HOUR = 22
+SLOT_MINUTES = 30
+SLOTS_PER_DAY = (DAY_END_HOUR - DAY_START_HOUR) * 60 // SLOT_MINUTES
+FULL_MASK = (1 << SLOTS_PER_DAY) - 1
+# Бронь хранится с запасом по полчаса до и после выбранного времени
+BOOKING_PADDING = timedelta(minutes=SLOT_MINUTES)
+
+
+def day_start(date):
+    return datetime.combine(date, datetime.min.time()).replace(hour=DAY_START_HOUR)
+
+
+def slot_time(date, index):
+    """Начало слота с номером index в указанный день."""
+    return day_start(date) + timedelta(minutes=SLOT_MINUTES * index)
+
+
+def slot_index(dt):
+    """Номер слота, который начинается в dt."""
+    return (dt - day_start(dt.date())) // timedelta(minutes=SLOT_MINUTES)
+
+
+def interval_mask(date, start, end):
+    """Маска слотов дня, которые пересекаются с интервалом [start, end)."""
+    origin = day_start(date)
+    slot = timedelta(minutes=SLOT_MINUTES)
+    first = max((start - origin) // slot, 0)
+    last = min(-((origin - end) // slot), SLOTS_PER_DAY)  # округление вверх
+    if last <= first:
+        return 0
+    return ((1 << (last - first)) - 1) << first
+
+
+def future_slots_mask(date, now):
+    """Маска слотов дня, которые начинаются не раньше now."""
+    slot = timedelta(minutes=SLOT_MINUTES)
+    passed = min(max(-((day_start(date) - now) // slot), 0), SLOTS_PER_DAY)
+    return FULL_MASK & ~((1 << passed) - 1)
+
+
+def free_starts(occupied, length):
+    """
+    Маска слотов, с которых можно начать поездку длиной length слотов:
+    сама поездка и по слоту запаса с каждой стороны не пересекаются с занятыми.
+    """
+    # сдвигаем на один бит, чтобы запас у краёв сетки (07:30, 22:00) считался свободным
+    free = ((~occupied & FULL_MASK) << 1) | 1 | (1 << (SLOTS_PER_DAY + 1))
+    runs = free
+    for k in range(1, length + 2):
+        runs &= free >> k
+    return runs & ((1 << (SLOTS_PER_DAY - length + 1)) - 1)
+
+
+def any_free_starts(masks, length):
+    """Объединение free_starts по водителям: начала, доступные хотя бы у одного."""
+    starts = 0
+    for occupied in masks:
+        starts |= free_starts(occupied, length)
+    return starts
+
+
+def expand_recurrence(first_date, last_date, weekdays, start, end):
+    """Интервалы [start, end) (время суток) во все дни с first_date по last_date, чей weekday() в weekdays."""
+    return [
+        (datetime.combine(date, start), datetime.combine(date, end))
+        for date in (first_date + timedelta(days=i) for i in range((last_date - first_date).days + 1))
+        if date.weekday() in weekdays
+    ]
+
+
+def first_slot(mask):
+    """Номер младшего выставленного бита или None."""
+    return (mask & -mask).bit_length() - 1 if mask else None
+
+
+class AvailabilityIndex:
+    """
+    Занятость водителей по дням: один int на пару (водитель, дата),
+    бит i выставлен, если слот i пересекается с активным бронированием.
+    Дни подгружаются лениво, вытесняются по LRU.
+    Индекс видит только записи своего процесса, поэтому раз в ttl секунд
+    он целиком сбрасывается и дни перечитываются из базы; None — не сбрасывать.
+    """
+
+    def __init__(self, max_days=65536, ttl=None):
+        self.max_days = max_days
+        self.ttl = ttl
+        self._days = OrderedDict()
+        # растёт при каждой записи; по нему отбрасываются загрузки,
+        # которые могли прочитать данные до конкурентного изменения
+        self._version = 0
+        self._expires = time.monotonic() + ttl if ttl else None
+
+    @property
+    def version(self):
+        self._expire()
+        return self._version
+
+    def _expire(self):
+        if self._expires is not None and time.monotonic() >= self._expires:
+            self.clear()
+
+    def get(self, driver_id, date):
+        self._expire()
+        key = (driver_id, date)
+        mask = self._days.get(key)
+        if mask is not None:
+            self._days.move_to_end(key)
+        return mask
+
+    def put(self, driver_id, date, mask, version=None):
+        if version is not None and version != self._version:
+            return
+        key = (driver_id, date)
+        self._days[key] = mask
+        self._days.move_to_end(key)
+        while len(self._days) > self.max_days:
+            self._days.popitem(last=False)
+
+    def occupy(self, driver_id, start, end):
+        self._version += 1
+        key = (driver_id, start.date())
+        if key in self._days:
+            self._days[key] |= interval_mask(start.date(), start, end)
+
+    def release(self, driver_id, start, end):
+        self._version += 1
+        key = (driver_id, start.date())
+        if key in self._days:
+            self._days[key] &= ~interval_mask(start.date(), start, end)
+
+    def clear(self):
+        self._version += 1
+        self._days.clear()
+        if self.ttl:
+            self._expires = time.monotonic() + self.ttl
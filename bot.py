@@ -1,35 +1,52 @@
 import asyncio
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, time, timedelta
+from aiohttp import web
 from aiogram import F, types, Router
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from config import dp, bot, ADMIN_ID, INVITE_CODE
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import (
+    dp, bot, ADMIN_ID, INVITE_CODE,
+    RUN_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+    METRICS_HOST, METRICS_PORT, THROTTLE_RATE, THROTTLE_BURST, THROTTLE_DUPLICATE_WINDOW
+)
 from database import db
-from keyboards import main_menu_kb, generate_dates_kb, generate_time_slots_kb, back_kb, get_calendar_kb
+from availability import (
+    BOOKING_PADDING, DAY_END_HOUR, DAY_START_HOUR, SLOT_MINUTES, SLOTS_PER_DAY, expand_recurrence, slot_index,
+    slot_time
+)
+from keyboards import (
+    BookingFlow, main_menu_kb, get_calendar_kb, generate_dates_kb, start_slots_kb, end_slots_kb,
+    confirm_booking_kb, day_code, day_from_code, CALENDAR_DAYS
+)
 from admin import admin_router
+from outbox import outbox
+from scheduler import scheduler
+from middlewares import DbSessionMiddleware, ThrottlingMiddleware
+from metrics import metrics, UpdateMetricsMiddleware, HandlerMetricsMiddleware, ApiMetricsMiddleware
 
 logging.basicConfig(level=logging.INFO)
 
 main_router = Router()
 
+throttling = ThrottlingMiddleware(
+    rate=THROTTLE_RATE, burst=THROTTLE_BURST, duplicate_window=THROTTLE_DUPLICATE_WINDOW, metrics=metrics
+)
+
 
 class BookingStates(StatesGroup):
     WAITING_INVITE = State()
-    CHOOSING_DATE = State()
-    CHOOSING_TIME = State()
-    CHOOSING_END_TIME = State()
     ADDING_NOTES = State()
-    CONFIRMATION = State()
     EDITING_BOOKING = State()
 
 
 # Старт — отдельной командой, чтобы не перехватывать все сообщения
 @main_router.message(CommandStart())
-async def start(message: types.Message, state: FSMContext):
-    user = db.get_user(message.from_user.id)
+async def start(message: types.Message, state: FSMContext, session: AsyncSession):
+    user = await db.get_user(message.from_user.id, session=session)
     if not user:
         await state.set_state(BookingStates.WAITING_INVITE)
         return await message.answer(
@@ -49,13 +66,14 @@ async def start(message: types.Message, state: FSMContext):
 @main_router.message(BookingStates.WAITING_INVITE)
 async def process_invite_code(message: types.Message, state: FSMContext):
     code = message.text.strip()
-    if db.check_invite(code):
-        db.use_invite(code)
-        db.add_user(
-            tg_id=message.from_user.id,
-            name=message.from_user.full_name,
-            username=message.from_user.username
-        )
+    # проверка, погашение кода и регистрация — одна транзакция записи
+    user_id = await db.redeem_invite_and_register(
+        code,
+        tg_id=message.from_user.id,
+        name=message.from_user.full_name,
+        username=message.from_user.username
+    )
+    if user_id is not None:
         await message.answer(
             "✅ Код приглашения принят!\n"
             "Теперь можно меня использовать.",
@@ -73,192 +91,373 @@ async def show_calendar_menu(message: types.Message):
 
 
 @main_router.message(F.text == '📅 Показать календарь')
-async def show_calendar(message: types.Message):
-    await message.answer("Выберите дату:", reply_markup=generate_dates_kb())
-
-
-@main_router.message(F.text == '📝 Мои бронирования')
-async def show_user_bookings(message: types.Message):
-    user = db.get_user(message.from_user.id)
-    if not user:
-        return await message.answer("Ошибка: пользователь не найден. Нажмите /start")
+async def show_calendar(message: types.Message, session: AsyncSession):
+    # полностью занятые дни в календарь не попадают
+    kb = await generate_dates_kb(session=session)
+    if not kb.inline_keyboard:
+        return await message.answer("Свободных дней в ближайшие 60 дней нет", reply_markup=main_menu_kb())
+    await message.answer("Выберите дату:", reply_markup=kb)
 
-    bookings = db.get_user_bookings(user.id)
-    if not bookings:
-        return await message.answer("У вас нет активных бронирований", reply_markup=main_menu_kb())
 
-    text = "📝 Ваши бронирования:\n\n"
+def _format_user_bookings(title, bookings):
+    text = f"{title}\n\n"
     for booking in bookings:
-        driver = db.get_driver(booking.driver_id)
+        driver = booking.driver  # get_user_bookings делает joinedload(Driver)
         text += (
             f"📅 {booking.booking_time.strftime('%d.%m.%Y %H:%M')} - {booking.end_time.strftime('%H:%M')}\n"
             f"🚗 Водитель: {driver.name if driver else 'Кто-то из семьи'}\n"
             f"📝 Заметки: {booking.notes if booking.notes else 'нет'}\n"
             f"🆔 ID: {booking.id}\n\n"
         )
+    return text
 
-    await message.answer(text, reply_markup=main_menu_kb())
 
+@main_router.message(F.text == '⚡ Ближайшее свободное время')
+async def show_first_free(message: types.Message, session: AsyncSession):
+    user = await db.get_user(message.from_user.id, session=session)
+    if not user:
+        return await message.answer("Ошибка: пользователь не найден. Нажмите /start")
 
-# Выбор даты (кнопки «Пн 12.08» и т.д.)
-@main_router.message(F.text.regexp(r'^[А-Яа-я]{2} \d{2}\.\d{2}$'))
-async def choose_date(message: types.Message, state: FSMContext):
-    try:
-        date_str = message.text.split()[1]
-        date = datetime.strptime(date_str, "%d.%m").date()
-        date = date.replace(year=datetime.now().year)
-        if date < datetime.now().date():
-            date = date.replace(year=datetime.now().year + 1)
-    except ValueError:
-        return await message.answer("Неверный формат даты. Выберите дату из списка.")
+    # ищем окно на час по всем водителям на весь горизонт календаря
+    found = await db.find_first_free(length=2, session=session)
+    if not found:
+        return await message.answer("Свободного времени в ближайшие 60 дней нет", reply_markup=main_menu_kb())
+
+    _, start_dt, end_dt = found
+    await message.answer(
+        "Ближайшее свободное время.\n" + _confirm_text(start_dt, end_dt),
+        reply_markup=confirm_booking_kb(day_code(start_dt.date()), slot_index(start_dt), slot_index(end_dt))
+    )
 
-    user = db.get_user(message.from_user.id)
+
+@main_router.message(F.text == '📝 Мои бронирования')
+async def show_user_bookings(message: types.Message, session: AsyncSession):
+    user = await db.get_user(message.from_user.id, session=session)
     if not user:
         return await message.answer("Ошибка: пользователь не найден. Нажмите /start")
 
-    drivers = db.get_all_drivers()
-    if not drivers:
-        return await message.answer("Нет доступных водителей")
+    bookings = await db.get_user_bookings(user.id, session=session)
+    if not bookings:
+        return await message.answer("У вас нет активных бронирований", reply_markup=main_menu_kb())
+
+    text = _format_user_bookings("📝 Ваши бронирования:", bookings)
+    await message.answer(text + "Старые поездки: /history", reply_markup=main_menu_kb())
 
-    driver_id = drivers[0].id
-    await state.update_data(selected_date=date, driver_id=driver_id)
-    await message.answer(
-        f"Вы выбрали дату: {date.strftime('%d.%m.%Y')}\n"
-        "Выберите время начала:",
-        reply_markup=generate_time_slots_kb(date, driver_id, user.id)
+
+@main_router.message(Command("history"))
+async def show_user_history(message: types.Message, session: AsyncSession):
+    user = await db.get_user(message.from_user.id, session=session)
+    if not user:
+        return await message.answer("Ошибка: пользователь не найден. Нажмите /start")
+
+    # архив читается только по запросу
+    bookings = await db.get_user_bookings(user.id, include_history=True, session=session)
+    if not bookings:
+        return await message.answer("История бронирований пуста", reply_markup=main_menu_kb())
+
+    text = _format_user_bookings("📜 История бронирований (последние 20):", bookings[-20:])
+    await message.answer(text, reply_markup=main_menu_kb())
+
+
+# Сценарий бронирования: одно сообщение, которое редактируется на каждом шаге
+def _flow_interval(callback_data):
+    """
+    (дата, начало, конец) из callback_data шагов d, s, e, n и ok; на шаге d
+    начала и конца ещё нет, на шаге s — конца. None, если дата вне календаря
+    или слоты не с сетки: callback_data приходит от клиента и может быть подделана.
+    """
+    day, start, end = callback_data.day, callback_data.start, callback_data.end
+    today = day_code(datetime.now().date())
+    if day is None or not today <= day < today + CALENDAR_DAYS:
+        return None
+    date = day_from_code(day)
+    if callback_data.act == "d":
+        return date, None, None
+    if start is None or not 0 <= start < SLOTS_PER_DAY:
+        return None
+    if callback_data.act == "s":
+        return date, slot_time(date, start), None
+    if end is None or not start < end <= SLOTS_PER_DAY:
+        return None
+    return date, slot_time(date, start), slot_time(date, end)
+
+
+BAD_INTERVAL = "Некорректная дата или время. Выберите заново."
+
+
+def _confirm_text(start_dt, end_dt, notes=None):
+    return (
+        "Подтвердите бронирование:\n"
+        f"📅 Дата: {start_dt.strftime('%d.%m.%Y')}\n"
+        f"⏰ Время: {start_dt.strftime('%H:%M')} - {end_dt.strftime('%H:%M')}\n"
+        f"📝 Заметки: {notes if notes else 'нет'}"
     )
-    await state.set_state(BookingStates.CHOOSING_TIME)
 
 
-# Время начала
-@main_router.message(BookingStates.CHOOSING_TIME, F.text.regexp(r'^🟡 \d{2}:\d{2}'))
-async def choose_start_time(message: types.Message, state: FSMContext):
-    time_str = message.text.split()[1]
-    try:
-        time_obj = datetime.strptime(time_str, "%H:%M").time()
-    except ValueError:
-        return await message.answer("Неверный формат времени. Выберите из списка.")
+@main_router.callback_query(BookingFlow.filter(F.act == "b"))
+async def flow_dates(callback: types.CallbackQuery, callback_data: BookingFlow, session: AsyncSession):
+    await callback.message.edit_text(
+        "Выберите дату:", reply_markup=await generate_dates_kb(callback_data.day, session=session)
+    )
+    await callback.answer()
 
-    data = await state.get_data()
-    date = data["selected_date"]
-    start_dt = datetime.combine(date, time_obj)
 
-    if start_dt < datetime.now():
-        return await message.answer("Нельзя выбрать прошедшее время. Выберите другое.")
+@main_router.callback_query(BookingFlow.filter(F.act == "d"))
+async def flow_date(callback: types.CallbackQuery, callback_data: BookingFlow, session: AsyncSession):
+    interval = _flow_interval(callback_data)
+    if interval is None:
+        return await callback.answer(BAD_INTERVAL, show_alert=True)
 
-    await state.update_data(start_time=start_dt)
-    await message.answer(
-        "Теперь выберите время окончания:",
-        reply_markup=generate_time_slots_kb(date, data["driver_id"], message.from_user.id)
+    user = await db.get_user(callback.from_user.id, session=session)
+    if not user:
+        return await callback.answer("Ошибка: пользователь не найден. Нажмите /start", show_alert=True)
+
+    if not await db.get_all_drivers(session=session):
+        return await callback.answer("Нет доступных водителей", show_alert=True)
+
+    # водитель выбирается при подтверждении — любой, у кого свободен интервал
+    date, _, _ = interval
+    await callback.message.edit_text(
+        f"Вы выбрали дату: {date.strftime('%d.%m.%Y')}\n"
+        "Выберите время начала:",
+        reply_markup=await start_slots_kb(date, session=session)
     )
-    await state.set_state(BookingStates.CHOOSING_END_TIME)
+    await callback.answer()
 
 
-# Время окончания
-@main_router.message(BookingStates.CHOOSING_END_TIME, F.text.regexp(r'^🟡 \d{2}:\d{2}'))
-async def choose_end_time(message: types.Message, state: FSMContext):
-    time_str = message.text.split()[1]
-    try:
-        time_obj = datetime.strptime(time_str, "%H:%M").time()
-    except ValueError:
-        return await message.answer("Неверный формат времени. Выберите из списка.")
+@main_router.callback_query(BookingFlow.filter(F.act == "s"))
+async def flow_start(callback: types.CallbackQuery, callback_data: BookingFlow, session: AsyncSession):
+    interval = _flow_interval(callback_data)
+    if interval is None:
+        return await callback.answer(BAD_INTERVAL, show_alert=True)
+    date, start_dt, _ = interval
+    if start_dt < datetime.now():
+        return await callback.answer("Нельзя выбрать прошедшее время. Выберите другое.", show_alert=True)
 
-    data = await state.get_data()
-    date = data["selected_date"]
-    start_dt = data["start_time"]
-    end_dt = datetime.combine(date, time_obj)
+    await callback.message.edit_text(
+        f"Дата: {date.strftime('%d.%m.%Y')}, начало в {start_dt.strftime('%H:%M')}\n"
+        "Теперь выберите время окончания:",
+        reply_markup=await end_slots_kb(date, callback_data.start, session=session)
+    )
+    await callback.answer()
 
-    if end_dt <= start_dt:
-        return await message.answer("Время окончания должно быть позже времени начала. Выберите снова.")
 
-    await state.update_data(end_time=end_dt)
-    await message.answer(
-        "Хотите добавить заметку к бронированию? (например, адрес или особые пожелания)\n"
-        "Если нет, отправьте '-'",
-        reply_markup=back_kb()
+@main_router.callback_query(BookingFlow.filter(F.act == "e"))
+async def flow_end(callback: types.CallbackQuery, callback_data: BookingFlow):
+    interval = _flow_interval(callback_data)
+    if interval is None:
+        return await callback.answer(BAD_INTERVAL, show_alert=True)
+    _, start_dt, end_dt = interval
+    await callback.message.edit_text(
+        _confirm_text(start_dt, end_dt),
+        reply_markup=confirm_booking_kb(callback_data.day, callback_data.start, callback_data.end)
     )
+    await callback.answer()
+
+
+@main_router.callback_query(BookingFlow.filter(F.act == "n"))
+async def flow_notes(callback: types.CallbackQuery, callback_data: BookingFlow, state: FSMContext):
+    # текст заметки придёт отдельным сообщением; запоминаем, какое сообщение потом обновить
+    interval = _flow_interval(callback_data)
+    if interval is None:
+        return await callback.answer(BAD_INTERVAL, show_alert=True)
+    _, start_dt, end_dt = interval
     await state.set_state(BookingStates.ADDING_NOTES)
+    await state.set_data({
+        "booking": [callback_data.day, callback_data.start, callback_data.end],
+        "message_id": callback.message.message_id
+    })
+    await callback.message.edit_text(
+        _confirm_text(start_dt, end_dt) + "\n\n"
+        "Отправьте заметку одним сообщением (например, адрес или особые пожелания)",
+        reply_markup=confirm_booking_kb(callback_data.day, callback_data.start, callback_data.end)
+    )
+    await callback.answer()
 
 
 # Заметка
-@main_router.message(BookingStates.ADDING_NOTES)
+@main_router.message(BookingStates.ADDING_NOTES, F.text, F.text != '🔙 Назад')
 async def add_notes(message: types.Message, state: FSMContext):
     notes = message.text if message.text != '-' else None
     data = await state.get_data()
+    day, start, end = data["booking"]
+    date = day_from_code(day)
 
-    confirm_text = (
-        "Подтвердите бронирование:\n"
-        f"📅 Дата: {data['selected_date'].strftime('%d.%m.%Y')}\n"
-        f"⏰ Время: {data['start_time'].strftime('%H:%M')} - {data['end_time'].strftime('%H:%M')}\n"
-        f"📝 Заметки: {notes if notes else 'нет'}"
-    )
-
-    confirm_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Подтвердить", callback_data="confirm_booking")],
-        [InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_booking")]
-    ])
-
+    await state.set_state(None)
     await state.update_data(notes=notes)
-    await message.answer(confirm_text, reply_markup=confirm_kb)
-    await state.set_state(BookingStates.CONFIRMATION)
+    await message.bot.edit_message_text(
+        _confirm_text(slot_time(date, start), slot_time(date, end), notes),
+        chat_id=message.chat.id,
+        message_id=data["message_id"],
+        reply_markup=confirm_booking_kb(day, start, end)
+    )
 
 
 # Подтверждение
-@main_router.callback_query(BookingStates.CONFIRMATION, F.data == "confirm_booking")
-async def confirm_booking(callback: types.CallbackQuery, state: FSMContext):
+@main_router.callback_query(BookingFlow.filter(F.act == "ok"))
+async def confirm_booking(callback: types.CallbackQuery, callback_data: BookingFlow,
+                          state: FSMContext, session: AsyncSession):
+    interval = _flow_interval(callback_data)
+    if interval is None:
+        return await callback.answer(BAD_INTERVAL, show_alert=True)
+    date, start_dt, end_dt = interval
     data = await state.get_data()
-    user = db.get_user(callback.from_user.id)
+    # заметка относится только к тому интервалу, для которого её вводили
+    interval = [callback_data.day, callback_data.start, callback_data.end]
+    notes = data.get("notes") if data.get("booking") == interval else None
+
+    user = await db.get_user(callback.from_user.id, session=session)
     if not user:
-        await callback.message.answer("Ошибка: пользователь не найден")
         await state.clear()
-        return
-
-    booking_id = db.add_booking(
-        driver_id=data['driver_id'],
-        user_id=user.id,
-        booking_time=data['start_time'] - timedelta(minutes=30),
-        end_time=data['end_time'] + timedelta(minutes=30),
-        notes=data.get('notes')
-    )
+        return await callback.answer("Ошибка: пользователь не найден", show_alert=True)
+
+    if start_dt < datetime.now():
+        return await callback.answer("Нельзя выбрать прошедшее время. Выберите другое.", show_alert=True)
+
+    booking_id = driver_id = None
+    for driver in await db.get_free_drivers(start_dt, end_dt, session=session):
+        # add_booking сам перепроверяет пересечения в транзакции записи
+        booking_id = await db.add_booking(
+            driver_id=driver.id,
+            user_id=user.id,
+            booking_time=start_dt - BOOKING_PADDING,
+            end_time=end_dt + BOOKING_PADDING,
+            notes=notes
+        )
+        if booking_id is not None:
+            driver_id = driver.id
+            break
 
     if booking_id is None:
-        # Слот успели занять
+        # Слот успели занять — сразу предлагаем другое время на ту же дату
         await callback.message.edit_text(
-            "⚠️ К сожалению, выбранный интервал уже занят. Пожалуйста, выберите другое время."
+            "⚠️ К сожалению, выбранный интервал уже занят. Пожалуйста, выберите другое время:",
+            reply_markup=await start_slots_kb(date, session=session)
         )
-        await state.clear()
-        return
+        return await callback.answer()
 
     if ADMIN_ID:
-        try:
-            driver = db.get_driver(data['driver_id'])
-            await bot.send_message(
-                ADMIN_ID,
-                f"Новое бронирование #{booking_id}:\n"
-                f"👤 Пользователь: {user.name} (@{user.username})\n"
-                f"🚗 Водитель: {driver.name if driver else 'Неизвестен'}\n"
-                f"📅 Дата: {data['selected_date'].strftime('%d.%m.%Y')}\n"
-                f"⏰ Время: {data['start_time'].strftime('%H:%M')} - {data['end_time'].strftime('%H:%M')}\n"
-                f"📝 Заметки: {data.get('notes', 'нет')}"
-            )
-        except Exception as e:
-            logging.error(f"Ошибка отправки уведомления админу: {e}")
+        driver = await db.get_driver(driver_id, session=session)
+        outbox.notify_admin(
+            f"Новое бронирование #{booking_id}:\n"
+            f"👤 Пользователь: {user.name} (@{user.username})\n"
+            f"🚗 Водитель: {driver.name if driver else 'Неизвестен'}\n"
+            f"📅 Дата: {date.strftime('%d.%m.%Y')}\n"
+            f"⏰ Время: {start_dt.strftime('%H:%M')} - {end_dt.strftime('%H:%M')}\n"
+            f"📝 Заметки: {notes if notes else 'нет'}"
+        )
 
     await callback.message.edit_text(
         f"✅ Бронирование #{booking_id} подтверждено!\n"
-        f"Водитель будет ожидать вас {data['selected_date'].strftime('%d.%m.%Y')} "
-        f"с {data['start_time'].strftime('%H:%M')} до {data['end_time'].strftime('%H:%M')}."
+        f"Водитель будет ожидать вас {date.strftime('%d.%m.%Y')} "
+        f"с {start_dt.strftime('%H:%M')} до {end_dt.strftime('%H:%M')}."
+    )
+    await callback.answer()
+    if data:
+        await state.clear()
+
+
+# Повторяющиеся поездки: /repeat 20.10.2026-20.11.2026 08:00-09:00 будни Заметка
+WEEKDAYS = {"пн": 0, "вт": 1, "ср": 2, "чт": 3, "пт": 4, "сб": 5, "вс": 6}
+WEEKDAY_SETS = {"ежедневно": set(range(7)), "будни": {0, 1, 2, 3, 4}, "выходные": {5, 6}}
+REPEAT_USAGE = (
+    "Формат: /repeat ДД.ММ.ГГГГ-ДД.ММ.ГГГГ ЧЧ:ММ-ЧЧ:ММ [будни|выходные|ежедневно|пн,ср,пт] [заметка]\n"
+    "Например: /repeat 20.10.2026-20.11.2026 08:00-09:00 будни"
+)
+
+
+def _parse_weekdays(word):
+    word = word.lower()
+    if word in WEEKDAY_SETS:
+        return WEEKDAY_SETS[word]
+    days = word.split(",")
+    if all(day in WEEKDAYS for day in days):
+        return {WEEKDAYS[day] for day in days}
+    return None
+
+
+def _parse_repeat(args):
+    """Возвращает (первая дата, последняя дата, начало, конец, дни недели, заметка)."""
+    parts = (args or "").split(maxsplit=2)
+    if len(parts) < 2:
+        raise ValueError("мало аргументов")
+    first, _, last = parts[0].partition("-")
+    first_date = datetime.strptime(first, "%d.%m.%Y").date()
+    last_date = datetime.strptime(last, "%d.%m.%Y").date() if last else first_date
+    start, _, end = parts[1].partition("-")
+    start, end = datetime.strptime(start, "%H:%M").time(), datetime.strptime(end, "%H:%M").time()
+
+    weekdays, notes = WEEKDAY_SETS["ежедневно"], None
+    if len(parts) > 2:
+        word, _, tail = parts[2].partition(" ")
+        days = _parse_weekdays(word)
+        if days is None:
+            notes = parts[2]
+        else:
+            weekdays, notes = days, tail.strip() or None
+    return first_date, last_date, start, end, weekdays, notes
+
+
+@main_router.message(Command("repeat"))
+async def repeat_booking(message: types.Message, command: CommandObject, session: AsyncSession):
+    user = await db.get_user(message.from_user.id, session=session)
+    if not user:
+        return await message.answer("Ошибка: пользователь не найден. Нажмите /start")
+
+    try:
+        first_date, last_date, start, end, weekdays, notes = _parse_repeat(command.args)
+    except ValueError:
+        return await message.answer(REPEAT_USAGE)
+
+    now = datetime.now()
+    if not time(DAY_START_HOUR) <= start < end <= time(DAY_END_HOUR) or \
+            start.minute % SLOT_MINUTES or end.minute % SLOT_MINUTES:
+        return await message.answer(
+            f"Время — с {DAY_START_HOUR:02d}:00 до {DAY_END_HOUR:02d}:00, кратно {SLOT_MINUTES} минутам"
+        )
+    if first_date < now.date() or last_date < first_date or \
+            last_date > now.date() + timedelta(days=CALENDAR_DAYS):
+        return await message.answer(
+            f"Период должен начинаться не раньше сегодняшнего дня и заканчиваться не позже чем через {CALENDAR_DAYS} дней"
+        )
+
+    trips = [(s, e) for s, e in expand_recurrence(first_date, last_date, weekdays, start, end) if s > now]
+    if not trips:
+        return await message.answer("В этом периоде нет подходящих дней")
+
+    # все поездки проверяются и создаются одной транзакцией
+    ids = await db.add_bookings([
+        {"user_id": user.id, "booking_time": s - BOOKING_PADDING, "end_time": e + BOOKING_PADDING, "notes": notes}
+        for s, e in trips
+    ])
+    booked = [trip for trip, booking_id in zip(trips, ids) if booking_id is not None]
+    busy = [trip for trip, booking_id in zip(trips, ids) if booking_id is None]
+
+    text = (
+        f"✅ Создано бронирований: {len(booked)} из {len(trips)}\n"
+        f"⏰ Время: {start.strftime('%H:%M')} - {end.strftime('%H:%M')}\n"
+        f"📝 Заметки: {notes if notes else 'нет'}"
     )
-    await state.clear()
-    await callback.message.answer("Главное меню:", reply_markup=main_menu_kb())
+    if busy:
+        text += "\n⚠️ Заняты: " + ", ".join(s.strftime('%d.%m') for s, _ in busy)
+    await message.answer(text, reply_markup=main_menu_kb())
+
+    if ADMIN_ID and booked:
+        outbox.notify_admin(
+            f"Серия бронирований ({len(booked)}):\n"
+            f"👤 Пользователь: {user.name} (@{user.username})\n"
+            f"📅 С {booked[0][0].strftime('%d.%m.%Y')} по {booked[-1][0].strftime('%d.%m.%Y')}\n"
+            f"⏰ Время: {start.strftime('%H:%M')} - {end.strftime('%H:%M')}"
+        )
 
 
 # Отмена
-@main_router.callback_query(BookingStates.CONFIRMATION, F.data == "cancel_booking")
+@main_router.callback_query(BookingFlow.filter(F.act == "x"))
 async def cancel_booking(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text("❌ Бронирование отменено")
-    await state.clear()
-    await callback.message.answer("Главное меню:", reply_markup=main_menu_kb())
+    await callback.answer()
+    if await state.get_data():
+        await state.clear()
 
 
 # Назад
@@ -276,34 +475,78 @@ async def back_to_menu(message: types.Message, state: FSMContext):
 
 
 async def on_startup():
+    await db.init()
+
     # Добавляем тестового водителя при первом запуске
-    if not db.get_all_drivers():
-        db.add_driver("Персональный водитель")
+    if not await db.get_all_drivers():
+        await db.add_driver("Персональный водитель")
 
     # Добавляем инвайт-код по умолчанию
-    if not db.check_invite(INVITE_CODE):
-        db.add_invite(INVITE_CODE)
+    if not await db.check_invite(INVITE_CODE):
+        await db.add_invite(INVITE_CODE)
 
-    if ADMIN_ID:
-        try:
-            await bot.send_message(ADMIN_ID, "Бот запущен")
-        except Exception as e:
-            logging.error(f"Ошибка отправки уведомления админу: {e}")
+    await outbox.start()
+    scheduler.start()
+    if METRICS_PORT:
+        await metrics.start_server(METRICS_HOST, METRICS_PORT)
+    outbox.notify_admin("Бот запущен")
 
 
 async def on_shutdown():
-    if ADMIN_ID:
-        try:
-            await bot.send_message(ADMIN_ID, "Бот остановлен")
-        except Exception:
-            pass
+    scheduler.shutdown(wait=False)
+    await metrics.stop_server()
+    outbox.notify_admin("Бот остановлен")
+    await outbox.close()
+    await dp.storage.close()
+    await db.close()
+
+
+async def set_webhook():
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
 
 
-if __name__ == "__main__":
+def create_webhook_app():
+    """aiohttp-приложение: Telegram шлёт апдейты POST-запросами на WEBHOOK_PATH."""
+    app = web.Application()
+    # handle_in_background: сразу отвечаем Telegram 200 и обрабатываем апдейты параллельно
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=True
+    ).register(app, path=WEBHOOK_PATH)
+    # startup/shutdown диспетчера привязываются к жизненному циклу приложения
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+def setup_dispatcher():
+    # метрики апдейта — самым внешним слоем, чтобы учесть и открытие сессии
+    dp.update.outer_middleware(UpdateMetricsMiddleware(metrics))
+    # лишние апдейты отбрасываются раньше, чем открывается сессия БД
+    dp.update.outer_middleware(throttling)
+    dp.update.outer_middleware(DbSessionMiddleware())
+    dp.message.middleware(HandlerMetricsMiddleware(metrics))
+    dp.callback_query.middleware(HandlerMetricsMiddleware(metrics))
+    bot.session.middleware(ApiMetricsMiddleware(metrics))
+    metrics.instrument_engine(db.engine, "read")
+    metrics.instrument_engine(db.write_engine, "write")
     dp.include_router(admin_router)
     dp.include_router(main_router)
 
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
+    if RUN_MODE == "webhook":
+        dp.startup.register(set_webhook)
 
-    asyncio.run(dp.start_polling(bot))
+
+if __name__ == "__main__":
+    setup_dispatcher()
+    if RUN_MODE == "webhook":
+        web.run_app(create_webhook_app(), host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    else:
+        asyncio.run(dp.start_polling(bot))
@@ -1,8 +1,12 @@
+import json
 import os
+from functools import partial
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from storage import SQLiteStorage
 
 load_dotenv(encoding='utf-8')
 
@@ -15,6 +19,57 @@ ADMIN_ID = int(_admin_id_str) if (_admin_id_str and _admin_id_str.isdigit()) els
 
 INVITE_CODE = os.getenv("INVITE_CODE", "default123")
 
-storage = MemoryStorage()
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+if RUN_MODE == "webhook" and not WEBHOOK_URL:
+    raise RuntimeError("WEBHOOK_URL не задан в .env")
+
+# За сколько минут до брони отправлять напоминание
+REMINDER_MINUTES = int(os.getenv("REMINDER_MINUTES", "60"))
+
+# Через сколько дней неактивные брони уходят в архивную таблицу; 0 — не архивировать
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "14"))
+
+# Сколько дней хранить завершённые бронирования по статусам (/cleanup);
+# пустое значение — не удалять никогда
+RETENTION_DAYS = {
+    status: int(days)
+    for status, days in (
+        ("canceled", os.getenv("RETENTION_CANCELED_DAYS", "30")),
+        ("completed", os.getenv("RETENTION_COMPLETED_DAYS", "")),
+    )
+    if days
+}
+
+# Метрики в формате Prometheus на METRICS_HOST:METRICS_PORT/metrics; 0 — не поднимать сервер
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Апдейты дольше порога (мс) пишутся в лог с разбивкой по БД и Bot API; 0 — не писать
+SLOW_UPDATE_MS = int(os.getenv("SLOW_UPDATE_MS", "1000"))
+
+# Ограничение частоты апдейтов от одного пользователя: в секунду и запас; 0 — без ограничения.
+# Одинаковые нажатия в пределах THROTTLE_DUPLICATE_WINDOW секунд склеиваются
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", "3"))
+THROTTLE_BURST = int(os.getenv("THROTTLE_BURST", "10"))
+THROTTLE_DUPLICATE_WINDOW = float(os.getenv("THROTTLE_DUPLICATE_WINDOW", "1"))
+
+# FSM: sqlite (по умолчанию, переживает перезапуск) или memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_DB_PATH = os.getenv("FSM_DB_PATH", "fsm.db")
+FSM_TTL = int(os.getenv("FSM_TTL", "86400")) or None  # брошенный сценарий живёт сутки; 0 — без ограничения
+
+if FSM_STORAGE == "memory":
+    storage = MemoryStorage()
+else:
+    storage = SQLiteStorage(FSM_DB_PATH, ttl=FSM_TTL)
+
+# клавиатуры уходят в Bot API как JSON: без \uXXXX-экранирования кириллицы и пробелов
+# разметка кнопок получается примерно вдвое короче
+session = AiohttpSession(json_dumps=partial(json.dumps, ensure_ascii=False, separators=(",", ":")))
+bot = Bot(token=TOKEN, session=session, default=DefaultBotProperties(parse_mode="HTML"))
 dp = Dispatcher(storage=storage)
@@ -1,14 +1,40 @@
 from sqlalchemy import (
-    create_engine,
     Column,
     Integer,
     String,
+    Date,
     DateTime,
     Boolean,
-    ForeignKey
+    LargeBinary,
+    ForeignKey,
+    Index,
+    delete,
+    event,
+    func,
+    insert,
+    inspect,
+    select,
+    update,
+    cast,
+    tuple_
 )
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship, joinedload
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base, relationship, joinedload
+import numpy as np
+import os
+import secrets
+import time
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
+from availability import (
+    AvailabilityIndex, BOOKING_PADDING, SLOT_MINUTES, SLOTS_PER_DAY,
+    any_free_starts, first_slot, free_starts, future_slots_mask, interval_mask,
+    slot_time
+)
+from analytics import COUNTERS, COUNTS_DTYPE, daily_counts, utilization
 
 Base = declarative_base()
 
@@ -34,15 +60,57 @@ class Driver(Base):
 class Booking(Base):
     __tablename__ = 'bookings'
     id = Column(Integer, primary_key=True)
-    driver_id = Column(Integer)
+    driver_id = Column(Integer, ForeignKey('drivers.id'))
     user_id = Column(Integer, ForeignKey('users.id'))
     booking_time = Column(DateTime)   # начало
     end_time = Column(DateTime)       # конец
     notes = Column(String, nullable=True)
     status = Column(String, default='active')  # active/canceled/completed
+    reminded_at = Column(DateTime, nullable=True)  # когда отправлено напоминание
+
+    # отношения к пользователю и водителю
+    user = relationship("User")
+    driver = relationship("Driver")
+
+    __table_args__ = (
+        # слоты водителя на дату: driver_id + status='active' + диапазон booking_time
+        Index('ix_bookings_driver_status_time', 'driver_id', 'status', 'booking_time'),
+        # «Мои бронирования»: user_id с сортировкой по времени
+        Index('ix_bookings_user_time', 'user_id', 'booking_time'),
+        # очистка и выборки по статусу за период
+        Index('ix_bookings_status_time', 'status', 'booking_time'),
+        # постраничный /bookings без фильтров: ключ (booking_time, id)
+        Index('ix_bookings_time', 'booking_time'),
+    )
+
+
+class ArchivedBooking(Base):
+    """Холодная копия отменённых и завершённых броней, см. Database.archive_bookings."""
+    __tablename__ = 'bookings_archive'
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    driver_id = Column(Integer, ForeignKey('drivers.id'))
+    user_id = Column(Integer, ForeignKey('users.id'))
+    booking_time = Column(DateTime)
+    end_time = Column(DateTime)
+    notes = Column(String, nullable=True)
+    status = Column(String)
+    reminded_at = Column(DateTime, nullable=True)
 
-    # отношение к пользователю
     user = relationship("User")
+    driver = relationship("Driver")
+
+    __table_args__ = (
+        Index('ix_bookings_archive_user_time', 'user_id', 'booking_time'),
+        Index('ix_bookings_archive_status_time', 'status', 'booking_time'),
+    )
+
+
+class DailyStats(Base):
+    """Дневные счётчики загрузки водителя для отчётов, см. Database.get_utilization."""
+    __tablename__ = 'booking_stats_daily'
+    day = Column(Date, primary_key=True)
+    driver_id = Column(Integer, primary_key=True)
+    counts = Column(LargeBinary)  # analytics.daily_counts для одного дня и водителя
 
 
 class Invite(Base):
@@ -52,221 +120,901 @@ class Invite(Base):
     is_used = Column(Boolean, default=False)
 
 
+# Без похожих символов (0/O, 1/I/L): коды вводят руками
+INVITE_ALPHABET = "ABCDEFGHJKMNPQRSTUVWXYZ23456789"
+INVITE_CODE_LENGTH = 10
+
+_MISSING = object()
+
+
+class TTLCache:
+    """LRU-кэш ограниченного размера, записи живут не дольше ttl секунд."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=_MISSING):
+        item = self._data.get(key)
+        if item is not None:
+            expires, value = item
+            if expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key=_MISSING):
+        """Удаляет одну запись или, без аргумента, весь кэш."""
+        if key is _MISSING:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+# PRAGMA, которые выставляются на каждое новое соединение
+SQLITE_PROFILES = {
+    # поведение SQLite по умолчанию: rollback-журнал, synchronous=FULL
+    "default": {
+        "busy_timeout": 5000,
+    },
+    # WAL: читатели не ждут писателя; NORMAL в WAL не теряет целостность при сбое
+    "tuned": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -32000,       # ~32 МБ страниц на соединение
+        "mmap_size": 268435456,     # 256 МБ
+        "temp_store": "MEMORY",
+    },
+}
+
+
 class Database:
-    def __init__(self):
-        self.engine = create_engine('sqlite:///bookings.db', connect_args={"check_same_thread": False})
-        Base.metadata.create_all(self.engine)
+    def __init__(self, url='sqlite+aiosqlite:///bookings.db', pool_size=5, max_overflow=10, profile="tuned",
+                 availability_ttl=60):
+        self.pragmas = SQLITE_PROFILES[profile]
+        # aiosqlite выполняет запросы в отдельном потоке, поэтому обработчики
+        # не блокируют цикл событий; соединения переиспользуются пулом
+        self.engine = self._create_engine(url, pool_size=pool_size, max_overflow=max_overflow)
+        # Все записи идут через одно соединение: в SQLite всё равно один писатель,
+        # а так они ждут своей очереди в пуле, не отнимая соединения у чтений
+        self.write_engine = self._create_engine(url, pool_size=1, max_overflow=0)
+        # В WAL чтения апдейта идут одной транзакцией и видят один снимок базы.
+        # С rollback-журналом открытая транзакция чтения держит SHARED-блокировку,
+        # и писатель в том же апдейте не смог бы сделать COMMIT: там каждое
+        # чтение выполняется без BEGIN и сразу отпускает блокировку
+        read_engine = self.engine
+        if self.pragmas.get("journal_mode") != "WAL":
+            read_engine = self.engine.execution_options(sqlite_autocommit=True)
         # КЛЮЧЕВОЕ: не искать объекты после commit и держать данные доступными
-        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.Session = async_sessionmaker(bind=read_engine, expire_on_commit=False)
+        # Транзакции записи берут блокировку сразу (BEGIN IMMEDIATE), чтобы
+        # между проверкой пересечений и вставкой никто не успел занять тот же интервал
+        self.WriteSession = async_sessionmaker(
+            bind=self.write_engine.execution_options(sqlite_immediate=True),
+            expire_on_commit=False
+        )
+        # другие процессы с той же базой не обновляют индекс этого, поэтому он
+        # перечитывается раз в availability_ttl секунд; 0 — только один процесс
+        self.availability = AvailabilityIndex(ttl=availability_ttl or None)
+        # пользователи и водители меняются редко, а читаются почти в каждом апдейте
+        self.user_cache = TTLCache(maxsize=4096, ttl=600)
+        self.driver_cache = TTLCache(maxsize=256, ttl=600)
+        # (ключ, результат) последнего get_free_slot_counts
+        self._free_counts = (None, None)
+
+    def _create_engine(self, url, **kwargs):
+        engine = create_async_engine(url, **kwargs)
+        event.listen(engine.sync_engine, "connect", self._on_connect)
+        event.listen(engine.sync_engine, "begin", self._on_begin)
+        return engine
+
+    async def init(self):
+        """Создаёт таблицы. Вызывается один раз при старте бота."""
+        async with self.write_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(self._migrate)
+
+    @staticmethod
+    def _migrate(conn):
+        """Доводит схему существующего bookings.db до текущих моделей."""
+        existing = {c['name'] for c in inspect(conn).get_columns(Booking.__tablename__)}
+        for column in Booking.__table__.columns:
+            if column.name not in existing:
+                conn.exec_driver_sql(
+                    f"ALTER TABLE {Booking.__tablename__} "
+                    f"ADD COLUMN {column.name} {column.type.compile(conn.dialect)}"
+                )
+        # create_all не добавляет индексы к уже существующим таблицам
+        for index in Booking.__table__.indexes:
+            index.create(conn, checkfirst=True)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        # отключаем неявный BEGIN драйвера, транзакции открывает _on_begin
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in self.pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    @staticmethod
+    def _on_begin(conn):
+        options = conn.get_execution_options()
+        if options.get("sqlite_autocommit"):
+            return
+        if options.get("sqlite_immediate"):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        else:
+            conn.exec_driver_sql("BEGIN")
+
+    @asynccontextmanager
+    async def _reading(self, session=None):
+        """Сессия апдейта из DbSessionMiddleware, если передана, иначе своя короткая."""
+        if session is not None:
+            yield session
+        else:
+            async with self.Session() as session:
+                yield session
+
+    async def close(self):
+        await self.engine.dispose()
+        await self.write_engine.dispose()
+
+    def cache_stats(self):
+        return {
+            "users": self.user_cache.stats(),
+            "drivers": self.driver_cache.stats(),
+        }
 
     # ---------- Users ----------
-    def add_user(self, tg_id, name, username):
-        session = self.Session()
-        try:
-            user = session.query(User).filter_by(tg_id=tg_id).first()
+    async def add_user(self, tg_id, name, username):
+        async with self.WriteSession() as session:
+            user = await session.scalar(select(User).filter_by(tg_id=tg_id))
             if user:
                 return user.id
             user = User(tg_id=tg_id, name=name, username=username)
             session.add(user)
-            session.commit()
+            await session.commit()
+            self.user_cache.invalidate(tg_id)
             return user.id
-        finally:
-            session.close()
 
-    def get_user(self, tg_id):
-        session = self.Session()
-        try:
-            return session.query(User).filter_by(tg_id=tg_id).first()
-        finally:
-            session.close()
+    async def get_user_ids(self, tg_ids, session=None):
+        """{tg_id: id} зарегистрированных пользователей из tg_ids одним запросом."""
+        async with self._reading(session) as session:
+            return dict((await session.execute(
+                select(User.tg_id, User.id).filter(User.tg_id.in_(set(tg_ids)))
+            )).all())
+
+    async def get_user(self, tg_id, session=None):
+        user = self.user_cache.get(tg_id)
+        if user is not _MISSING:
+            return user
+        async with self._reading(session) as session:
+            user = await session.scalar(select(User).filter_by(tg_id=tg_id))
+        # None тоже кэшируется: незарегистрированные шлют /start повторно
+        self.user_cache.set(tg_id, user)
+        return user
 
     # ---------- Invites ----------
-    def add_invite(self, code):
-        session = self.Session()
-        try:
-            if session.query(Invite).filter_by(code=code).first():
+    async def add_invite(self, code):
+        async with self.WriteSession() as session:
+            if await session.scalar(select(Invite).filter_by(code=code)):
                 return False
             session.add(Invite(code=code))
-            session.commit()
+            await session.commit()
             return True
-        finally:
-            session.close()
-
-    def check_invite(self, code):
-        session = self.Session()
-        try:
-            return session.query(Invite).filter_by(code=code, is_used=False).first() is not None
-        finally:
-            session.close()
-
-    def use_invite(self, code):
-        session = self.Session()
-        try:
-            invite = session.query(Invite).filter_by(code=code, is_used=False).first()
-            if not invite:
-                return False
-            invite.is_used = True
-            session.commit()
-            return True
-        finally:
-            session.close()
+
+    async def check_invite(self, code, session=None):
+        async with self._reading(session) as session:
+            return await session.scalar(select(Invite).filter_by(code=code, is_used=False)) is not None
+
+    async def add_invites(self, count, length=INVITE_CODE_LENGTH):
+        """
+        Генерирует count новых уникальных кодов и вставляет их пачкой в одной
+        транзакции. Совпавшие с существующими коды пропускаются и дозаполняются.
+        """
+        created = []
+        async with self.WriteSession() as session:
+            while len(created) < count:
+                codes = {
+                    "".join(secrets.choice(INVITE_ALPHABET) for _ in range(length))
+                    for _ in range(count - len(created))
+                }
+                created += await session.scalars(
+                    sqlite_insert(Invite).on_conflict_do_nothing(index_elements=[Invite.code])
+                    .returning(Invite.code),
+                    [{"code": code} for code in codes]
+                )
+            await session.commit()
+        return created
+
+    async def redeem_invite_and_register(self, code, tg_id, name, username):
+        """
+        Погашает инвайт и регистрирует пользователя одной транзакцией.
+        Условный UPDATE ... WHERE is_used = 0 срабатывает для кода ровно один раз,
+        даже если его вводят одновременно. Возвращает id пользователя или None,
+        если код неверный или уже использован.
+        """
+        async with self.WriteSession() as session:
+            redeemed = await session.execute(
+                update(Invite).filter_by(code=code, is_used=False).values(is_used=True)
+            )
+            if redeemed.rowcount != 1:
+                return None
+            user_id = await session.scalar(
+                sqlite_insert(User).values(tg_id=tg_id, name=name, username=username)
+                .on_conflict_do_update(index_elements=[User.tg_id], set_={"name": name, "username": username})
+                .returning(User.id)
+            )
+            await session.commit()
+        self.user_cache.invalidate(tg_id)
+        return user_id
 
     # ---------- Drivers ----------
-    def add_driver(self, name):
-        session = self.Session()
-        try:
+    async def add_driver(self, name):
+        async with self.WriteSession() as session:
             driver = Driver(name=name)
             session.add(driver)
-            session.commit()
+            await session.commit()
+            self.driver_cache.invalidate()
             return driver.id
-        finally:
-            session.close()
-
-    def get_driver(self, driver_id):
-        session = self.Session()
-        try:
-            return session.get(Driver, driver_id)
-        finally:
-            session.close()
-
-    def get_all_drivers(self):
-        session = self.Session()
-        try:
-            return session.query(Driver).filter_by(is_active=True).all()
-        finally:
-            session.close()
+
+    async def add_drivers(self, drivers):
+        """Вставляет водителей (словари name, phone) многострочными INSERT, возвращает их id."""
+        async with self.WriteSession() as session:
+            ids = (await session.scalars(
+                insert(Driver).returning(Driver.id), drivers
+            )).all()
+            await session.commit()
+        self.driver_cache.invalidate()
+        return ids
+
+    async def get_driver(self, driver_id, session=None):
+        driver = self.driver_cache.get(driver_id)
+        if driver is not _MISSING:
+            return driver
+        async with self._reading(session) as session:
+            driver = await session.get(Driver, driver_id)
+        self.driver_cache.set(driver_id, driver)
+        return driver
+
+    async def get_all_drivers(self, session=None):
+        drivers = self.driver_cache.get("active")
+        if drivers is not _MISSING:
+            return drivers
+        async with self._reading(session) as session:
+            drivers = (await session.scalars(select(Driver).filter_by(is_active=True))).all()
+        self.driver_cache.set("active", drivers)
+        return drivers
 
     # ---------- Bookings ----------
-    def add_booking(self, driver_id, user_id, booking_time, end_time, notes=None):
-        session = self.Session()
-        try:
-            booking = Booking(
-                driver_id=driver_id,
-                user_id=user_id,
-                booking_time=booking_time,
-                end_time=end_time,
-                notes=notes,
-                status='active'
-            )
-            session.add(booking)
-            session.commit()
+    @staticmethod
+    async def _has_overlap(session, driver_id, booking_time, end_time, exclude_id=None):
+        query = select(Booking.id).filter(
+            Booking.driver_id == driver_id,
+            Booking.status == 'active',
+            Booking.booking_time < end_time,
+            Booking.end_time > booking_time
+        )
+        if exclude_id is not None:
+            query = query.filter(Booking.id != exclude_id)
+        return await session.scalar(query.limit(1)) is not None
+
+    @staticmethod
+    async def _next_booking_id(session):
+        """
+        Следующий свободный id брони. Архив хранит бывшие id броней, поэтому
+        максимум берётся по обеим таблицам: иначе id заархивированной брони
+        выдавался бы снова. Вызывается под блокировкой записи.
+        """
+        return 1 + max([
+            await session.scalar(select(func.coalesce(func.max(model.id), 0)))
+            for model in (Booking, ArchivedBooking)
+        ])
+
+    async def add_booking(self, driver_id, user_id, booking_time, end_time, notes=None):
+        """Создаёт бронирование или возвращает None, если интервал уже занят."""
+        async with self.WriteSession() as session:
+            async with session.begin():
+                if await self._has_overlap(session, driver_id, booking_time, end_time):
+                    return None
+                await self._touch_stats(session, booking_time.date())
+                booking = Booking(
+                    id=await self._next_booking_id(session),
+                    driver_id=driver_id,
+                    user_id=user_id,
+                    booking_time=booking_time,
+                    end_time=end_time,
+                    notes=notes,
+                    status='active'
+                )
+                session.add(booking)
+            self.availability.occupy(driver_id, booking_time, end_time)
             return booking.id
-        finally:
-            session.close()
-
-    def get_booking(self, booking_id):
-        session = self.Session()
-        try:
-            return session.get(Booking, booking_id)
-        finally:
-            session.close()
-
-    def get_user_bookings(self, user_id):
-        session = self.Session()
-        try:
-            return (
-                session.query(Booking)
+
+    @staticmethod
+    async def _busy_intervals(session, driver_ids, start, end):
+        """
+        Активные брони водителей, пересекающие [start, end), одним запросом:
+        {driver_id: (начала, концы)} по возрастанию. Активные брони водителя
+        не пересекаются, поэтому концы тоже отсортированы.
+        """
+        busy = defaultdict(lambda: ([], []))
+        rows = await session.execute(
+            select(Booking.driver_id, Booking.booking_time, Booking.end_time)
+            .filter(
+                Booking.driver_id.in_(driver_ids),
+                Booking.status == 'active',
+                Booking.booking_time < end,
+                Booking.end_time > start
+            )
+            .order_by(Booking.driver_id, Booking.booking_time)
+        )
+        for driver_id, booking_time, end_time in rows:
+            busy[driver_id][0].append(booking_time)
+            busy[driver_id][1].append(end_time)
+        return busy
+
+    @staticmethod
+    def _overlaps(intervals, start, end):
+        starts, ends = intervals
+        i = bisect_left(starts, end)
+        return i > 0 and ends[i - 1] > start
+
+    @staticmethod
+    def _reserve(intervals, start, end):
+        starts, ends = intervals
+        i = bisect_left(starts, start)
+        starts.insert(i, start)
+        ends.insert(i, end)
+
+    async def add_bookings(self, bookings):
+        """
+        Создаёт пачку бронирований одной транзакцией. bookings — словари с
+        user_id, booking_time, end_time и необязательными notes, status и
+        driver_id (None — любой свободный активный водитель, по возможности
+        тот же, что у предыдущей брони пачки).
+        Пересечения активных броней с базой и друг с другом проверяются по
+        одной выборке занятости, вставка — один INSERT на всю пачку.
+        Возвращает id по порядку bookings, None — интервал занят.
+        """
+        if not bookings:
+            return []
+        drivers = [d.id for d in await self.get_all_drivers()]
+        bookings = [{"driver_id": None, "notes": None, "status": 'active', **b} for b in bookings]
+        active = [b for b in bookings if b["status"] == 'active']
+        result = [None] * len(bookings)
+        async with self.WriteSession() as session:
+            async with session.begin():
+                busy = {}
+                if active:
+                    driver_ids = {b["driver_id"] for b in active}
+                    if None in driver_ids:
+                        driver_ids = (driver_ids - {None}) | set(drivers)
+                    busy = await self._busy_intervals(
+                        session, driver_ids,
+                        min(b["booking_time"] for b in active), max(b["end_time"] for b in active)
+                    )
+
+                rows, positions, preferred = [], [], None
+                for i, b in enumerate(bookings):
+                    if b["status"] == 'active':
+                        if b["driver_id"] is not None:
+                            candidates = [b["driver_id"]]
+                        else:
+                            candidates = ([preferred] if preferred else []) + drivers
+                        driver_id = next((
+                            d for d in candidates
+                            if not self._overlaps(busy[d], b["booking_time"], b["end_time"])
+                        ), None)
+                        if driver_id is None:
+                            continue
+                        self._reserve(busy[driver_id], b["booking_time"], b["end_time"])
+                        if b["driver_id"] is None:
+                            preferred = driver_id
+                        b = {**b, "driver_id": driver_id}
+                    rows.append(b)
+                    positions.append(i)
+
+                if rows:
+                    # id назначаются явно: под блокировкой записи между max(id) и INSERT
+                    # никто не вставит, а без RETURNING вся пачка уходит одним executemany.
+                    # INSERT по таблице, а не по модели: ORM дробит пачку на серии
+                    # строк с одинаковыми None (notes есть не у всех) — по запросу на серию
+                    first_id = await self._next_booking_id(session)
+                    rows = [{**b, "id": first_id + k} for k, b in enumerate(rows)]
+                    await session.execute(insert(Booking.__table__), rows)
+                    await self._touch_stats(session, *{b["booking_time"].date() for b in rows})
+                    for i, b in zip(positions, rows):
+                        result[i] = b["id"]
+        for i, b in zip(positions, rows):
+            if b["status"] == 'active':
+                self.availability.occupy(b["driver_id"], b["booking_time"], b["end_time"])
+        return result
+
+    async def get_booking(self, booking_id, session=None):
+        async with self._reading(session) as session:
+            return await session.get(Booking, booking_id)
+
+    async def get_user_bookings(self, user_id, include_history=False, session=None):
+        """Брони из рабочей таблицы; с include_history — вместе с архивом."""
+        async with self._reading(session) as session:
+            bookings = (await session.scalars(
+                select(Booking)
+                .options(joinedload(Booking.driver))
                 .filter_by(user_id=user_id)
                 .order_by(Booking.booking_time)
-                .all()
-            )
-        finally:
-            session.close()
-
-    def get_all_bookings(self):
-        session = self.Session()
-        try:
-            return (
-                session.query(Booking)
-                .options(joinedload(Booking.user))
+            )).all()
+            if not include_history:
+                return bookings
+            archived = (await session.scalars(
+                select(ArchivedBooking)
+                .options(joinedload(ArchivedBooking.driver))
+                .filter_by(user_id=user_id)
+                .order_by(ArchivedBooking.booking_time)
+            )).all()
+        return sorted([*archived, *bookings], key=lambda b: b.booking_time)
+
+    async def get_all_bookings(self, session=None):
+        async with self._reading(session) as session:
+            return (await session.scalars(
+                select(Booking)
+                .options(joinedload(Booking.user), joinedload(Booking.driver))
                 .order_by(Booking.booking_time)
-                .all()
+            )).all()
+
+    async def get_bookings_page(self, after=None, before=None, limit=10,
+                                status=None, date=None, driver_id=None, session=None):
+        """
+        Страница бронирований по ключу (booking_time, id): after — следующая
+        страница после этого ключа, before — предыдущая перед ним.
+        Возвращает (bookings, has_more) — есть ли ещё записи в сторону листания.
+        """
+        key = tuple_(Booking.booking_time, Booking.id)
+        query = select(Booking).options(joinedload(Booking.user), joinedload(Booking.driver))
+        if status:
+            query = query.filter(Booking.status == status)
+        if driver_id:
+            query = query.filter(Booking.driver_id == driver_id)
+        if date:
+            query = query.filter(
+                Booking.booking_time >= datetime.combine(date, datetime.min.time()),
+                Booking.booking_time <= datetime.combine(date, datetime.max.time())
             )
-        finally:
-            session.close()
-
-    def get_driver_bookings_on_date(self, driver_id, date):
-        session = self.Session()
-        try:
-            start_dt = datetime.combine(date, datetime.min.time())
-            end_dt = datetime.combine(date, datetime.max.time())
-            return (
-                session.query(Booking)
-                .options(joinedload(Booking.user))
+        if before is not None:
+            query = query.filter(key < tuple_(*before)).order_by(Booking.booking_time.desc(), Booking.id.desc())
+        else:
+            if after is not None:
+                query = query.filter(key > tuple_(*after))
+            query = query.order_by(Booking.booking_time, Booking.id)
+
+        async with self._reading(session) as session:
+            bookings = (await session.scalars(query.limit(limit + 1))).all()
+        has_more = len(bookings) > limit
+        bookings = bookings[:limit]
+        if before is not None:
+            bookings.reverse()
+        return bookings, has_more
+
+    async def stream_bookings(self, date_from=None, date_to=None, status=None, driver_id=None,
+                              include_archive=True, chunk_size=1000):
+        """
+        Брони для выгрузки: асинхронный генератор пачек строк (id, booking_time,
+        end_time, status, driver_id, driver, tg_id, user, username, notes).
+        Сначала архив, потом рабочая таблица, внутри — по (booking_time, id).
+        Курсор читается по chunk_size строк (yield_per), поэтому в памяти
+        не больше одной пачки, сколько бы броней ни выгружалось.
+        """
+        models = (ArchivedBooking, Booking) if include_archive else (Booking,)
+        async with self.Session() as session:
+            for model in models:
+                query = (
+                    select(
+                        model.id, model.booking_time, model.end_time, model.status, model.driver_id,
+                        Driver.name.label("driver"), User.tg_id, User.name.label("user"),
+                        User.username, model.notes
+                    )
+                    .outerjoin(Driver, Driver.id == model.driver_id)
+                    .outerjoin(User, User.id == model.user_id)
+                )
+                if status:
+                    query = query.filter(model.status == status)
+                if driver_id:
+                    query = query.filter(model.driver_id == driver_id)
+                if date_from:
+                    query = query.filter(model.booking_time >= datetime.combine(date_from, datetime.min.time()))
+                if date_to:
+                    query = query.filter(model.booking_time <= datetime.combine(date_to, datetime.max.time()))
+                result = await session.stream(
+                    query.order_by(model.booking_time, model.id).execution_options(yield_per=chunk_size)
+                )
+                async for rows in result.partitions():
+                    yield rows
+
+    async def get_occupancy_range(self, start_date, days, session=None):
+        """
+        Занятость всех активных водителей на days дней вперёд:
+        {(driver_id, date): маска}. Недостающие дни грузятся одним запросом
+        сразу по всем водителям и всему диапазону.
+        """
+        drivers = await self.get_all_drivers(session=session)
+        dates = [start_date + timedelta(days=i) for i in range(days)]
+        cached = {(d.id, date): self.availability.get(d.id, date) for d in drivers for date in dates}
+        if all(mask is not None for mask in cached.values()):
+            return cached
+
+        version = (session.info.get("availability_version", self.availability.version)
+                   if session is not None else self.availability.version)
+        async with self._reading(session) as session:
+            rows = (await session.execute(
+                select(Booking.driver_id, Booking.booking_time, Booking.end_time)
                 .filter(
-                    Booking.driver_id == driver_id,
+                    Booking.driver_id.in_([d.id for d in drivers]),
                     Booking.status == 'active',
-                    Booking.booking_time >= start_dt,
-                    Booking.booking_time <= end_dt
+                    Booking.booking_time >= datetime.combine(dates[0], datetime.min.time()),
+                    Booking.booking_time <= datetime.combine(dates[-1], datetime.max.time())
                 )
-                .order_by(Booking.booking_time)
-                .all()
-            )
-        finally:
-            session.close()
-
-    def cancel_booking(self, booking_id):
-        session = self.Session()
-        try:
-            booking = session.get(Booking, booking_id)
+            )).all()
+        result = {(d.id, date): 0 for d in drivers for date in dates}
+        for driver_id, booking_time, end_time in rows:
+            key = (driver_id, booking_time.date())
+            result[key] |= interval_mask(key[1], booking_time, end_time)
+        for (driver_id, date), mask in result.items():
+            self.availability.put(driver_id, date, mask, version)
+        return result
+
+    async def find_first_free(self, length, days=60, now=None, session=None):
+        """
+        Самое раннее окно длиной length слотов у любого активного водителя
+        за days дней: (driver_id, начало, конец) без запаса или None.
+        """
+        now = now or datetime.now()
+        occupancy = await self.get_occupancy_range(now.date(), days, session=session)
+        drivers = await self.get_all_drivers(session=session)
+        for i in range(days):
+            date = now.date() + timedelta(days=i)
+            best = None
+            for driver in drivers:
+                # сегодня — только слоты, которые ещё не начались
+                starts = free_starts(occupancy[driver.id, date], length) & future_slots_mask(date, now)
+                slot = first_slot(starts)
+                if slot is not None and (best is None or slot < best[1]):
+                    best = (driver.id, slot)
+            if best:
+                start = slot_time(date, best[1])
+                return best[0], start, start + timedelta(minutes=SLOT_MINUTES * length)
+        return None
+
+    async def get_free_drivers(self, start, end, session=None):
+        """Активные водители, у которых свободен интервал [start, end) вместе с запасом."""
+        occupancy = await self.get_occupancy_range(start.date(), 1, session=session)
+        wanted = interval_mask(start.date(), start - BOOKING_PADDING, end + BOOKING_PADDING)
+        return [
+            driver for driver in await self.get_all_drivers(session=session)
+            if not occupancy[driver.id, start.date()] & wanted
+        ]
+
+    async def get_free_slot_counts(self, start_date, days, now=None, session=None):
+        """
+        {дата: число слотов, с которых можно начать поездку хотя бы у одного
+        водителя} на days дней.
+        Считается по маскам занятости из get_occupancy_range и переиспользуется,
+        пока не изменились брони, список водителей или не прошёл очередной слот.
+        """
+        now = now or datetime.now()
+        drivers = await self.get_all_drivers(session=session)
+        key = (start_date, days, self.availability.version,
+               tuple(d.id for d in drivers), future_slots_mask(start_date, now))
+        if self._free_counts[0] == key:
+            return self._free_counts[1]
+
+        occupancy = await self.get_occupancy_range(start_date, days, session=session)
+        counts = {}
+        for i in range(days):
+            date = start_date + timedelta(days=i)
+            starts = any_free_starts((occupancy[d.id, date] for d in drivers), 1)
+            counts[date] = bin(starts & future_slots_mask(date, now)).count("1")
+        self._free_counts = (key, counts)
+        return counts
+
+    async def cancel_booking(self, booking_id):
+        async with self.WriteSession() as session:
+            booking = await session.get(Booking, booking_id)
             if not booking:
                 return False
+            was_active = booking.status == 'active'
             booking.status = 'canceled'
-            session.commit()
+            await self._touch_stats(session, booking.booking_time.date())
+            await session.commit()
+            if was_active:
+                self.availability.release(booking.driver_id, booking.booking_time, booking.end_time)
             return True
-        finally:
-            session.close()
 
-    def delete_canceled_bookings(self):
+    async def take_due_reminders(self, now, lead):
+        """
+        Активные брони, которые начинаются в ближайшие lead и ещё без
+        напоминания. Выборка по индексу (status, booking_time) и отметка
+        reminded_at — в одной транзакции, чтобы напоминание ушло один раз.
+        """
+        async with self.WriteSession() as session:
+            async with session.begin():
+                bookings = (await session.scalars(
+                    select(Booking)
+                    .options(joinedload(Booking.user))
+                    .filter(
+                        Booking.status == 'active',
+                        Booking.booking_time > now,
+                        Booking.booking_time <= now + lead,
+                        Booking.reminded_at.is_(None)
+                    )
+                )).all()
+                if bookings:
+                    await session.execute(
+                        update(Booking)
+                        .where(Booking.id.in_([b.id for b in bookings]))
+                        .values(reminded_at=now)
+                        .execution_options(synchronize_session=False)
+                    )
+            return bookings
+
+    async def complete_past_bookings(self, now):
+        """Переводит закончившиеся активные брони в 'completed' одним UPDATE."""
+        async with self.WriteSession() as session:
+            async with session.begin():
+                rows = (await session.execute(
+                    update(Booking)
+                    .where(
+                        Booking.status == 'active',
+                        Booking.booking_time < now,  # диапазон по индексу (status, booking_time)
+                        Booking.end_time <= now
+                    )
+                    .values(status='completed')
+                    .returning(Booking.driver_id, Booking.booking_time, Booking.end_time)
+                    .execution_options(synchronize_session=False)
+                )).all()
+        for driver_id, booking_time, end_time in rows:
+            self.availability.release(driver_id, booking_time, end_time)
+        return len(rows)
+
+    async def purge_bookings(self, status, older_than=None, chunk_size=5000, dry_run=False):
+        """
+        Удаляет бронирования со статусом status (и началом раньше older_than)
+        из рабочей таблицы и архива пачками по chunk_size: один DELETE на пачку,
+        каждая пачка — своя короткая транзакция, чтобы не держать блокировку
+        записи. dry_run — только посчитать.
+        """
+        if status == 'active':
+            raise ValueError("Активные бронирования не удаляются")
+
+        total = 0
+        for model in (Booking, ArchivedBooking):
+            conditions = [model.status == status]
+            if older_than is not None:
+                conditions.append(model.booking_time < older_than)
+
+            if dry_run:
+                async with self.Session() as session:
+                    total += await session.scalar(select(func.count()).select_from(model).filter(*conditions))
+                continue
+
+            while True:
+                chunk = select(model.id).filter(*conditions).limit(chunk_size)
+                async with self.WriteSession() as session:
+                    async with session.begin():
+                        result = await session.execute(
+                            delete(model)
+                            .where(model.id.in_(chunk.scalar_subquery()))
+                            .execution_options(synchronize_session=False)
+                        )
+                total += result.rowcount
+                if result.rowcount < chunk_size:
+                    break
+        return total
+
+    async def archive_bookings(self, older_than, chunk_size=1000):
+        """
+        Переносит отменённые и завершённые брони, начавшиеся раньше older_than,
+        в bookings_archive. Каждая пачка — INSERT ... SELECT и DELETE в одной
+        транзакции, так что строка всегда ровно в одной из таблиц.
+        """
+        columns = [c.name for c in Booking.__table__.columns]
+        total = 0
+        while True:
+            async with self.WriteSession() as session:
+                async with session.begin():
+                    ids = (await session.scalars(
+                        select(Booking.id)
+                        .filter(
+                            Booking.status.in_(('canceled', 'completed')),
+                            Booking.booking_time < older_than
+                        )
+                        .limit(chunk_size)
+                    )).all()
+                    if ids:
+                        await session.execute(
+                            ArchivedBooking.__table__.insert().from_select(
+                                columns,
+                                select(*(Booking.__table__.c[name] for name in columns))
+                                .where(Booking.id.in_(ids))
+                            )
+                        )
+                        await session.execute(
+                            delete(Booking)
+                            .where(Booking.id.in_(ids))
+                            .execution_options(synchronize_session=False)
+                        )
+            total += len(ids)
+            if len(ids) < chunk_size:
+                return total
+
+    async def apply_retention(self, policy, dry_run=False):
+        """policy: {статус: сколько дней хранить}. Возвращает {статус: удалено}."""
+        now = datetime.now()
+        return {
+            status: await self.purge_bookings(status, now - timedelta(days=days), dry_run=dry_run)
+            for status, days in policy.items()
+        }
+
+    async def delete_canceled_bookings(self):
         """Удаляет все бронирования со статусом 'canceled'"""
-        session = self.Session()
-        try:
-            canceled_bookings = session.query(Booking).filter(Booking.status == 'canceled').all()
-            for booking in canceled_bookings:
-                session.delete(booking)
-            session.commit()
-            return len(canceled_bookings)
-        except Exception as e:
-            session.rollback()
-            print(f"Ошибка при удалении: {e}")
-            return 0
-        finally:
-            session.close()
-
-    def delete_old_canceled_bookings(self, days=30):
+        return await self.purge_bookings('canceled')
+
+    async def delete_old_canceled_bookings(self, days=30):
         """Удаляет отмененные бронирования старше указанного количества дней"""
-        session = self.Session()
-        try:
-            cutoff_date = datetime.now() - timedelta(days=days)
-            old_bookings = session.query(Booking).filter(
-                Booking.status == 'canceled',
-                Booking.booking_time < cutoff_date
-            ).all()
-
-            for booking in old_bookings:
-                session.delete(booking)
-
-            session.commit()
-            return len(old_bookings)  # Возвращаем количество удаленных записей
-        finally:
-            session.close()
-
-    def update_booking(self, booking_id, new_time=None, end_time=None, notes=None):
-        session = self.Session()
-        try:
-            booking = session.get(Booking, booking_id)
-            if not booking:
-                return False
-            if new_time:
-                booking.booking_time = new_time
-            if end_time:
-                booking.end_time = end_time
-            if notes is not None:
-                booking.notes = notes
-            session.commit()
+        return await self.purge_bookings('canceled', datetime.now() - timedelta(days=days))
+
+    async def update_booking(self, booking_id, new_time=None, end_time=None, notes=None):
+        """Возвращает None, если новый интервал пересекается с другой активной бронью."""
+        async with self.WriteSession() as session:
+            async with session.begin():
+                booking = await session.get(Booking, booking_id)
+                if not booking:
+                    return False
+                old_interval = (booking.booking_time, booking.end_time)
+                new_interval = (new_time or booking.booking_time, end_time or booking.end_time)
+                if (booking.status == 'active' and new_interval != old_interval
+                        and await self._has_overlap(session, booking.driver_id, *new_interval,
+                                                    exclude_id=booking.id)):
+                    return None
+                booking.booking_time, booking.end_time = new_interval
+                await self._touch_stats(session, old_interval[0].date(), new_interval[0].date())
+                if notes is not None:
+                    booking.notes = notes
+            if booking.status == 'active':
+                self.availability.release(booking.driver_id, *old_interval)
+                self.availability.occupy(booking.driver_id, booking.booking_time, booking.end_time)
             return True
-        finally:
-            session.close()
 
+    # ---------- Statistics ----------
+    @staticmethod
+    async def _touch_stats(session, *days):
+        """Сбрасывает сохранённые счётчики прошедших дней, которые задела запись."""
+        today = datetime.now().date()
+        past = {day for day in days if day < today}
+        if past:
+            await session.execute(delete(DailyStats).where(DailyStats.day.in_(past)))
+
+    @staticmethod
+    async def _stats_rows(session, first_day, last_day):
+        """
+        Брони рабочей таблицы и архива за дни [first_day, last_day] для
+        analytics.daily_counts: (driver_id, начало, конец, отменена), время —
+        целые минуты от 1970-01-01, чтобы не разбирать datetime построчно.
+        """
+        start = datetime.combine(first_day, datetime.min.time())
+        end = datetime.combine(last_day + timedelta(days=1), datetime.min.time())
+        rows = []
+        for model in (Booking, ArchivedBooking):
+            rows += (await session.execute(
+                select(
+                    model.driver_id,
+                    cast(func.strftime('%s', model.booking_time), Integer) // 60,
+                    cast(func.strftime('%s', model.end_time), Integer) // 60,
+                    model.status == 'canceled'
+                )
+                .filter(
+                    # статус перечислен, чтобы диапазон шёл по индексу (status, booking_time)
+                    model.status.in_(('active', 'canceled', 'completed')),
+                    model.booking_time >= start,
+                    model.booking_time < end
+                )
+            )).all()
+        return rows
+
+    async def _materialize_stats(self, days, driver_ids):
+        """Считает и сохраняет счётчики прошедших дней days одним проходом по броням."""
+        async with self.WriteSession() as session:
+            async with session.begin():
+                # пока ждали блокировку записи, часть дней мог посчитать другой отчёт
+                done = set(await session.scalars(
+                    select(DailyStats.day).filter(DailyStats.day.in_(days)).distinct()
+                ))
+                days = [day for day in days if day not in done]
+                if not days:
+                    return
+                first_day = days[0]
+                counts = daily_counts(
+                    await self._stats_rows(session, first_day, days[-1]),
+                    first_day, (days[-1] - first_day).days + 1, driver_ids
+                )
+                await session.execute(insert(DailyStats), [
+                    {"day": day, "driver_id": driver_id, "counts": counts[(day - first_day).days, i].tobytes()}
+                    for day in days for i, driver_id in enumerate(driver_ids)
+                ])
+
+    async def get_utilization(self, first_day, last_day, now=None):
+        """
+        Загрузка водителей за дни [first_day, last_day]: analytics.utilization
+        и drivers — id водителей в порядке первой оси массивов.
+        Счётчики прошедших дней берутся из booking_stats_daily: каждый день
+        считается один раз, при первом отчёте, и пересчитывается, только если
+        запись задела его бронь (_touch_stats). Очистка старых броней счётчики
+        не трогает. Сегодняшний и будущие дни считаются по броням каждый раз.
+        """
+        today = (now or datetime.now()).date()
+        days = (last_day - first_day).days + 1
+        async with self.Session() as session:
+            driver_ids = sorted(await session.scalars(select(Driver.id)))
+        counts = np.zeros((days, len(driver_ids), COUNTERS, SLOTS_PER_DAY), dtype=COUNTS_DTYPE)
+
+        closed_last = min(last_day, today - timedelta(days=1))
+        if driver_ids and closed_last >= first_day:
+            async with self.Session() as session:
+                done = set(await session.scalars(
+                    select(DailyStats.day).filter(DailyStats.day.between(first_day, closed_last)).distinct()
+                ))
+            closed = [first_day + timedelta(days=i) for i in range((closed_last - first_day).days + 1)]
+            missing = [day for day in closed if day not in done]
+            if missing:
+                await self._materialize_stats(missing, driver_ids)
+
+            async with self.Session() as session:
+                stored = (await session.execute(
+                    select(DailyStats.day, DailyStats.driver_id, DailyStats.counts)
+                    .filter(DailyStats.day.between(first_day, closed_last),
+                            DailyStats.driver_id.in_(driver_ids))
+                )).all()
+            if stored:
+                day, driver, blobs = zip(*stored)
+                index = (np.array(day, dtype="datetime64[D]") - np.datetime64(first_day, "D")).astype(np.int64)
+                column = np.searchsorted(driver_ids, driver)
+                counts[index, column] = np.frombuffer(b"".join(blobs), dtype=COUNTS_DTYPE).reshape(
+                    len(stored), COUNTERS, SLOTS_PER_DAY
+                )
+
+        open_first = max(first_day, today)
+        if driver_ids and open_first <= last_day:
+            async with self.Session() as session:
+                rows = await self._stats_rows(session, open_first, last_day)
+            offset = (open_first - first_day).days
+            counts[offset:] = daily_counts(rows, open_first, days - offset, driver_ids)
+
+        return {"drivers": driver_ids, **utilization(counts, first_day)}
 
-db = Database()
+
+# профиль PRAGMA: tuned (по умолчанию) или default
+db = Database(
+    profile=os.getenv("SQLITE_PROFILE", "tuned"),
+    availability_ttl=int(os.getenv("AVAILABILITY_TTL", "60"))
+)
@@ -1,10 +1,17 @@
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
     InlineKeyboardMarkup,
     InlineKeyboardButton
 )
+from bisect import bisect_right
 from datetime import datetime, timedelta
+from typing import Optional
+from functools import lru_cache
+from availability import (
+    BOOKING_PADDING, SLOTS_PER_DAY, any_free_starts, future_slots_mask, interval_mask, slot_time
+)
 
 
 def main_menu_kb():
@@ -23,56 +30,146 @@ def get_calendar_kb():
     return ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text='📅 Показать календарь')],
+            [KeyboardButton(text='⚡ Ближайшее свободное время')],
             [KeyboardButton(text='🔙 Назад')]
         ],
         resize_keyboard=True
     )
 
 
-def generate_dates_kb():
-    today = datetime.now().date()
-    dates = [today + timedelta(days=i) for i in range(0, 60)]
+CALENDAR_DAYS = 60
+# четыре недели на странице — ближайшие даты без лишних байт в каждом ответе
+DATES_PER_PAGE = 28
+DAY_NAMES = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+
+class BookingFlow(CallbackData, prefix="bf"):
+    # весь сценарий бронирования живёт в callback_data кнопок одного сообщения
+    # шаг: d — дата, s — начало, e — окончание, n — заметка, ok — подтвердить, x — отмена, b — к датам
+    act: str
+    day: Optional[int] = None    # date.toordinal()
+    start: Optional[int] = None  # номер слота начала
+    end: Optional[int] = None    # номер слота окончания
+
+
+def day_code(date):
+    # порядковый номер дня короче, чем ГГГГММДД, а callback_data ограничена 64 байтами
+    return date.toordinal()
+
+
+def day_from_code(code):
+    return datetime.fromordinal(code).date()
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def time_code(dt):
+    # секунды от 1970-01-01 без часового пояса: время броней хранится наивным
+    return (dt - EPOCH) // timedelta(seconds=1)
 
-    buttons = []
-    for d in dates:
-        day_name = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"][d.weekday()]
-        buttons.append(KeyboardButton(text=f"{day_name} {d.strftime('%d.%m')}"))
 
-    rows = [buttons[i:i + 4] for i in range(0, len(buttons), 4)]
-    rows.append([KeyboardButton(text='🔙 Назад')])
-    return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
+def time_from_code(code):
+    return EPOCH + timedelta(seconds=code)
 
 
-def generate_time_slots_kb(date, driver_id, user_id=None):
+def _rows(buttons, width=4):
+    return [buttons[i:i + width] for i in range(0, len(buttons), width)]
+
+
+@lru_cache(maxsize=16)
+def _dates_kb(dates, prev_day=None, next_day=None):
+    # страница меняется не чаще, чем заполняется день целиком или наступает новый
+    buttons = [
+        InlineKeyboardButton(
+            text=f"{DAY_NAMES[d.weekday()]} {d.strftime('%d.%m')}",
+            callback_data=BookingFlow(act="d", day=day_code(d)).pack()
+        )
+        for d in dates
+    ]
+    rows = _rows(buttons)
+    nav = []
+    if prev_day is not None:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=BookingFlow(act="b", day=prev_day).pack()))
+    if next_day is not None:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=BookingFlow(act="b", day=next_day).pack()))
+    if nav:
+        rows.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+async def generate_dates_kb(day=None, session=None):
+    """
+    Дни на CALENDAR_DAYS вперёд, в которых есть хотя бы один свободный слот,
+    страницами по DATES_PER_PAGE; показывается страница с датой day.
+    """
     from database import db
-    from datetime import datetime, time as dtime
 
-    bookings = db.get_driver_bookings_on_date(driver_id, date)  # уже с joinedload(user)
-    # Составим интервалы, заранее вытащив имя пользователя (без ленивой подгрузки)
-    intervals = []
-    for b in bookings:
-        booked_by_name = b.user.name if getattr(b, "user", None) else "Неизвестно"
-        intervals.append((b.booking_time, b.end_time, b.user_id, booked_by_name))
+    counts = await db.get_free_slot_counts(datetime.now().date(), CALENDAR_DAYS, session=session)
+    dates = [d for d, free in counts.items() if free]
+    codes = [day_code(d) for d in dates]
+    index = bisect_right(codes, day) - 1 if day else 0
+    first = max(index, 0) // DATES_PER_PAGE * DATES_PER_PAGE
+    last = first + DATES_PER_PAGE
+    return _dates_kb(
+        tuple(dates[first:last]),
+        codes[first - DATES_PER_PAGE] if first else None,
+        codes[last] if last < len(codes) else None
+    )
 
-    free_buttons = []
-    for hour in range(8, 22):
-        for minute in (0, 30):
-            slot_start = datetime.combine(date, dtime(hour=hour, minute=minute))
-            slot_end = slot_start + timedelta(minutes=30)
 
-            # пересечение интервалов
-            taken = False
-            for b_start, b_end, b_uid, _ in intervals:
-                if (slot_start < b_end) and (slot_end > b_start):
-                    taken = True
-                    break
+async def start_slots_kb(date, session=None):
+    """Слоты, с которых можно начать поездку хотя бы у одного водителя."""
+    from database import db
 
-            if not taken:
-                free_buttons.append(KeyboardButton(text=f"🟡 {hour:02d}:{minute:02d}"))
+    occupancy = await db.get_occupancy_range(date, 1, session=session)
+    starts = any_free_starts(occupancy.values(), 1) & future_slots_mask(date, datetime.now())
+    code = day_code(date)
+    buttons = [
+        InlineKeyboardButton(
+            text=slot_time(date, i).strftime('%H:%M'),
+            callback_data=BookingFlow(act="s", day=code, start=i).pack()
+        )
+        for i in range(SLOTS_PER_DAY) if starts & (1 << i)
+    ]
+    rows = _rows(buttons)
+    rows.append([InlineKeyboardButton(text='🔙 К датам', callback_data=BookingFlow(act="b", day=code).pack())])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+async def end_slots_kb(date, start, session=None):
+    """Окончания, при которых весь интервал с запасом свободен хотя бы у одного водителя."""
+    from database import db
 
-    rows = [free_buttons[i:i + 4] for i in range(0, len(free_buttons), 4)]
-    rows.append([KeyboardButton(text='🔙 Назад')])
-    return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
+    masks = (await db.get_occupancy_range(date, 1, session=session)).values()
+    code = day_code(date)
+    buttons = []
+    for end in range(start + 1, SLOTS_PER_DAY + 1):
+        wanted = interval_mask(
+            date, slot_time(date, start) - BOOKING_PADDING, slot_time(date, end) + BOOKING_PADDING
+        )
+        if all(mask & wanted for mask in masks):
+            break  # интервал только растёт — дальше тоже занято
+        buttons.append(InlineKeyboardButton(
+            text=slot_time(date, end).strftime('%H:%M'),
+            callback_data=BookingFlow(act="e", day=code, start=start, end=end).pack()
+        ))
+    rows = _rows(buttons)
+    rows.append([InlineKeyboardButton(text='🔙 Назад', callback_data=BookingFlow(act="d", day=code).pack())])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def confirm_booking_kb(day, start, end):
+    def button(text, act):
+        return InlineKeyboardButton(
+            text=text, callback_data=BookingFlow(act=act, day=day, start=start, end=end).pack()
+        )
+
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [button("✅ Подтвердить", "ok")],
+        [button("📝 Заметка", "n"), button("🔙 Назад", "s")],
+        [button("❌ Отменить", "x")]
+    ])
 
 
 def booking_actions_kb(booking_id):
@@ -83,5 +180,28 @@ def booking_actions_kb(booking_id):
     return kb
 
 
-def back_kb():
-    return ReplyKeyboardMarkup(keyboard=[[KeyboardButton(text='🔙 Назад')]], resize_keyboard=True)
+class BookingsPage(CallbackData, prefix="bk"):
+    # всё нужное для следующей страницы: направление, ключ (booking_time, id) и фильтры
+    go: str       # 'n' — вперёд, 'p' — назад
+    ts: int       # booking_time ключа, time_code
+    id: int
+    st: str = ""  # статус
+    day: int = 0  # дата, day_code
+    drv: int = 0  # водитель
+
+
+def bookings_page_kb(first, last, has_prev, has_next, st="", day=0, drv=0):
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(
+            text="⬅️ Назад",
+            callback_data=BookingsPage(go="p", ts=time_code(first.booking_time), id=first.id,
+                                       st=st, day=day, drv=drv).pack()
+        ))
+    if has_next:
+        buttons.append(InlineKeyboardButton(
+            text="Вперёд ➡️",
+            callback_data=BookingsPage(go="n", ts=time_code(last.booking_time), id=last.id,
+                                       st=st, day=day, drv=drv).pack()
+        ))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
@@ -0,0 +1,871 @@
+"""
+Нагрузочный тест: диспетчер из bot.py против локальной подделки Telegram Bot API.
+
+    python loadtest.py --users 200 --drivers 3
+
+Поддельный сервер (aiohttp) отдаёт апдейты через getUpdates и записывает
+sendMessage/editMessageText. N виртуальных пользователей одновременно проходят
+весь сценарий: инвайт → дата → время начала → окончание → заметка → подтверждение.
+С --flooders параллельно работают пользователи, засыпающие бота апдейтами:
+сравнение с --no-throttle показывает, как шквал влияет на задержки остальных.
+Сценарий webhook — тот же сценарий брони, но апдейты приходят POST-запросами в
+aiohttp-приложение create_webhook_app() из bot.py, а не через getUpdates.
+В сценарии booking-race все пользователи одновременно подтверждают один и тот же
+интервал: броней должно получиться ровно столько, сколько водителей, а отчёт
+показывает пропускную способность подтверждений под конкуренцией за блокировку записи.
+Сценарий export заполняет базу --rows синтетическими бронями (половина — в архиве)
+и замеряет /export администратора: время, размер файла и память
+(с --tracemalloc пик считается только за время выгрузки).
+Сценарий import отправляет администратором /import и CSV-файл из --rows броней
+(каждая десятая пересекается с предыдущей того же водителя) и замеряет загрузку,
+проверку и вставку одной пачкой через db.add_bookings.
+Сценарий cleanup заполняет базу так же, как export, и замеряет /cleanup:
+подсчёт (dry run) и удаление пачками по политике хранения CLEANUP_POLICY.
+Сценарий stats заполняет базу годом броней (каждые два часа у каждого из --drivers
+водителей, половина — в архиве) и замеряет /stats за год: первый отчёт со счётом
+и сохранением счётчиков прошедших дней, повторный и после отмены одной брони.
+Сценарий fsm не запускает бота: он замеряет set/get FSM-хранилища SQLiteStorage
+против MemoryStorage на тех же операциях, что делает сценарий брони.
+С --sync-db каждый вызов SQLite блокирует цикл событий до своего завершения, как
+синхронный слой данных до перехода на aiosqlite: это базовая линия для сравнения.
+В конце печатаются пропускная способность, перцентили задержек, число SQL-запросов
+и память. База и FSM создаются во временном каталоге, bookings.db не трогается.
+"""
+import argparse
+import asyncio
+import csv
+import io
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta
+
+from aiohttp import ClientSession, web
+
+TOKEN = "123456:loadtest"
+STEP_TIMEOUT = 30
+ADMIN_UID = 1_000_000_000
+FSM_ROUNDS = 10
+CLEANUP_POLICY = {"canceled": 30, "completed": 30}
+CLIENTS = 100
+STATS_DAYS = 365
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+
+class FakeBotAPI:
+    """Минимальный Bot API: очередь апдейтов для getUpdates и журнал ответов бота по чатам."""
+
+    def __init__(self):
+        self.updates = []
+        self.replies = defaultdict(asyncio.Queue)
+        self.calls = Counter()
+        self.bytes_in = 0
+        self._update_id = 0
+        self._message_id = 0
+        self._new_updates = asyncio.Event()
+        self._webhook = None
+        self._posts = set()
+        self.webhook_latencies = []
+        self.files = {}
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+        self.app.router.add_get("/file/bot{token}/{path}", self.download)
+
+    def push(self, update):
+        self._update_id += 1
+        if self._webhook is not None:
+            post = asyncio.create_task(self._post({"update_id": self._update_id, **update}))
+            self._posts.add(post)
+            post.add_done_callback(self._posts.discard)
+            return
+        self.updates.append({"update_id": self._update_id, **update})
+        self._new_updates.set()
+
+    def deliver_to(self, url, secret):
+        """Апдейты уходят POST-запросами на вебхук бота вместо очереди getUpdates."""
+        self._webhook = (ClientSession(), url, {"X-Telegram-Bot-Api-Secret-Token": secret})
+
+    async def _post(self, update):
+        session, url, headers = self._webhook
+        started = time.perf_counter()
+        async with session.post(url, json=update, headers=headers) as response:
+            response.raise_for_status()
+        self.webhook_latencies.append(time.perf_counter() - started)
+
+    async def close(self):
+        if self._webhook is not None:
+            await self._webhook[0].close()
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        if method == "sendDocument":
+            data = await self._read_multipart(request)
+        else:
+            data = dict(await request.post())
+        self.calls[method] += 1
+        self.bytes_in += request.content_length or data.get("document_size", 0)
+        if method == "getUpdates":
+            result = await self._get_updates(data)
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Load test", "username": "loadtest_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(data)
+            self._record(method, result)
+        elif method == "sendDocument":
+            result = self._message(data)
+            result["document"] = {
+                "file_id": "loadtest", "file_unique_id": "loadtest",
+                "file_name": data["document_name"], "file_size": data["document_size"]
+            }
+            self._record(method, result)
+        elif method == "getFile":
+            file_id = data["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id,
+                      "file_size": len(self.files[file_id]), "file_path": file_id}
+        elif method == "answerCallbackQuery" and data.get("text"):
+            # всплывающее предупреждение — тоже ответ пользователю
+            result = True
+            self._record(method, {"chat": None, "text": data["text"]}, data["callback_query_id"])
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def download(self, request):
+        return web.Response(body=self.files[request.match_info["path"]])
+
+    @staticmethod
+    async def _read_multipart(request):
+        """Поля формы; файл не держим в памяти, только считаем его байты."""
+        data = {}
+        async for part in await request.multipart():
+            if part.filename:
+                size = 0
+                while chunk := await part.read_chunk():
+                    size += len(chunk)
+                data["document_name"], data["document_size"] = part.filename, size
+            else:
+                data[part.name] = await part.text()
+        return data
+
+    async def _get_updates(self, data):
+        offset = int(data.get("offset", 0))
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), min(float(data.get("timeout", 0)), 1.0))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+    def _message(self, data):
+        if "message_id" in data:
+            message_id = int(data["message_id"])
+        else:
+            self._message_id += 1
+            message_id = self._message_id
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(data["chat_id"]), "type": "private"},
+            "text": data.get("text") or data.get("caption", "")
+        }
+        markup = json.loads(data.get("reply_markup") or "{}")
+        if "inline_keyboard" in markup:
+            message["reply_markup"] = markup
+        return message
+
+    def _record(self, method, message, callback_id=None):
+        # ответ на callback адресуем по id запроса: в нём закодирован чат пользователя
+        chat_id = message["chat"]["id"] if message["chat"] else int(callback_id.split(":")[0])
+        self.replies[chat_id].put_nowait((method, message))
+
+
+class VirtualUser:
+    def __init__(self, api, uid, invite, rng):
+        self.api = api
+        self.uid = uid
+        self.invite = invite
+        self.rng = rng
+        self.latencies = []
+        self.message = None
+        self.booked = False
+        self.conflicts = 0
+        self._callbacks = 0
+
+    def _sender(self):
+        return {"id": self.uid, "is_bot": False, "first_name": f"User {self.uid}"}
+
+    async def _step(self, update):
+        queue = self.api.replies[self.uid]
+        started = time.perf_counter()
+        self.api.push(update)
+        method, message = await asyncio.wait_for(queue.get(), STEP_TIMEOUT)
+        self.latencies.append(time.perf_counter() - started)
+        if method != "answerCallbackQuery":
+            self.message = message
+        return method, message
+
+    def _message_update(self, text):
+        return {"message": {
+            "message_id": self.rng.randrange(1, 1 << 30),
+            "date": int(time.time()),
+            "chat": {"id": self.uid, "type": "private"},
+            "from": self._sender(),
+            "text": text
+        }}
+
+    def _callback_update(self, callback_data):
+        self._callbacks += 1
+        return {"callback_query": {
+            "id": f"{self.uid}:{self._callbacks}",
+            "chat_instance": str(self.uid),
+            "from": self._sender(),
+            "data": callback_data,
+            "message": {k: self.message[k] for k in ("message_id", "date", "chat", "text")}
+        }}
+
+    async def send(self, text):
+        return await self._step(self._message_update(text))
+
+    async def click(self, callback_data):
+        return await self._step(self._callback_update(callback_data))
+
+    def buttons(self, act):
+        markup = self.message.get("reply_markup", {"inline_keyboard": []})
+        return [
+            b["callback_data"] for row in markup["inline_keyboard"] for b in row
+            if b.get("callback_data", "").split(":")[1:2] == [act]
+        ]
+
+    async def run(self, today_code, delay=0.0, attempts=5):
+        await asyncio.sleep(delay)
+        await self.send("/start")
+        await self.send(self.invite)
+        await self.send("📅 Показать календарь")
+        dates = [d for d in self.buttons("d") if int(d.split(":")[2]) > today_code]
+        await self.click(self.rng.choice(dates))
+
+        for _ in range(attempts):
+            starts = self.buttons("s")
+            if not starts:
+                return
+            method, _ = await self.click(self.rng.choice(starts))
+            if method == "answerCallbackQuery":
+                continue
+            await self.click(self.rng.choice(self.buttons("e")[:4]))
+            await self.click(self.buttons("n")[0])
+            await self.send(f"Заметка от {self.uid}")
+            await self.click(self.buttons("ok")[0])
+            if self.message["text"].startswith("✅"):
+                self.booked = True
+                return
+            # интервал успели занять — бот сразу показывает оставшееся время
+            self.conflicts += 1
+
+    async def redeem(self, code, go):
+        """Вводит общий на всех код одновременно с остальными."""
+        await self.send("/start")
+        await go.wait()
+        _, message = await self.send(code)
+        self.booked = message["text"].startswith("✅")
+
+    async def register(self):
+        await self.send("/start")
+        await self.send(self.invite)
+
+    async def race(self, callback_data):
+        """Подтверждает общий на всех интервал одновременно с остальными."""
+        _, message = await self.click(callback_data)
+        self.booked = message["text"].startswith("✅")
+        if not self.booked:
+            self.conflicts += 1
+
+    async def export(self, command):
+        """Команда выгрузки; ответ ждём без STEP_TIMEOUT — большой файл пишется долго."""
+        started = time.perf_counter()
+        self.api.push(self._message_update(command))
+        method, self.message = await self.api.replies[self.uid].get()
+        self.latencies.append(time.perf_counter() - started)
+        return method, self.message
+
+    async def upload(self, name, content):
+        """/import и файл следом; ответ на файл ждём без STEP_TIMEOUT, как у выгрузки."""
+        await self.send("/import")
+        self.api.files[name] = content
+        update = self._message_update(None)
+        del update["message"]["text"]
+        update["message"]["document"] = {"file_id": name, "file_unique_id": name,
+                                         "file_name": name, "file_size": len(content)}
+        started = time.perf_counter()
+        self.api.push(update)
+        method, self.message = await self.api.replies[self.uid].get()
+        self.latencies.append(time.perf_counter() - started)
+        return method, self.message
+
+    async def flood(self, rate, stop):
+        """Шлёт апдейты с частотой rate, не дожидаясь ответов, пока не выставлен stop."""
+        await self.send("/start")
+        await self.send(self.invite)
+        await self.send("📅 Показать календарь")
+        dates = self.buttons("d")
+        # разные тексты и даты по кругу, чтобы срабатывал лимит, а не склейка дублей
+        texts = ("📅 Показать календарь", "📝 Мои бронирования")
+        sent = 0
+        while not stop.is_set():
+            if sent % 3 < 2:
+                self.api.push(self._message_update(texts[sent % 3]))
+            else:
+                self.api.push(self._callback_update(dates[sent % len(dates)]))
+            sent += 1
+            await asyncio.sleep(1 / rate)
+        return sent
+
+
+class TimingMiddleware:
+    """Время обработки апдейта диспетчером, включая сессию БД."""
+
+    def __init__(self):
+        self.samples = []
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.samples.append(time.perf_counter() - started)
+
+
+def block_loop_on_sqlite():
+    """
+    Каждый вызов aiosqlite ждёт результата, не отдавая управление циклу событий:
+    запросы по-прежнему выполняются в потоке соединения, но цикл в это время
+    стоит — так работали обработчики поверх синхронной сессии SQLAlchemy.
+    """
+    from aiosqlite.core import Connection
+
+    async def _execute(self, fn, *args, **kwargs):
+        if not self._running or not self._connection:
+            raise ValueError("Connection closed")
+        done, outcome = threading.Event(), {}
+
+        def call():
+            try:
+                outcome["result"] = fn(*args, **kwargs)
+            except BaseException as e:
+                outcome["error"] = e
+            finally:
+                done.set()
+
+        self._tx.put_nowait((None, call))
+        done.wait()
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["result"]
+
+    Connection._execute = _execute
+
+
+async def seed_clients(db):
+    """CLIENTS пользователей с tg_id 2_000_000_001 и далее, id по порядку с 1."""
+    from database import User
+
+    async with db.write_engine.begin() as conn:
+        await conn.execute(User.__table__.insert(), [
+            {"tg_id": 2_000_000_000 + i, "name": f"Клиент {i}", "username": f"client{i}"}
+            for i in range(1, CLIENTS + 1)
+        ])
+
+
+async def seed_bookings(db, rows, drivers, chunk_size=10000):
+    """rows синтетических броней по drivers водителям: первая половина — в архиве."""
+    from database import ArchivedBooking, Booking
+
+    await seed_clients(db)
+    origin = datetime.combine(date.today(), datetime.min.time()) - timedelta(hours=2 * rows // drivers)
+    for first in range(0, rows, chunk_size):
+        batch = {ArchivedBooking: [], Booking: []}
+        for i in range(first, min(first + chunk_size, rows)):
+            start = origin + timedelta(hours=2 * (i // drivers))
+            archived = i < rows // 2
+            batch[ArchivedBooking if archived else Booking].append({
+                "id": i + 1, "driver_id": i % drivers + 1, "user_id": i % CLIENTS + 1,
+                "booking_time": start, "end_time": start + timedelta(hours=1),
+                "notes": f"Синтетическая бронь {i}" if i % 3 else None,
+                "status": ("completed", "canceled")[i % 5 == 0] if archived else "completed"
+            })
+        async with db.write_engine.begin() as conn:
+            for model, values in batch.items():
+                if values:
+                    await conn.execute(model.__table__.insert(), values)
+
+
+def import_csv(rows, drivers):
+    """
+    CSV для /import: rows будущих броней водителей «Водитель N» по два часа подряд,
+    каждая седьмая отменена. Каждая десятая строка повторяет время предыдущей брони
+    того же водителя; возвращает (байты файла, сколько строк должны дать пересечение).
+    """
+    origin = datetime.combine(date.today() + timedelta(days=1), datetime.min.time())
+    file = io.StringIO()
+    writer = csv.writer(file)
+    writer.writerow(["booking_time", "end_time", "driver", "tg_id", "notes", "status"])
+    taken, conflicts = defaultdict(set), 0
+    for i in range(rows):
+        driver, slot = i % drivers + 1, i // drivers
+        if i % 10 == 9:
+            slot -= 1
+        status = "canceled" if i % 7 == 0 else "active"
+        if status == "active":
+            conflicts += slot in taken[driver]
+            taken[driver].add(slot)
+        start = origin + timedelta(hours=2 * slot)
+        writer.writerow([start.isoformat(" "), (start + timedelta(hours=1)).isoformat(" "),
+                         f"Водитель {driver}", 2_000_000_000 + i % CLIENTS + 1,
+                         f"Импорт {i}" if i % 3 else "", status])
+    return file.getvalue().encode(), conflicts
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    if args.sync_db:
+        block_loop_on_sqlite()
+    api = FakeBotAPI()
+    runner = web.AppRunner(api.app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    # импорт после настройки окружения: config читает его при загрузке
+    from aiogram.client.telegram import TelegramAPIServer
+    from sqlalchemy import event
+    import bot as bot_module
+    from config import bot, dp
+    from database import db, Invite
+    from keyboards import BookingFlow, day_code
+
+    bot.session.api = TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")
+    timing = TimingMiddleware()
+    dp.update.outer_middleware(timing)
+    bot_module.setup_dispatcher()
+
+    queries = Counter()
+    for name, engine in (("read", db.engine), ("write", db.write_engine)):
+        event.listen(engine.sync_engine, "before_cursor_execute",
+                     lambda *a, kind=name: queries.update((kind,)))
+
+    await db.init()
+    for i in range(args.drivers - len(await db.get_all_drivers())):
+        await db.add_driver(f"Водитель {i + 1}")
+    async with db.WriteSession() as session:
+        session.add_all(Invite(code=f"lt-{uid}") for uid in range(1, args.users + args.flooders + 1))
+        session.add(Invite(code="lt-race"))
+        await session.commit()
+    if args.scenario == "export":
+        await seed_bookings(db, args.rows, args.drivers)
+    elif args.scenario == "import":
+        await seed_clients(db)
+        upload, expected_conflicts = import_csv(args.rows, args.drivers)
+    queries.clear()
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    if args.scenario == "webhook":
+        from config import WEBHOOK_PATH, WEBHOOK_SECRET
+        webhook = web.AppRunner(bot_module.create_webhook_app(), access_log=None)
+        await webhook.setup()  # здесь же срабатывает startup диспетчера
+        webhook_site = web.TCPSite(webhook, "127.0.0.1", 0)
+        await webhook_site.start()
+        webhook_port = webhook_site._server.sockets[0].getsockname()[1]
+        api.deliver_to(f"http://127.0.0.1:{webhook_port}{WEBHOOK_PATH}", WEBHOOK_SECRET)
+    else:
+        polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=1))
+
+    users = [VirtualUser(api, uid, f"lt-{uid}", random.Random(rng.random())) for uid in range(1, args.users + 1)]
+    admin = VirtualUser(api, ADMIN_UID, None, random.Random(rng.random()))
+    if args.scenario in ("export", "import"):
+        users = []
+    flooders = [
+        VirtualUser(api, uid, f"lt-{uid}", random.Random(rng.random()))
+        for uid in range(args.users + 1, args.users + args.flooders + 1)
+    ]
+    stop_flood = asyncio.Event()
+    flooding = [asyncio.create_task(f.flood(args.flood_rate, stop_flood)) for f in flooders]
+    if flooders:
+        await asyncio.sleep(1)  # обычные пользователи приходят, когда шквал уже идёт
+
+    today = day_code(date.today())
+    if args.scenario in ("export", "import"):
+        await api.replies[ADMIN_UID].get()  # «Бот запущен» администратору
+    started = time.perf_counter()
+    if args.scenario == "invite-race":
+        # все вводят один и тот же код: зарегистрироваться должен ровно один
+        race_start = asyncio.Event()
+        asyncio.get_running_loop().call_later(0.5, race_start.set)
+        jobs = [u.redeem("lt-race", race_start) for u in users]
+    elif args.scenario == "booking-race":
+        # все регистрируются, затем разом подтверждают один интервал завтра:
+        # бронь получает по одному пользователю на водителя
+        await asyncio.gather(*(u.register() for u in users))
+        timing.samples.clear()
+        queries.clear()
+        started = time.perf_counter()
+        slot = BookingFlow(act="ok", day=today + 1, start=4, end=6).pack()
+        jobs = [u.race(slot) for u in users]
+    elif args.scenario == "export":
+        jobs = [admin.export(f"/export {args.export_format}")]
+    elif args.scenario == "import":
+        jobs = [admin.upload("bookings.csv", upload)]
+    else:
+        jobs = [u.run(today, delay=args.ramp * i / len(users)) for i, u in enumerate(users)]
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    stop_flood.set()
+    flood_sent = sum(await asyncio.gather(*flooding))
+
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    document = admin.message.get("document") if admin.message else None
+    if args.scenario == "webhook":
+        await api.close()
+        await webhook.cleanup()
+    else:
+        await dp.stop_polling()
+        await polling
+    await runner.cleanup()
+
+    errors = [r for r in results if isinstance(r, Exception)]
+    booked = sum(u.booked for u in users)
+    steps = [s for u in users for s in u.latencies]
+    # подтверждение — последний шаг каждого участника гонки
+    confirms = [u.latencies[-1] for u in users if u.latencies] if args.scenario == "booking-race" else []
+    report = {
+        "scenario": args.scenario,
+        "profile": args.profile,
+        "sync_db": args.sync_db,
+        "users": len(users),
+        "drivers": args.drivers,
+        "elapsed_s": round(elapsed, 3),
+        "bookings": booked,
+        "not_booked": args.users - booked - len(errors),
+        "errors": len(errors),
+        "conflicts": sum(u.conflicts for u in users),
+        "updates": len(timing.samples),
+        "updates_per_s": round(len(timing.samples) / elapsed, 1),
+        "bookings_per_s": round(booked / elapsed, 1),
+        "handler_ms": {f"p{p}": round(percentile(timing.samples, p) * 1000, 2) for p in (50, 95, 99)},
+        "step_ms": {f"p{p}": round(percentile(steps, p) * 1000, 2) for p in (50, 95, 99)},
+        "sql": {
+            "read": queries["read"],
+            "write": queries["write"],
+            "per_update": round(sum(queries.values()) / max(len(timing.samples), 1), 2),
+            "per_booking": round(sum(queries.values()) / max(booked, 1), 1)
+        },
+        "api_calls": dict(api.calls),
+        "api_bytes_per_booking": api.bytes_in // max(booked, 1),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "traced_peak_mb": round(traced_peak / 2 ** 20, 1) if traced_peak is not None else None,
+        "webhook": {
+            "posts": len(api.webhook_latencies),
+            "post_ms": {f"p{p}": round(percentile(api.webhook_latencies, p) * 1000, 2) for p in (50, 95, 99)}
+        } if api.webhook_latencies else None,
+        "race": {
+            "confirmations": len(confirms),
+            # все подтверждения уходят разом, поэтому их длительность — самое долгое из них
+            "confirmations_per_s": round(len(confirms) / max(confirms), 1),
+            "confirm_ms": {f"p{p}": round(percentile(confirms, p) * 1000, 2) for p in (50, 95, 99)}
+        } if confirms else None,
+        "export": {
+            "rows": args.rows,
+            "caption": admin.message["text"],
+            "file": document["file_name"],
+            "file_mb": round(document["file_size"] / 2 ** 20, 1),
+            "rows_per_s": round(args.rows / elapsed)
+        } if document else None,
+        "import": {
+            "rows": args.rows,
+            "file_mb": round(len(upload) / 2 ** 20, 1),
+            "reply": admin.message["text"],
+            "expected_conflicts": expected_conflicts,
+            # ответ на файл: скачивание, разбор, проверка и вставка
+            "elapsed_s": round(admin.latencies[-1], 3),
+            "rows_per_s": round(args.rows / admin.latencies[-1])
+        } if args.scenario == "import" and admin.latencies else None,
+        "flood": {
+            "flooders": args.flooders,
+            "sent": flood_sent,
+            "throttled": bot_module.throttling.throttled,
+            "duplicates": bot_module.throttling.duplicates
+        }
+    }
+    for e in errors[:3]:
+        print(f"ошибка пользователя: {e!r}", file=sys.stderr)
+    return report
+
+
+async def bench_fsm(args):
+    """Задержки set/get FSM: --users сценариев параллельно, у каждого FSM_ROUNDS проходов, и чтение с диска."""
+    from aiogram.fsm.storage.base import StorageKey
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from config import FSM_TTL
+    from storage import SQLiteStorage
+
+    async def flow(storage, uid, timings):
+        key = StorageKey(bot_id=1, chat_id=uid, user_id=uid)
+
+        async def timed(kind, call):
+            started = time.perf_counter()
+            result = await call
+            timings[kind].append(time.perf_counter() - started)
+            return result
+
+        for i in range(FSM_ROUNDS):
+            # как в сценарии брони: заметка, её текст, подтверждение и очистка
+            await timed("set", storage.set_state(key, "BookingStates:ADDING_NOTES"))
+            await timed("set", storage.set_data(key, {
+                "booking": [739000 + i, 4, 6], "message_id": uid, "at": datetime.now()
+            }))
+            await timed("get", storage.get_state(key))
+            data = await timed("get", storage.get_data(key))
+            await timed("set", storage.set_data(key, {**data, "notes": f"Заметка {uid}"}))
+            await timed("get", storage.get_data(key))
+            await timed("set", storage.set_state(key, None))
+            await timed("set", storage.set_data(key, {}))
+
+    report = {"scenario": "fsm", "users": args.users, "rounds": FSM_ROUNDS, "storages": {}}
+    for name, storage in (("memory", MemoryStorage()), ("sqlite", SQLiteStorage("fsm-bench.db", ttl=FSM_TTL))):
+        timings = defaultdict(list)
+        started = time.perf_counter()
+        await asyncio.gather(*(flow(storage, uid, timings) for uid in range(1, args.users + 1)))
+        # чтение после сброса на диск: буфер записей уже пуст, SQLiteStorage идёт в базу
+        keys = [StorageKey(bot_id=1, chat_id=uid, user_id=uid) for uid in range(1, args.users + 1)]
+        for key in keys:
+            await storage.set_data(key, {"booking": [739000, 4, 6], "message_id": key.user_id})
+        if isinstance(storage, SQLiteStorage):
+            await storage.flush()
+        for key in keys:
+            started_get = time.perf_counter()
+            await storage.get_data(key)
+            timings["cold_get"].append(time.perf_counter() - started_get)
+        await storage.close()
+        elapsed = time.perf_counter() - started
+        report["storages"][name] = {
+            "elapsed_s": round(elapsed, 3),
+            "ops_per_s": round(sum(map(len, timings.values())) / elapsed),
+            **{f"{kind}_us": {f"p{p}": round(percentile(samples, p) * 1e6, 1) for p in (50, 99)}
+               for kind, samples in timings.items()}
+        }
+    return report
+
+
+async def bench_cleanup(args):
+    """apply_retention по --rows синтетическим броням: сначала dry run, затем удаление."""
+    from database import db
+
+    await db.init()
+    started = time.perf_counter()
+    await seed_bookings(db, args.rows, args.drivers)
+    report = {"scenario": "cleanup", "rows": args.rows, "policy": CLEANUP_POLICY,
+              "seed_s": round(time.perf_counter() - started, 2)}
+    for phase, dry_run in (("dry_run", True), ("purge", False)):
+        started = time.perf_counter()
+        counts = await db.apply_retention(CLEANUP_POLICY, dry_run=dry_run)
+        elapsed = time.perf_counter() - started
+        report[phase] = {"counts": counts, "elapsed_s": round(elapsed, 2),
+                         "rows_per_s": round(sum(counts.values()) / elapsed)}
+    report["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    await db.close()
+    return report
+
+
+def print_cleanup_report(r):
+    print(f"Очистка {r['rows']} броней (заполнение {r['seed_s']} с), политика: "
+          + ", ".join(f"{status} старше {days} дн." for status, days in r["policy"].items()))
+    for phase, title in (("dry_run", "Подсчёт"), ("purge", "Удаление")):
+        p = r[phase]
+        print(f"{title}: {p['elapsed_s']} с, {p['rows_per_s']} строк/с, "
+              + ", ".join(f"{status}={count}" for status, count in p["counts"].items()))
+    print(f"Память: maxrss {r['max_rss_mb']} МБ")
+
+
+async def bench_stats(args):
+    """get_utilization за STATS_DAYS дней плотных броней: с пустыми счётчиками, с готовыми и после отмены."""
+    from sqlalchemy import func, select
+    from database import Booking, DailyStats, db
+
+    await db.init()
+    rows = STATS_DAYS * 12 * args.drivers  # бронь каждые два часа у каждого водителя
+    started = time.perf_counter()
+    await db.add_drivers([{"name": f"Водитель {i + 1}"} for i in range(args.drivers)])
+    await seed_bookings(db, rows, args.drivers)
+    report = {"scenario": "stats", "days": STATS_DAYS, "drivers": args.drivers, "rows": rows,
+              "seed_s": round(time.perf_counter() - started, 2)}
+
+    today = date.today()
+    first_day = today - timedelta(days=STATS_DAYS - 1)
+    async with db.Session() as session:
+        # свежая бронь из рабочей таблицы: её отмена сбрасывает счётчики одного дня
+        touched = await session.scalar(
+            select(Booking.id).filter(Booking.booking_time < datetime.combine(today, datetime.min.time()))
+            .order_by(Booking.id.desc()).limit(1)
+        )
+    for phase in ("cold", "warm", "touched"):
+        if phase == "touched":
+            await db.cancel_booking(touched)
+        started = time.perf_counter()
+        stats = await db.get_utilization(first_day, today)
+        report[phase] = {"elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+                         "starts": int(stats["starts"].sum())}
+    async with db.Session() as session:
+        report["stored_rows"] = await session.scalar(select(func.count()).select_from(DailyStats))
+    report["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    await db.close()
+    return report
+
+
+def print_stats_report(r):
+    print(f"/stats за {r['days']} дн.: {r['rows']} броней у {r['drivers']} водителей (заполнение {r['seed_s']} с), "
+          f"сохранено дневных счётчиков: {r['stored_rows']}")
+    for phase, title in (("cold", "Первый отчёт"), ("warm", "Повторный"), ("touched", "После отмены брони")):
+        print(f"{title}: {r[phase]['elapsed_ms']} мс, броней в отчёте {r[phase]['starts']}")
+    print(f"Память: maxrss {r['max_rss_mb']} МБ")
+
+
+def print_fsm_report(r):
+    print(f"FSM: {r['users']} сценариев параллельно по {r['rounds']} проходов")
+    for name, s in r["storages"].items():
+        print(f"{name:>7}: {s['ops_per_s']} операций/с, set мкс p50={s['set_us']['p50']} p99={s['set_us']['p99']}, "
+              f"get мкс p50={s['get_us']['p50']} p99={s['get_us']['p99']}, "
+              f"get после сброса мкс p50={s['cold_get_us']['p50']} p99={s['cold_get_us']['p99']}")
+
+
+def print_report(r):
+    print(f"Пользователей: {r['users']}, водителей: {r['drivers']}, профиль SQLite: {r['profile']}"
+          f"{' (синхронные запросы)' if r['sync_db'] else ''}, время: {r['elapsed_s']} с")
+    if r["scenario"] == "invite-race":
+        print(f"Один инвайт-код на всех: зарегистрировано {r['bookings']} из {r['users']} "
+              f"(ожидается 1), ошибок: {r['errors']}")
+    elif r["scenario"] == "booking-race":
+        c = r["race"] or {"confirmations": 0, "confirmations_per_s": 0, "confirm_ms": {"p50": 0, "p99": 0}}
+        print(f"Один интервал на всех: бронирований {r['bookings']} из {r['users']} "
+              f"(ожидается {min(r['drivers'], r['users'])}), отказов: {r['conflicts']}, ошибок: {r['errors']}")
+        print(f"Подтверждений: {c['confirmations']} ({c['confirmations_per_s']}/с), "
+              f"мс: p50={c['confirm_ms']['p50']} p99={c['confirm_ms']['p99']}")
+    elif r["scenario"] == "export":
+        e = r["export"]
+        if e is None:
+            print(f"Выгрузка не получена, ошибок: {r['errors']}")
+        else:
+            print(f"Выгрузка {e['rows']} строк: {e['file']}, {e['file_mb']} МБ, "
+                  f"{e['rows_per_s']} строк/с ({e['caption']})")
+    elif r["scenario"] == "import":
+        i = r["import"]
+        if i is None:
+            print(f"Импорт не выполнен, ошибок: {r['errors']}")
+        else:
+            reply = i["reply"].replace("\n", "; ")
+            print(f"Импорт {i['rows']} строк ({i['file_mb']} МБ): {i['elapsed_s']} с, {i['rows_per_s']} строк/с")
+            print(f"Ответ бота: {reply} (ожидается пересечений: {i['expected_conflicts']})")
+    else:
+        print(f"Бронирований: {r['bookings']} (без брони: {r['not_booked']}, ошибок: {r['errors']}, "
+              f"конфликтов при подтверждении: {r['conflicts']})")
+    print(f"Апдейтов: {r['updates']} ({r['updates_per_s']}/с), бронирований в секунду: {r['bookings_per_s']}")
+    if r["webhook"]:
+        w = r["webhook"]["post_ms"]
+        print(f"POST на вебхук: {r['webhook']['posts']}, ответ, мс: p50={w['p50']} p95={w['p95']} p99={w['p99']}")
+    h, s = r["handler_ms"], r["step_ms"]
+    print(f"Обработка апдейта, мс: p50={h['p50']} p95={h['p95']} p99={h['p99']}")
+    print(f"Шаг пользователя (от апдейта до ответа бота), мс: p50={s['p50']} p95={s['p95']} p99={s['p99']}")
+    q = r["sql"]
+    print(f"SQL: чтений {q['read']}, записей {q['write']}, "
+          f"на апдейт {q['per_update']}, на бронирование {q['per_booking']}")
+    print("Bot API: " + ", ".join(f"{m}={n}" for m, n in sorted(r["api_calls"].items())) +
+          f"; байт на бронирование: {r['api_bytes_per_booking']}")
+    memory = f"Память: maxrss {r['max_rss_mb']} МБ"
+    if r["traced_peak_mb"] is not None:
+        memory += f", пик tracemalloc {r['traced_peak_mb']} МБ"
+    print(memory)
+    f = r["flood"]
+    if f["flooders"] or f["throttled"] or f["duplicates"]:
+        print(f"Шквал: {f['flooders']} польз. отправили {f['sent']} апдейтов; "
+              f"отброшено по лимиту {f['throttled']}, склеено дублей {f['duplicates']}")
+
+
+# сценарии без бота и поддельного Bot API: замеры отдельных частей
+BENCHMARKS = {
+    "fsm": (bench_fsm, print_fsm_report),
+    "cleanup": (bench_cleanup, print_cleanup_report),
+    "stats": (bench_stats, print_stats_report),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с поддельным Bot API")
+    parser.add_argument("--users", type=int, default=100, help="число одновременных пользователей")
+    parser.add_argument("--drivers", type=int, default=3, help="число водителей")
+    parser.add_argument("--ramp", type=float, default=0.0,
+                        help="за сколько секунд подключаются все пользователи (0 — сразу все)")
+    parser.add_argument("--scenario", choices=("booking", "webhook", "invite-race", "booking-race", "export", "import",
+                                                 *BENCHMARKS),
+                        default="booking",
+                        help="booking — весь сценарий брони; webhook — он же через вебхук; "
+                             "invite-race — все вводят один код одновременно; "
+                             "booking-race — все подтверждают один интервал одновременно; "
+                             "export — /export администратора по --rows броням; "
+                             "import — /import CSV-файла из --rows броней; "
+                             "cleanup — /cleanup по --rows броням; stats — /stats за год броней; fsm — set/get FSM-хранилищ без бота")
+    parser.add_argument("--rows", type=int, default=100000, help="сколько броней для export, import и cleanup")
+    parser.add_argument("--export-format", choices=("csv", "jsonl"), default="csv", help="формат для export")
+    parser.add_argument("--flooders", type=int, default=0,
+                        help="пользователи, которые шлют апдейты без остановки параллельно с остальными")
+    parser.add_argument("--flood-rate", type=float, default=100, help="апдейтов в секунду от каждого из них")
+    parser.add_argument("--no-throttle", action="store_true", help="выключить ограничение частоты апдейтов")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--fsm", choices=("sqlite", "memory"), default="sqlite", help="FSM-хранилище")
+    parser.add_argument("--profile", choices=("tuned", "default"), default="tuned",
+                        help="профиль PRAGMA SQLite (SQLITE_PROFILE): сравнение чтений и записей под нагрузкой")
+    parser.add_argument("--sync-db", action="store_true",
+                        help="блокировать цикл событий на каждом запросе SQLite — базовая линия «до» aiosqlite")
+    parser.add_argument("--tracemalloc", action="store_true", help="считать пик памяти Python (медленнее)")
+    parser.add_argument("--json", action="store_true", help="вывести отчёт в JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    os.environ.update(
+        TELEGRAM_BOT_TOKEN=TOKEN, ADMIN_ID=str(ADMIN_UID) if args.scenario in ("export", "import") else "",
+        RUN_MODE="webhook" if args.scenario == "webhook" else "polling",
+        WEBHOOK_URL="http://127.0.0.1", WEBHOOK_SECRET="loadtest",
+        FSM_STORAGE=args.fsm, FSM_DB_PATH=os.path.join(workdir, "fsm.db"),
+        SQLITE_PROFILE=args.profile
+    )
+    if args.no_throttle:
+        os.environ["THROTTLE_RATE"] = "0"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)  # bookings.db создаётся относительно рабочего каталога
+
+    if args.scenario in BENCHMARKS:
+        bench, print_bench = BENCHMARKS[args.scenario]
+        report = asyncio.run(bench(args))
+    else:
+        report, print_bench = asyncio.run(run(args)), print_report
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_bench(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import logging
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject
+from aiohttp import web
+from sqlalchemy import event
+
+from config import SLOW_UPDATE_MS
+
+# Границы корзин гистограмм, секунды и штуки
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus с одной необязательной меткой."""
+
+    def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        # значение метки -> [счётчики корзин..., +Inf, сумма]
+        self._series = {}
+
+    def observe(self, value, label_value=""):
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_value, series in sorted(self._series.items()):
+            labels = f'{self.label}="{label_value}",' if self.label else ""
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                lines.append(f'{self.name}_bucket{{{labels}le="{bound}"}} {total}')
+            suffix = f"{{{labels.rstrip(',')}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{suffix} {total}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._values = {}
+
+    def inc(self, label_value="", amount=1):
+        self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_value, value in sorted(self._values.items()):
+            labels = f'{{{self.label}="{label_value}"}}' if self.label else ""
+            lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+class UpdateStats:
+    """Из чего сложилось время одного апдейта."""
+    __slots__ = ("kind", "handler", "db_queries", "db_time", "api_calls", "api_time")
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.handler = None
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.api_calls = 0
+        self.api_time = 0.0
+
+
+# Статистика апдейта, который сейчас обрабатывается в этой задаче
+current_update: ContextVar[Optional[UpdateStats]] = ContextVar("current_update", default=None)
+
+
+class Metrics:
+    """
+    Метрики бота: время апдейтов и обработчиков, запросы к БД и вызовы Bot API.
+    Отдаются в текстовом формате Prometheus на METRICS_PORT; апдейты дольше
+    slow_update_ms пишутся в лог с разбивкой по БД, Bot API и остальному коду.
+    """
+
+    def __init__(self, slow_update_ms=1000):
+        self.slow_update_ms = slow_update_ms
+        self.update_seconds = Histogram(
+            "bot_update_seconds", "Время обработки апдейта целиком", "type")
+        self.handler_seconds = Histogram(
+            "bot_handler_seconds", "Время работы обработчика", "handler")
+        self.db_query_seconds = Histogram(
+            "bot_db_query_seconds", "Время одного SQL-запроса", "engine")
+        self.update_db_queries = Histogram(
+            "bot_update_db_queries", "SQL-запросов за апдейт", buckets=COUNT_BUCKETS)
+        self.update_db_seconds = Histogram(
+            "bot_update_db_seconds", "Время SQL-запросов за апдейт")
+        self.api_seconds = Histogram(
+            "bot_api_request_seconds", "Время вызова Bot API", "method")
+        self.api_errors = Counter(
+            "bot_api_errors_total", "Ошибки вызовов Bot API", "method")
+        self.slow_updates = Counter(
+            "bot_slow_updates_total", "Апдейты дольше порога медленного лога")
+        self.throttled_updates = Counter(
+            "bot_throttled_updates_total", "Апдейты, отброшенные ограничителем", "reason")
+        self._runner = None
+
+    def render(self):
+        lines = []
+        for metric in (self.update_seconds, self.handler_seconds, self.db_query_seconds,
+                       self.update_db_queries, self.update_db_seconds, self.api_seconds,
+                       self.api_errors, self.slow_updates, self.throttled_updates):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    # ---------- SQLAlchemy ----------
+    def instrument_engine(self, engine, name):
+        """Считает запросы движка; запросы внутри апдейта добавляются в его статистику."""
+        sync_engine = engine.sync_engine
+
+        @event.listens_for(sync_engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+        @event.listens_for(sync_engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info["query_started"].pop()
+            self.db_query_seconds.observe(elapsed, name)
+            stats = current_update.get()
+            if stats is not None:
+                stats.db_queries += 1
+                stats.db_time += elapsed
+
+    # ---------- HTTP ----------
+    async def start_server(self, host, port):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+
+    async def _handle_metrics(self, request):
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    async def stop_server(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    # ---------- медленные апдейты ----------
+    def finish_update(self, stats, elapsed):
+        self.update_seconds.observe(elapsed, stats.kind)
+        self.update_db_queries.observe(stats.db_queries)
+        self.update_db_seconds.observe(stats.db_time)
+        if self.slow_update_ms and elapsed * 1000 >= self.slow_update_ms:
+            self.slow_updates.inc()
+            # в «остальное» входят клавиатуры, FSM и ожидание соединения-писателя
+            other = elapsed - stats.db_time - stats.api_time
+            handler = stats.handler or "без обработчика"
+            logging.warning(
+                f"Медленный апдейт {elapsed * 1000:.0f} мс ({stats.kind} → {handler}): "
+                f"БД {stats.db_queries} запр. / {stats.db_time * 1000:.0f} мс, "
+                f"Bot API {stats.api_calls} выз. / {stats.api_time * 1000:.0f} мс, "
+                f"остальное {other * 1000:.0f} мс"
+            )
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware апдейта: заводит UpdateStats и замеряет апдейт целиком."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        stats = UpdateStats(event.event_type)
+        token = current_update.set(stats)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            current_update.reset(token)
+            self.metrics.finish_update(stats, time.perf_counter() - started)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware: время конкретного обработчика по имени функции."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        name = data["handler"].callback.__name__
+        stats = current_update.get()
+        if stats is not None:
+            stats.handler = name
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.metrics.handler_seconds.observe(time.perf_counter() - started, name)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время каждого вызова Bot API, в том числе из outbox."""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            self.metrics.api_errors.inc(name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.metrics.api_seconds.observe(elapsed, name)
+            stats = current_update.get()
+            if stats is not None:
+                stats.api_calls += 1
+                stats.api_time += elapsed
+
+
+metrics = Metrics(slow_update_ms=SLOW_UPDATE_MS)
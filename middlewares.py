@@ -0,0 +1,126 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+from database import db
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Одна сессия на апдейт: обработчик получает её аргументом session и передаёт
+    в методы чтения Database. Соединение берётся из пула один раз за апдейт,
+    и все чтения видят один и тот же снимок базы. Записи по-прежнему идут
+    через одиночного писателя (Database.WriteSession).
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        async with db.Session() as session:
+            session.info["availability_version"] = db.availability.version
+            data["session"] = session
+            try:
+                result = await handler(event, data)
+            except Exception:
+                await session.rollback()
+                raise
+            await session.commit()
+            return result
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Защита от шквала нажатий. У каждого пользователя свой token bucket: rate
+    апдейтов в секунду с запасом burst. Повтор того же текста или callback_data
+    в пределах duplicate_window склеивается с первым. Лишние апдейты
+    отбрасываются до открытия сессии БД и до обработчиков. На отброшенный
+    callback_query бот всё же отвечает, иначе кнопка у пользователя крутится
+    до таймаута: один answerCallbackQuery без обращения к базе.
+
+    Состояние пользователя — список [токены, время пополнения, последний ключ,
+    время ключа, ограничен ли сейчас] в OrderedDict по давности; записи
+    старше idle_ttl вытесняются.
+    """
+
+    def __init__(self, rate=3.0, burst=10, duplicate_window=1.0, idle_ttl=600, metrics=None):
+        self.rate = rate
+        self.burst = burst
+        self.duplicate_window = duplicate_window
+        self.idle_ttl = idle_ttl
+        self.metrics = metrics
+        self._users = OrderedDict()
+        self.throttled = 0
+        self.duplicates = 0
+
+    @staticmethod
+    def _key(event: Update):
+        if event.message is not None:
+            return event.message.text
+        if event.callback_query is not None:
+            return event.callback_query.data
+        return None
+
+    def _evict(self, now):
+        while self._users:
+            state = next(iter(self._users.values()))
+            if now - state[1] < self.idle_ttl:
+                break
+            self._users.popitem(last=False)
+
+    async def _drop(self, event: Update, reason, notice=None):
+        if reason == "duplicate":
+            self.duplicates += 1
+        else:
+            self.throttled += 1
+        if self.metrics is not None:
+            self.metrics.throttled_updates.inc(reason)
+        if event.callback_query is not None:
+            try:
+                await event.callback_query.answer(notice)
+            except Exception as e:
+                logging.warning(f"Не удалось ответить на отброшенный callback: {e}")
+        return None
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None or not self.rate:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        key = self._key(event)
+        state = self._users.get(user.id)
+        if state is None:
+            state = self._users[user.id] = [self.burst, now, None, 0.0, False]
+        else:
+            self._users.move_to_end(user.id)
+        self._evict(now)
+
+        if key is not None and key == state[2] and now - state[3] < self.duplicate_window:
+            return await self._drop(event, "duplicate")
+
+        tokens = min(self.burst, state[0] + (now - state[1]) * self.rate)
+        state[1] = now
+        if tokens < 1:
+            # предупреждаем один раз за серию, дальше отбрасываем молча
+            notice = None
+            if not state[4]:
+                logging.warning(f"Пользователь {user.id} превысил лимит апдейтов, лишние отбрасываются")
+                notice = "Слишком часто, подождите немного"
+            state[0], state[4] = tokens, True
+            return await self._drop(event, "rate", notice)
+
+        state[0], state[4] = tokens - 1, False
+        state[2], state[3] = key, now
+        return await handler(event, data)
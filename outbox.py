@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
+
+from config import bot, ADMIN_ID
+
+# Лимиты Bot API: ~30 сообщений/с на бота, ~1/с в личный чат, 20/мин в группу
+GLOBAL_RATE = 30
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_RATE = 20 / 60
+MESSAGE_LIMIT = 4096
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Забирает токен и возвращает, сколько секунд нужно подождать до отправки."""
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    @property
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class Outbox:
+    """
+    Очередь исходящих сообщений. Обработчики ставят сообщение в очередь и не
+    ждут Telegram; воркеры отправляют с учётом лимитов и retry_after.
+    Сообщения одного чата обрабатывает один и тот же воркер, поэтому порядок
+    сохраняется. Уведомления админу во время всплеска склеиваются в сводку.
+    """
+
+    def __init__(self, bot, admin_id=None, workers=4, digest_window=5.0, max_retries=3):
+        self.bot = bot
+        self.admin_id = admin_id
+        self.digest_window = digest_window
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.chat_buckets = {}
+        self._queues = [asyncio.Queue() for _ in range(workers)]
+        self._workers = []
+        self._digest = []
+        self._digest_task = None
+        self._last_admin_send = 0.0
+        self.sent = 0
+        self.failed = 0
+
+    async def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    def send(self, chat_id, text, **kwargs):
+        self._queues[hash(chat_id) % len(self._queues)].put_nowait((chat_id, text, kwargs))
+
+    def notify_admin(self, text):
+        if not self.admin_id:
+            return
+        now = time.monotonic()
+        if self._digest_task is None and now - self._last_admin_send >= self.digest_window:
+            self._last_admin_send = now
+            self._send_admin(text)
+            return
+        self._digest.append(text)
+        if self._digest_task is None:
+            delay = self._last_admin_send + self.digest_window - now
+            self._digest_task = asyncio.create_task(self._flush_digest_later(delay))
+
+    async def _flush_digest_later(self, delay):
+        await asyncio.sleep(max(delay, 0))
+        self._digest_task = None
+        self._flush_digest()
+
+    def _flush_digest(self):
+        if not self._digest:
+            return
+        items, self._digest = self._digest, []
+        self._last_admin_send = time.monotonic()
+        if len(items) == 1:
+            return self._send_admin(items[0])
+
+        chunk = f"📬 Сводка ({len(items)}):"
+        for item in items:
+            if len(chunk) + len(item) + 2 > MESSAGE_LIMIT:
+                self._send_admin(chunk)
+                chunk = ""
+            chunk = f"{chunk}\n\n{item}" if chunk else item
+        self._send_admin(chunk)
+
+    def _send_admin(self, text):
+        # уведомления собираются из имён и заметок пользователей: без HTML-разметки,
+        # иначе один символ «<» в имени — и Telegram отклонит всю сводку
+        self.send(self.admin_id, text, parse_mode=None)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.idle}
+            rate = GROUP_CHAT_RATE if chat_id < 0 else PRIVATE_CHAT_RATE
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, 1)
+        return bucket
+
+    async def _worker(self, queue):
+        while True:
+            chat_id, text, kwargs = await queue.get()
+            try:
+                await self._deliver(chat_id, text, kwargs)
+            finally:
+                queue.task_done()
+
+    async def _deliver(self, chat_id, text, kwargs):
+        for attempt in range(self.max_retries + 1):
+            delay = max(self._chat_bucket(chat_id).reserve(), self.global_bucket.reserve())
+            if delay:
+                await asyncio.sleep(delay)
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                self.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                logging.warning(f"Flood control для {chat_id}: ждём {e.retry_after} с")
+                await asyncio.sleep(e.retry_after)
+            except TelegramNetworkError as e:
+                logging.warning(f"Сетевая ошибка при отправке в {chat_id}: {e}")
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logging.error(f"Ошибка отправки сообщения в {chat_id}: {e}")
+                break
+        self.failed += 1
+
+    async def close(self):
+        """Отправляет накопленную сводку и всё, что осталось в очереди."""
+        if self._digest_task is not None:
+            self._digest_task.cancel()
+            self._digest_task = None
+        self._flush_digest()
+        if self._workers:
+            await asyncio.gather(*(q.join() for q in self._queues))
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+
+outbox = Outbox(bot, admin_id=ADMIN_ID)
@@ -0,0 +1,69 @@
+import logging
+from datetime import datetime, timedelta
+
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from config import REMINDER_MINUTES, ARCHIVE_AFTER_DAYS
+from database import db
+from outbox import outbox
+
+
+async def send_reminders(now=None):
+    """Одна выборка по индексу за тик: брони, до начала которых осталось не больше REMINDER_MINUTES."""
+    now = now or datetime.now()
+    bookings = await db.take_due_reminders(now, timedelta(minutes=REMINDER_MINUTES))
+    for b in bookings:
+        if b.user:
+            outbox.send(
+                b.user.tg_id,
+                f"🔔 Напоминание: бронирование #{b.id}\n"
+                f"📅 {b.booking_time.strftime('%d.%m.%Y %H:%M')} - {b.end_time.strftime('%H:%M')}\n"
+                f"📝 Заметки: {b.notes if b.notes else 'нет'}",
+                parse_mode=None  # заметку пишет пользователь, это не HTML
+            )
+    return len(bookings)
+
+
+async def complete_past_bookings(now=None):
+    count = await db.complete_past_bookings(now or datetime.now())
+    if count:
+        logging.info(f"Завершено бронирований: {count}")
+    return count
+
+
+async def archive_old_bookings(now=None):
+    if not ARCHIVE_AFTER_DAYS:
+        return 0
+    now = now or datetime.now()
+    count = await db.archive_bookings(now - timedelta(days=ARCHIVE_AFTER_DAYS))
+    if count:
+        logging.info(f"Перенесено в архив бронирований: {count}")
+    return count
+
+
+def create_scheduler():
+    # задания держим в памяти: хранилище на SQLAlchemy читало бы bookings.db синхронно
+    # прямо в цикле событий. При старте задания добавляются заново (replace_existing),
+    # а то, кому уже ушло напоминание, записано в самих бронях (reminded_at)
+    scheduler = AsyncIOScheduler(
+        jobstores={"default": MemoryJobStore()},
+        job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 300}
+    )
+    scheduler.add_job(
+        "scheduler:send_reminders", "interval", minutes=1,
+        id="send_reminders", replace_existing=True
+    )
+    scheduler.add_job(
+        "scheduler:complete_past_bookings", "interval", minutes=5,
+        id="complete_past_bookings", replace_existing=True
+    )
+    if ARCHIVE_AFTER_DAYS:
+        scheduler.add_job(
+            "scheduler:archive_old_bookings", "cron", hour=4,
+            id="archive_old_bookings", replace_existing=True
+        )
+    return scheduler
+
+
+scheduler = create_scheduler()
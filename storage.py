@@ -0,0 +1,204 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import date, datetime
+from typing import Any, Dict, Mapping, Optional
+
+import aiosqlite
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+
+def _encode(value):
+    # в состоянии бронирования лежат datetime/date: храним их ISO-строкой без потерь
+    if isinstance(value, datetime):
+        return {"$dt": value.isoformat()}
+    if isinstance(value, date):
+        return {"$d": value.isoformat()}
+    raise TypeError(f"Не удаётся сериализовать {type(value).__name__}")
+
+
+def _decode(obj):
+    if len(obj) == 1:
+        if "$dt" in obj:
+            return datetime.fromisoformat(obj["$dt"])
+        if "$d" in obj:
+            return date.fromisoformat(obj["$d"])
+    return obj
+
+
+def dumps(data):
+    return json.dumps(data, default=_encode, ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(raw):
+    return json.loads(raw, object_hook=_decode) if raw else {}
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в локальном SQLite (WAL): переживает перезапуск и может
+    использоваться несколькими процессами бота на одной машине.
+
+    Записи копятся в памяти и сбрасываются одной транзакцией раз в
+    flush_interval секунд (0 — писать сразу). Сценарии, которые не менялись
+    дольше ttl секунд, считаются брошенными и удаляются.
+    """
+
+    def __init__(self, path="fsm.db", flush_interval=0.05, ttl=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._connect_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        # key -> {"state": ..., "data": ...}; в записи только изменённые поля
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._inflight: Dict[str, Dict[str, Any]] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._last_purge = 0.0
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id or "",
+            key.business_connection_id or "", key.destiny
+        ))
+
+    async def _connection(self) -> aiosqlite.Connection:
+        if self._conn is None:
+            async with self._connect_lock:
+                if self._conn is None:
+                    conn = await aiosqlite.connect(self.path, isolation_level=None)
+                    await conn.execute("PRAGMA journal_mode=WAL")
+                    await conn.execute("PRAGMA synchronous=NORMAL")
+                    await conn.execute("PRAGMA busy_timeout=5000")
+                    await conn.execute(
+                        "CREATE TABLE IF NOT EXISTS fsm ("
+                        "key TEXT PRIMARY KEY, state TEXT, data TEXT, updated_at REAL NOT NULL)"
+                    )
+                    await conn.execute("CREATE INDEX IF NOT EXISTS ix_fsm_updated_at ON fsm (updated_at)")
+                    self._conn = conn
+        return self._conn
+
+    # ---------- запись ----------
+    async def _write(self, key: StorageKey, **fields):
+        record_key = self._key(key)
+        self._pending.setdefault(record_key, {}).update(fields, updated_at=time.time())
+        if not self.flush_interval:
+            await self.flush()
+        elif self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # изменения, пришедшие во время сброса, уходят следующим пакетом
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Ошибка записи FSM-состояния: {e}")
+
+    async def flush(self):
+        """Сбрасывает накопленные изменения одной транзакцией."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            self._inflight, self._pending = self._pending, {}
+            conn = await self._connection()
+            full, state_only, data_only = [], [], []
+            for record_key, fields in self._inflight.items():
+                updated_at = fields["updated_at"]
+                if "state" in fields and "data" in fields:
+                    full.append((record_key, fields["state"], fields["data"], updated_at))
+                elif "state" in fields:
+                    state_only.append((record_key, fields["state"], updated_at))
+                else:
+                    data_only.append((record_key, fields["data"], updated_at))
+            try:
+                await conn.execute("BEGIN")
+                await conn.executemany(
+                    "INSERT INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET state = excluded.state, "
+                    "data = excluded.data, updated_at = excluded.updated_at",
+                    full
+                )
+                await conn.executemany(
+                    "INSERT INTO fsm (key, state, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                    state_only
+                )
+                await conn.executemany(
+                    "INSERT INTO fsm (key, data, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                    data_only
+                )
+                # state.clear() оставляет пустую запись — она не нужна; проверяем
+                # по первичному ключу только что записанные, а не всю таблицу
+                await conn.executemany(
+                    "DELETE FROM fsm WHERE key = ? AND state IS NULL AND (data IS NULL OR data = '{}')",
+                    [(record_key,) for record_key in self._inflight]
+                )
+                await self._purge_expired(conn)
+                await conn.execute("COMMIT")
+            except Exception:
+                if conn.in_transaction:
+                    await conn.execute("ROLLBACK")
+                # не теряем изменения: более свежие записи из _pending имеют приоритет
+                for record_key, fields in self._inflight.items():
+                    self._pending[record_key] = {**fields, **self._pending.get(record_key, {})}
+                raise
+            finally:
+                self._inflight = {}
+
+    async def _purge_expired(self, conn):
+        if not self.ttl:
+            return
+        now = time.time()
+        if now - self._last_purge < min(self.ttl, 60):
+            return
+        self._last_purge = now
+        await conn.execute("DELETE FROM fsm WHERE updated_at < ?", (now - self.ttl,))
+
+    # ---------- чтение ----------
+    async def _read(self, key: StorageKey, field: str):
+        record_key = self._key(key)
+        for buffer in (self._pending, self._inflight):
+            fields = buffer.get(record_key)
+            if fields and field in fields:
+                return fields[field]
+        conn = await self._connection()
+        query = f"SELECT {field} FROM fsm WHERE key = ?"
+        params = [record_key]
+        if self.ttl:
+            query += " AND updated_at >= ?"
+            params.append(time.time() - self.ttl)
+        async with conn.execute(query, params) as cursor:
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._write(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self._read(key, "state")
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(
+                f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            )
+        await self._write(key, data=dumps(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return loads(await self._read(key, "data"))
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._flusher is not None:
+            self._flusher.cancel()
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
@@ -0,0 +1,30 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# модули бота лежат в корне репозитория; config.py требует токен при импорте
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["TELEGRAM_BOT_TOKEN"] = "123456:test"
+os.environ["ADMIN_ID"] = ""
+os.environ["RUN_MODE"] = "polling"
+os.environ["FSM_STORAGE"] = "memory"
+os.environ["METRICS_PORT"] = "0"
+
+from database import Database  # noqa: E402
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(params=["tuned", "default"])
+def database(request, tmp_path, loop):
+    database = Database(f"sqlite+aiosqlite:///{tmp_path / 'bookings.db'}", profile=request.param)
+    loop.run_until_complete(database.init())
+    yield database
+    loop.run_until_complete(database.close())
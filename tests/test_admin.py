@@ -0,0 +1,99 @@
+import re
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import admin
+from keyboards import BookingsPage, day_code, time_code, time_from_code
+
+
+@pytest.fixture
+def admin_db(database, monkeypatch):
+    monkeypatch.setattr(admin, "db", database)
+    return database
+
+
+def page_ids(text):
+    return [int(i) for i in re.findall(r"🆔 ID: (\d+)", text)]
+
+
+def buttons(kb):
+    if kb is None:
+        return {}
+    return {b.text: BookingsPage.unpack(b.callback_data) for b in kb.inline_keyboard[0]}
+
+
+async def open_page(page):
+    # как admin.page_bookings
+    cursor = (time_from_code(page.ts), page.id)
+    return await admin._bookings_page(
+        None, page.st, page.day, page.drv,
+        after=cursor if page.go == "n" else None,
+        before=cursor if page.go == "p" else None
+    )
+
+
+def test_time_code_round_trips_seconds():
+    dt = datetime(2030, 3, 31, 2, 30, 59)  # в ночь перехода на летнее время в Европе
+    assert time_from_code(time_code(dt)) == dt
+
+
+def test_pages_neither_repeat_nor_skip_bookings(admin_db, loop):
+    async def scenario():
+        user_id = await admin_db.add_user(100, "Тест", "test")
+        origin = datetime(2030, 1, 7, 10, 0)
+        # брони из /import бывают с секундами, несколько — в одну и ту же секунду
+        ids = await admin_db.add_bookings([
+            {"user_id": user_id, "status": "completed", "driver_id": None,
+             "booking_time": origin + timedelta(seconds=15 * (i // 2)),
+             "end_time": origin + timedelta(hours=1)}
+            for i in range(35)
+        ])
+        forward, pages = [], []
+        text, kb = await admin._bookings_page(None, "", 0, 0)
+        while True:
+            pages.append(page_ids(text))
+            forward += pages[-1]
+            if "Вперёд ➡️" not in buttons(kb):
+                break
+            text, kb = await open_page(buttons(kb)["Вперёд ➡️"])
+
+        backward = [pages[-1]]
+        while "⬅️ Назад" in buttons(kb):
+            text, kb = await open_page(buttons(kb)["⬅️ Назад"])
+            backward.append(page_ids(text))
+        return ids, forward, pages, backward
+
+    ids, forward, pages, backward = loop.run_until_complete(scenario())
+    assert forward == ids
+    assert backward == pages[::-1]
+
+
+def test_bookings_filters_use_day_code():
+    status, day, driver_id = admin._parse_bookings_filters("canceled 07.01.2030 driver=3")
+    assert (status, driver_id) == ("canceled", 3)
+    assert day == day_code(date(2030, 1, 7))
+
+
+class FakeMessage:
+    def __init__(self):
+        self.from_user = type("User", (), {"id": 1})()
+        self.answers = []
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+
+
+def test_stats_range_is_capped(loop, monkeypatch):
+    class NoDb:
+        def __getattr__(self, name):
+            raise AssertionError("слишком длинный период не должен доходить до базы")
+
+    monkeypatch.setattr(admin, "_admin_only", lambda tg_id: True)
+    monkeypatch.setattr(admin, "db", NoDb())
+    last = date(2030, 1, 1)
+    first = last - timedelta(days=admin.MAX_STATS_DAYS)
+    message = FakeMessage()
+    command = type("Command", (), {"args": f"{first:%d.%m.%Y}-{last:%d.%m.%Y}"})()
+    loop.run_until_complete(admin.show_stats(message, command))
+    assert message.answers == [f"Период — не больше {admin.MAX_STATS_DAYS} дней"]
@@ -0,0 +1,72 @@
+import random
+from datetime import date
+
+import numpy as np
+import pytest
+
+from analytics import (
+    CANCELED, EPOCH, MINUTES_PER_DAY, OCCUPIED, PADDING_MINUTES, STARTS, daily_counts, utilization
+)
+from availability import DAY_START_HOUR, SLOT_MINUTES, SLOTS_PER_DAY
+
+FIRST_DAY = date(2030, 1, 7)
+
+
+def reference_counts(rows, first_day, days, driver_ids):
+    """daily_counts по одной брони за раз, без NumPy: занятость — пересечение со слотами дня начала."""
+    columns = {driver_id: i for i, driver_id in enumerate(sorted(driver_ids))}
+    counts = [[[[0] * SLOTS_PER_DAY for _ in range(3)] for _ in driver_ids] for _ in range(days)]
+    for driver_id, start, end, canceled in rows:
+        day = start // MINUTES_PER_DAY - (first_day - EPOCH).days
+        if driver_id not in columns or not 0 <= day < days:
+            continue
+        cell = counts[day][columns[driver_id]]
+        grid = (start // MINUTES_PER_DAY) * MINUTES_PER_DAY + DAY_START_HOUR * 60
+        for slot in range(SLOTS_PER_DAY):
+            slot_start = grid + slot * SLOT_MINUTES
+            if not canceled and start < slot_start + SLOT_MINUTES and slot_start < end:
+                cell[OCCUPIED][slot] = 1
+        slot = (start + PADDING_MINUTES - grid) // SLOT_MINUTES
+        if 0 <= slot < SLOTS_PER_DAY:
+            cell[STARTS][slot] += 1
+            cell[CANCELED][slot] += bool(canceled)
+    return np.array(counts, dtype=np.int64).reshape(days, len(driver_ids), 3, SLOTS_PER_DAY)
+
+
+def random_rows(rng, count, days, drivers):
+    origin = (FIRST_DAY - EPOCH).days * MINUTES_PER_DAY
+    rows = []
+    for _ in range(count):
+        # с днями вне диапазона, чужими водителями, бронями до и после сетки и через полночь
+        start = origin + rng.randrange(-MINUTES_PER_DAY, (days + 1) * MINUTES_PER_DAY, rng.choice((1, 15, 30)))
+        end = start + rng.choice((0, 15, 30, 90, 240, 20 * 60))
+        rows.append((rng.randrange(1, drivers + 2), start, end, rng.random() < 0.3))
+    return rows
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_daily_counts_matches_per_row_reference(seed):
+    rng = random.Random(seed)
+    driver_ids = [1, 2, 4]
+    rows = random_rows(rng, 500, 10, 4)
+    counts = daily_counts(rows, FIRST_DAY, 10, driver_ids)
+    assert counts.shape == (10, 3, 3, SLOTS_PER_DAY)
+    assert (counts == reference_counts(rows, FIRST_DAY, 10, driver_ids)).all()
+
+
+def test_daily_counts_without_rows_or_drivers():
+    assert not daily_counts([], FIRST_DAY, 3, [1]).any()
+    assert daily_counts(random_rows(random.Random(0), 10, 3, 2), FIRST_DAY, 3, []).shape == (3, 0, 3, SLOTS_PER_DAY)
+
+
+def test_utilization_by_weekday():
+    start = (FIRST_DAY - EPOCH).days * MINUTES_PER_DAY + DAY_START_HOUR * 60 - PADDING_MINUTES
+    # понедельник FIRST_DAY и следующий: одна бронь на первом слоте, вторая отменена
+    rows = [(1, start, start + 2 * PADDING_MINUTES + SLOT_MINUTES, False),
+            (1, start + 7 * MINUTES_PER_DAY, start + 7 * MINUTES_PER_DAY + SLOT_MINUTES, True)]
+    stats = utilization(daily_counts(rows, FIRST_DAY, 14, [1]), FIRST_DAY)
+    assert stats["weekdays"].tolist() == [2] * 7
+    assert stats["starts"][0, 0, 0] == 2 and stats["canceled"][0, 0, 0] == 1
+    assert stats["cancellation"][0, 0, 0] == 0.5
+    assert stats["occupancy"][0, 0, 0] == 0.5
+    assert stats["occupancy"][0, 1:].sum() == 0
@@ -0,0 +1,150 @@
+from datetime import date, datetime, time, timedelta
+
+import pytest
+
+from availability import SLOTS_PER_DAY, expand_recurrence, slot_time
+import bot
+from bot import WEEKDAY_SETS, _flow_interval, _parse_repeat
+from keyboards import CALENDAR_DAYS, BookingFlow, day_code
+
+TODAY = day_code(date.today())
+TOMORROW = date.today() + timedelta(days=1)
+DAY = day_code(TOMORROW)
+
+
+def crafted(act, day=None, start=None, end=None):
+    # callback_data приходит с клиента: её можно собрать руками
+    return BookingFlow.unpack(BookingFlow(act=act, day=day, start=start, end=end).pack())
+
+
+def test_flow_interval_on_grid():
+    assert _flow_interval(crafted("d", DAY)) == (TOMORROW, None, None)
+    assert _flow_interval(crafted("s", DAY, 4)) == (TOMORROW, slot_time(TOMORROW, 4), None)
+    for act in ("e", "n", "ok"):
+        assert _flow_interval(crafted(act, DAY, 0, SLOTS_PER_DAY)) == (
+            TOMORROW, datetime.combine(TOMORROW, datetime.min.time()).replace(hour=8),
+            datetime.combine(TOMORROW, datetime.min.time()).replace(hour=22)
+        )
+    # последний день календаря
+    assert _flow_interval(crafted("d", TODAY + CALENDAR_DAYS - 1)) is not None
+
+
+@pytest.mark.parametrize("act", ["d", "s", "e", "n", "ok"])
+@pytest.mark.parametrize("day", [
+    None,                           # нет даты
+    0,                              # datetime.fromordinal(0) — ValueError
+    10 ** 9,                        # за пределами datetime
+    TODAY - 1,                      # прошедший день
+    TODAY + CALENDAR_DAYS,          # за пределами календаря
+    day_code(date(2191, 4, 29)),
+])
+def test_flow_interval_rejects_day_outside_calendar(act, day):
+    assert _flow_interval(crafted(act, day, 4, 6)) is None
+
+
+@pytest.mark.parametrize("act, start, end", [
+    ("s", None, None),              # нет начала
+    ("s", -1, None),                # до начала сетки
+    ("s", SLOTS_PER_DAY, None),     # начало после конца сетки
+    ("e", 4, None),                 # нет конца
+    ("e", None, 6),
+    ("n", 6, 4),                    # конец раньше начала
+    ("ok", 4, 4),                   # пустой интервал
+    ("ok", -2, 4),
+    ("ok", 4, SLOTS_PER_DAY + 1),   # после конца сетки
+])
+def test_flow_interval_rejects_crafted_slots(act, start, end):
+    assert _flow_interval(crafted(act, DAY, start, end)) is None
+
+
+class FakeCallback:
+    def __init__(self):
+        self.answers = []
+
+    async def answer(self, text=None, show_alert=False):
+        self.answers.append((text, show_alert))
+
+
+@pytest.mark.parametrize("handler, callback_data", [
+    (bot.flow_date, crafted("d")),
+    (bot.flow_date, crafted("d", 0)),
+    (bot.flow_start, crafted("s", DAY)),
+    (bot.flow_start, crafted("s", 10 ** 9, 4)),
+])
+def test_date_and_start_steps_reject_crafted_callback(loop, handler, callback_data):
+    callback = FakeCallback()
+    # до базы и клавиатур дело не доходит: session не нужна
+    loop.run_until_complete(handler(callback, callback_data, session=None))
+    assert callback.answers == [(bot.BAD_INTERVAL, True)]
+
+
+def test_parse_repeat():
+    assert _parse_repeat("20.10.2030-20.11.2030 08:00-09:30 будни Школа, 2 этаж") == (
+        date(2030, 10, 20), date(2030, 11, 20), time(8), time(9, 30), WEEKDAY_SETS["будни"], "Школа, 2 этаж"
+    )
+    # одна дата, по умолчанию ежедневно
+    assert _parse_repeat("20.10.2030 08:00-09:00") == (
+        date(2030, 10, 20), date(2030, 10, 20), time(8), time(9), WEEKDAY_SETS["ежедневно"], None
+    )
+    assert _parse_repeat("20.10.2030-21.10.2030 08:00-09:00 ПН,ср")[4] == {0, 2}
+    # первое слово не дни недели — это начало заметки
+    assert _parse_repeat("20.10.2030 08:00-09:00 Школа по пн")[4:] == (WEEKDAY_SETS["ежедневно"], "Школа по пн")
+
+
+@pytest.mark.parametrize("args", [
+    None,
+    "20.10.2030",
+    "20.10.2030 08:00",
+    "32.10.2030 08:00-09:00",
+    "20.10.2030-30.02.2031 08:00-09:00",
+    "20.10.2030 8-9",
+])
+def test_parse_repeat_rejects_malformed(args):
+    with pytest.raises(ValueError):
+        _parse_repeat(args)
+
+
+def test_expand_recurrence():
+    # 07.01.2030 — понедельник
+    trips = expand_recurrence(date(2030, 1, 7), date(2030, 1, 20), {0, 2}, time(8), time(9))
+    assert trips == [
+        (datetime(2030, 1, day, 8), datetime(2030, 1, day, 9)) for day in (7, 9, 14, 16)
+    ]
+    assert expand_recurrence(date(2030, 1, 7), date(2030, 1, 7), {5, 6}, time(8), time(9)) == []
+    assert expand_recurrence(date(2030, 1, 8), date(2030, 1, 7), set(range(7)), time(8), time(9)) == []
+
+
+class FakeMessage:
+    def __init__(self):
+        self.from_user = type("User", (), {"id": 100})()
+        self.answers = []
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+
+
+class FakeDb:
+    def __init__(self):
+        self.batches = []
+
+    async def get_user(self, tg_id, session=None):
+        return type("User", (), {"id": 1})()
+
+    async def add_bookings(self, bookings):
+        self.batches.append(bookings)
+        return list(range(1, len(bookings) + 1))
+
+
+@pytest.mark.parametrize("first, last", [
+    (date.today() - timedelta(days=1), date.today() + timedelta(days=2)),    # начало в прошлом
+    (date.today() + timedelta(days=3), date.today() + timedelta(days=2)),    # конец раньше начала
+    (date.today(), date.today() + timedelta(days=CALENDAR_DAYS + 1)),        # за пределами календаря
+])
+def test_repeat_rejects_period_outside_calendar(loop, monkeypatch, first, last):
+    fake_db = FakeDb()
+    monkeypatch.setattr(bot, "db", fake_db)
+    message = FakeMessage()
+    command = type("Command", (), {"args": f"{first:%d.%m.%Y}-{last:%d.%m.%Y} 08:00-09:00"})()
+    loop.run_until_complete(bot.repeat_booking(message, command, session=None))
+    assert len(message.answers) == 1 and message.answers[0].startswith("Период должен")
+    assert fake_db.batches == []
@@ -0,0 +1,359 @@
+import asyncio
+import re
+import sqlite3
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import event, func, select
+
+from availability import BOOKING_PADDING, slot_time
+from database import ArchivedBooking, Booking, DailyStats, Database, Invite, User
+
+DAY = date(2030, 1, 7)
+
+
+async def seed(database, drivers=2, per_driver=10, user_tg_id=100):
+    """Пользователь и водители с бронями на DAY и следующий день; возвращает (user_id, driver_ids)."""
+    user_id = await database.add_user(user_tg_id, "Тест", "test")
+    driver_ids = await database.add_drivers([{"name": f"Водитель {i}"} for i in range(drivers)])
+    for day in (DAY, DAY + timedelta(days=1)):
+        for driver_id in driver_ids:
+            for slot in range(0, 2 * per_driver, 2):
+                start = slot_time(day, slot)
+                await database.add_booking(driver_id, user_id, start, start + BOOKING_PADDING)
+    return user_id, driver_ids
+
+
+@contextmanager
+def statements(database):
+    """Запросы (SQL, параметры), выполненные на обоих движках внутри блока."""
+    executed = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        executed.append((statement, parameters))
+
+    engines = (database.engine.sync_engine, database.write_engine.sync_engine)
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield executed
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def query_plans(path, executed):
+    """EXPLAIN QUERY PLAN для каждого SELECT по bookings: [(SQL, строки плана)]."""
+    plans = []
+    with sqlite3.connect(path) as conn:
+        for statement, parameters in executed:
+            if statement.lstrip().upper().startswith("SELECT") and re.search(r"\bbookings\b", statement):
+                rows = conn.execute(f"EXPLAIN QUERY PLAN {statement}", parameters).fetchall()
+                plans.append((statement, [row[-1] for row in rows]))
+    return plans
+
+
+def test_hot_queries_use_indexes(database, loop, tmp_path):
+    async def scenario():
+        user_id, driver_ids = await seed(database)
+        with statements(database) as executed:
+            await database.get_user_bookings(user_id)
+            await database.get_occupancy_range(DAY, 7)
+            async with database.Session() as session:
+                await Database._busy_intervals(
+                    session, driver_ids, slot_time(DAY, 0), slot_time(DAY + timedelta(days=1), 0)
+                )
+            await database.take_due_reminders(slot_time(DAY, 0) - timedelta(minutes=30), timedelta(hours=2))
+        return executed
+
+    executed = loop.run_until_complete(scenario())
+    plans = query_plans(tmp_path / "bookings.db", executed)
+    assert len(plans) == 4
+    for statement, plan in plans:
+        assert any(re.search(r"SEARCH bookings USING (COVERING )?INDEX", line) for line in plan), (statement, plan)
+        assert not any(line.startswith("SCAN bookings") for line in plan), (statement, plan)
+
+
+def test_availability_sees_other_process_after_ttl(database, loop, tmp_path):
+    # второй процесс с той же базой: его записи не обновляют индекс первого
+    other = Database(f"sqlite+aiosqlite:///{tmp_path / 'bookings.db'}", availability_ttl=0.5)
+
+    async def scenario():
+        user_id = await database.add_user(100, "Тест", "test")
+        driver_id = await database.add_driver("Водитель")
+        start = slot_time(DAY, 4)
+        assert [d.id for d in await other.get_free_drivers(start, start + BOOKING_PADDING)] == [driver_id]
+
+        await database.add_booking(driver_id, user_id, start - BOOKING_PADDING, start + 2 * BOOKING_PADDING)
+        assert [d.id for d in await other.get_free_drivers(start, start + BOOKING_PADDING)] == [driver_id]
+        await asyncio.sleep(0.6)
+        assert await other.get_free_drivers(start, start + BOOKING_PADDING) == []
+        await other.close()
+
+    loop.run_until_complete(scenario())
+
+
+def test_parallel_confirmations_of_one_slot(database, loop):
+    async def scenario():
+        user_ids = [await database.add_user(100 + i, f"Клиент {i}", None) for i in range(300)]
+        driver_id = await database.add_driver("Водитель")
+        start = slot_time(DAY, 4) - BOOKING_PADDING
+        results = await asyncio.gather(*(
+            database.add_booking(driver_id, user_id, start, start + 3 * BOOKING_PADDING)
+            for user_id in user_ids
+        ))
+        bookings = await database.get_all_bookings()
+        return results, bookings
+
+    results, bookings = loop.run_until_complete(scenario())
+    winners = [r for r in results if r is not None]
+    assert len(winners) == 1
+    assert [b.id for b in bookings if b.status == 'active'] == winners
+
+
+def test_user_bookings_query_count_is_constant(database, loop):
+    async def count(user_id, include_history):
+        with statements(database) as executed:
+            bookings = await database.get_user_bookings(user_id, include_history=include_history)
+            # связанный водитель уже загружен, обращение не должно вызывать запрос
+            assert all(b.driver.name for b in bookings)
+        return len(executed)
+
+    async def scenario():
+        few, _ = await seed(database, drivers=1, per_driver=1, user_tg_id=100)
+        many, _ = await seed(database, drivers=3, per_driver=10, user_tg_id=200)
+        # часть броней второго пользователя — в архиве
+        async with database.WriteSession() as session:
+            await session.execute(
+                Booking.__table__.update().where(Booking.user_id == many, Booking.id % 2 == 0)
+                .values(status='completed')
+            )
+            await session.commit()
+        assert await database.archive_bookings(datetime.combine(DAY + timedelta(days=2), datetime.min.time()))
+        return [await count(user_id, history) for history in (False, True) for user_id in (few, many)]
+
+    plain_few, plain_many, history_few, history_many = loop.run_until_complete(scenario())
+    assert plain_few == plain_many
+    assert history_few == history_many
+
+
+def test_booking_ids_are_not_reused_after_archiving(database, loop):
+    async def scenario():
+        user_id, (driver_id,) = await seed(database, drivers=1, per_driver=3)
+        before = await database.get_all_bookings()
+        last = max(b.id for b in before)
+        # последняя бронь уходит в архив, освобождая максимальный id рабочей таблицы
+        assert await database.cancel_booking(last)
+        archive_before = max(b.booking_time for b in before) + timedelta(days=1)
+        assert await database.archive_bookings(archive_before) == 1
+
+        start = slot_time(DAY + timedelta(days=2), 0)
+        new_id = await database.add_booking(driver_id, user_id, start, start + BOOKING_PADDING)
+        batch_ids = await database.add_bookings([
+            {"driver_id": driver_id, "user_id": user_id, "status": "canceled",
+             "booking_time": start, "end_time": start + BOOKING_PADDING}
+        ])
+        await database.cancel_booking(new_id)
+        # архивация новых броней не упирается в UNIQUE по bookings_archive.id
+        assert await database.archive_bookings(start + timedelta(days=1)) == 2
+        return last, new_id, batch_ids
+
+    last, new_id, batch_ids = loop.run_until_complete(scenario())
+    assert new_id == last + 1
+    assert batch_ids == [last + 2]
+
+
+def test_write_inside_update_session(database, loop):
+    # как в DbSessionMiddleware: чтения апдейта в одной сессии, запись — через писателя
+    async def scenario():
+        user_id = await database.add_user(100, "Тест", "test")
+        driver_id = await database.add_driver("Водитель")
+        start = slot_time(DAY, 4)
+        async with database.Session() as session:
+            assert await database.get_free_drivers(start, start + BOOKING_PADDING, session=session)
+            assert await database.get_user_bookings(user_id, session=session) == []
+            booking_id = await asyncio.wait_for(
+                database.add_booking(driver_id, user_id, start - BOOKING_PADDING, start + 2 * BOOKING_PADDING),
+                timeout=2
+            )
+            assert booking_id is not None
+            await session.commit()
+
+    loop.run_until_complete(scenario())
+
+
+async def seed_history(database, now):
+    """Неактивные брони за 100 дней до now в обеих таблицах; возвращает {(статус, архив): число}."""
+    user_id = await database.add_user(100, "Тест", "test")
+    await database.add_driver("Водитель")
+    statuses = ("canceled", "completed", "canceled", "active")
+    await database.add_bookings([
+        {"user_id": user_id, "driver_id": None, "status": statuses[i % 4],
+         "booking_time": now - timedelta(days=100 - i), "end_time": now - timedelta(days=100 - i, hours=-1)}
+        for i in range(100)
+    ])
+    # всё неактивное старше 50 дней — в архиве
+    await database.archive_bookings(now - timedelta(days=50))
+    counts = {}
+    async with database.Session() as session:
+        for model, archived in ((Booking, False), (ArchivedBooking, True)):
+            for status, count in (await session.execute(
+                select(model.status, func.count()).group_by(model.status)
+            )).all():
+                counts[status, archived] = count
+    return counts
+
+
+def test_purge_bookings_in_chunks(database, loop):
+    now = datetime(2030, 1, 7, 12, 0)
+
+    async def scenario():
+        counts = await seed_history(database, now)
+        assert counts[("canceled", True)] and counts[("canceled", False)]
+        with pytest.raises(ValueError):
+            await database.purge_bookings("active")
+
+        expected = counts[("canceled", True)] + counts[("canceled", False)]
+        assert await database.purge_bookings("canceled", dry_run=True) == expected
+        # по 25 отменённых в каждой таблице: несколько пачек, последняя полная —
+        # цикл должен остановиться на следующей пустой
+        assert counts[("canceled", True)] == counts[("canceled", False)] == 25
+        purged = await database.purge_bookings("canceled", chunk_size=5)
+        assert purged == expected
+        assert await database.purge_bookings("canceled", dry_run=True) == 0
+
+        statuses = {b.status for b in await database.get_all_bookings()}
+        async with database.Session() as session:
+            statuses |= set(await session.scalars(select(ArchivedBooking.status)))
+        return statuses
+
+    assert loop.run_until_complete(scenario()) == {"active", "completed"}
+
+
+def test_apply_retention_by_age(database, loop):
+    now = datetime.now().replace(microsecond=0)
+
+    async def scenario():
+        await seed_history(database, now)
+        policy = {"canceled": 30, "completed": 70}
+        dry = await database.apply_retention(policy, dry_run=True)
+        done = await database.apply_retention(policy)
+        left = await database.apply_retention(policy, dry_run=True)
+        return dry, done, left
+
+    dry, done, left = loop.run_until_complete(scenario())
+    # бронь i начинается за 100 - i дней до now, а apply_retention считает от чуть более позднего времени
+    assert dry == done == {
+        "canceled": sum(1 for i in range(100) if i % 4 in (0, 2) and 100 - i >= 30),
+        "completed": sum(1 for i in range(100) if i % 4 == 1 and 100 - i >= 70),
+    }
+    assert left == {"canceled": 0, "completed": 0}
+
+
+def test_parallel_redeems_of_one_invite(database, loop):
+    async def scenario():
+        [code] = await database.add_invites(1)
+        results = await asyncio.gather(*(
+            database.redeem_invite_and_register(code, 100 + i, f"Клиент {i}", None)
+            for i in range(50)
+        ))
+        async with database.Session() as session:
+            invite = await session.scalar(select(Invite).filter_by(code=code))
+            users = (await session.scalars(select(User.id))).all()
+        return results, invite, users
+
+    results, invite, users = loop.run_until_complete(scenario())
+    winners = [r for r in results if r is not None]
+    assert len(winners) == 1
+    assert users == winners
+    assert invite.is_used
+
+
+def test_add_invites_refills_colliding_codes(database, loop, monkeypatch):
+    # алфавит из двух букв и длина 3 дают всего 8 кодов: коллизии неизбежны
+    monkeypatch.setattr("database.INVITE_ALPHABET", "AB")
+
+    async def scenario():
+        first = await database.add_invites(4, length=3)
+        second = await database.add_invites(4, length=3)
+        async with database.Session() as session:
+            stored = (await session.scalars(select(Invite.code))).all()
+        return first, second, stored
+
+    first, second, stored = loop.run_until_complete(scenario())
+    assert len(first) == len(set(first)) == 4
+    assert len(second) == len(set(second)) == 4
+    assert sorted(first + second) == sorted(stored) == sorted(
+        a + b + c for a in "AB" for b in "AB" for c in "AB"
+    )
+
+
+def test_add_bookings_picks_drivers_and_conflicts_inside_batch(database, loop):
+    async def scenario():
+        user_id = await database.add_user(100, "Тест", "test")
+
+        def trip(day, hour, **extra):
+            start = datetime.combine(day, datetime.min.time()).replace(hour=hour)
+            return {"user_id": user_id, "booking_time": start, "end_time": start + timedelta(hours=1), **extra}
+
+        first, second = await database.add_drivers([{"name": "Первый"}, {"name": "Второй"}])
+        busy = trip(DAY, 12)
+        existing = await database.add_booking(first, user_id, busy["booking_time"], busy["end_time"])
+        with statements(database) as executed:
+            ids = await database.add_bookings([
+                trip(DAY, 8),                                   # свободны оба — первый
+                trip(DAY, 12),                                  # первый занят в базе — второй
+                trip(DAY + timedelta(days=1), 8, notes="Школа"),  # тот же водитель, что у предыдущей
+                trip(DAY, 8, driver_id=first),                  # пересекается с первой бронью пачки
+                trip(DAY, 8, driver_id=first, status="canceled"),  # отменённые не занимают слот
+                trip(DAY, 8, notes="Вокзал"),                   # первый занят пачкой — второй
+                trip(DAY, 8),                                   # заняты оба
+            ])
+        inserts = [sql for sql, _ in executed if sql.startswith("INSERT INTO bookings ")]
+        bookings = {b.id: b for b in await database.get_all_bookings()}
+        return first, second, existing, ids, inserts, bookings
+
+    first, second, existing, ids, inserts, bookings = loop.run_until_complete(scenario())
+    # строки с заметками и без уходят одним INSERT
+    assert len(inserts) == 1
+    assert ids == [existing + 1, existing + 2, existing + 3, None, existing + 4, existing + 5, None]
+    assert [bookings[i].driver_id for i in ids if i is not None] == [first, second, second, first, second]
+    assert [bookings[i].status for i in ids if i is not None] == ["active"] * 3 + ["canceled", "active"]
+
+
+def test_stats_of_closed_day_recomputed_only_when_touched(database, loop):
+    today = date.today()
+    day, other = today - timedelta(days=3), today - timedelta(days=5)
+
+    def totals(stats):
+        return int(stats["starts"].sum()), int(stats["canceled"].sum())
+
+    async def scenario():
+        user_id = await database.add_user(100, "Тест", "test")
+        driver_id = await database.add_driver("Водитель")
+        first, _ = await database.add_bookings([
+            {"user_id": user_id, "booking_time": slot_time(d, 4) - BOOKING_PADDING,
+             "end_time": slot_time(d, 6) + BOOKING_PADDING} for d in (day, other)
+        ])
+        computed = totals(await database.get_utilization(other, day))
+
+        # запись в обход Database: сохранённые счётчики о ней не знают
+        async with database.WriteSession() as session:
+            session.add(Booking(id=first + 10, driver_id=driver_id, user_id=user_id, status='active',
+                                booking_time=slot_time(day, 10) - BOOKING_PADDING,
+                                end_time=slot_time(day, 12) + BOOKING_PADDING))
+            await session.commit()
+        cached = totals(await database.get_utilization(other, day))
+
+        # отмена через Database сбрасывает счётчики своего дня, и он считается заново
+        await database.cancel_booking(first)
+        async with database.Session() as session:
+            stored_days = set(await session.scalars(select(DailyStats.day)))
+        recomputed = totals(await database.get_utilization(other, day))
+        return computed, cached, stored_days, recomputed
+
+    computed, cached, stored_days, recomputed = loop.run_until_complete(scenario())
+    assert computed == cached == (2, 0)
+    assert day not in stored_days and other in stored_days
+    assert recomputed == (3, 1)
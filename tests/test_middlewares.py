@@ -0,0 +1,138 @@
+from datetime import datetime
+
+import pytest
+from aiogram.types import Update, User
+
+import middlewares
+from middlewares import ThrottlingMiddleware
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeBot:
+    """Принимает вызовы методов Bot API, которыми отвечают объекты апдейта."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, method, request_timeout=None):
+        self.calls.append(method)
+        return True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(middlewares, "time", clock)
+    return clock
+
+
+class Harness:
+    def __init__(self, middleware, bot):
+        self.middleware = middleware
+        self.bot = bot
+        self.handled = []
+        self._update_id = 0
+
+    async def _handler(self, event, data):
+        self.handled.append((data["event_from_user"].id, event.update_id))
+        return True
+
+    def _update(self, uid, text=None, callback_data=None):
+        self._update_id += 1
+        sender = {"id": uid, "is_bot": False, "first_name": f"User {uid}"}
+        if callback_data is not None:
+            body = {"callback_query": {"id": f"{uid}:{self._update_id}", "from": sender,
+                                       "chat_instance": str(uid), "data": callback_data}}
+        else:
+            body = {"message": {"message_id": self._update_id, "date": int(datetime.now().timestamp()),
+                                "chat": {"id": uid, "type": "private"}, "from": sender, "text": text}}
+        return Update.model_validate({"update_id": self._update_id, **body}, context={"bot": self.bot})
+
+    async def send(self, uid, text=None, callback_data=None):
+        """True, если апдейт дошёл до обработчика."""
+        update = self._update(uid, text, callback_data)
+        user = User(id=uid, is_bot=False, first_name=f"User {uid}")
+        return await self.middleware(self._handler, update, {"event_from_user": user}) is not None
+
+
+@pytest.fixture
+def harness():
+    return Harness(ThrottlingMiddleware(rate=2, burst=5, duplicate_window=1.0, idle_ttl=60), FakeBot())
+
+
+def test_token_bucket(harness, clock, loop):
+    async def scenario():
+        passed = [await harness.send(1, f"/cmd {i}") for i in range(8)]
+        clock.now += 1.0  # два токена за секунду
+        passed += [await harness.send(1, f"/again {i}") for i in range(3)]
+        return passed
+
+    assert loop.run_until_complete(scenario()) == [True] * 5 + [False] * 3 + [True, True, False]
+    assert harness.middleware.throttled == 4
+
+
+def test_duplicates_within_window_are_coalesced(harness, clock, loop):
+    async def scenario():
+        passed = [await harness.send(1, "📅 Показать календарь"), await harness.send(1, "📅 Показать календарь")]
+        clock.now += 0.5
+        passed.append(await harness.send(1, "📅 Показать календарь"))
+        clock.now += 1.1
+        passed.append(await harness.send(1, "📅 Показать календарь"))
+        # тот же текст от другого пользователя — не дубль
+        passed.append(await harness.send(2, "📅 Показать календарь"))
+        return passed
+
+    assert loop.run_until_complete(scenario()) == [True, False, False, True, True]
+    assert harness.middleware.duplicates == 2
+
+
+def test_idle_users_are_evicted(harness, clock, loop):
+    async def scenario():
+        for uid in range(1, 4):
+            await harness.send(uid, "/start")
+        clock.now += 30
+        await harness.send(4, "/start")
+        clock.now += 31
+        await harness.send(5, "/start")
+
+    loop.run_until_complete(scenario())
+    # пользователи 1–3 молчат дольше idle_ttl
+    assert list(harness.middleware._users) == [4, 5]
+
+
+def test_flooder_does_not_starve_other_users(harness, clock, loop):
+    async def scenario():
+        calm = []
+        # первый шлёт по апдейту в миллисекунду десять секунд подряд, второй — раз в полсекунды
+        for tick in range(10000):
+            await harness.send(1, f"/flood {tick}")
+            if tick % 500 == 0:
+                calm.append(await harness.send(2, f"/calm {tick}"))
+            clock.now += 0.001
+        return calm
+
+    calm = loop.run_until_complete(scenario())
+    assert calm == [True] * 20
+    flood_handled = sum(1 for uid, _ in harness.handled if uid == 1)
+    # до обработчиков доходит только запас и пополнение: 5 + 2/с * 10 с
+    assert flood_handled <= 5 + 2 * 10 + 1
+
+
+def test_dropped_callbacks_are_answered(harness, clock, loop):
+    async def scenario():
+        await harness.send(1, callback_data="bf:d:739000")
+        await harness.send(1, callback_data="bf:d:739000")  # дубль
+        for i in range(6):
+            await harness.send(1, callback_data=f"bf:d:{739001 + i}")
+
+    loop.run_until_complete(scenario())
+    # 1 дубль и 2 сверх лимита: на каждый — answerCallbackQuery, предупреждение — один раз
+    answers = [call.text for call in harness.bot.calls]
+    assert answers == [None, "Слишком часто, подождите немного", None]
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import outbox as outbox_module
+from outbox import Outbox
+
+ADMIN = 42
+
+
+class FakeBot:
+    """Записывает отправленные сообщения; на тексты из flood один раз отвечает RetryAfter."""
+
+    def __init__(self, flood=()):
+        self.sent = []
+        self.flood = set(flood)
+        self.retried = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(0)
+        if text in self.flood:
+            self.flood.discard(text)
+            self.retried.append(text)
+            raise TelegramRetryAfter(SendMessage(chat_id=chat_id, text=text), "Flood control", retry_after=0)
+        self.sent.append((chat_id, text, kwargs))
+
+
+@pytest.fixture(autouse=True)
+def fast_limits(monkeypatch):
+    # настоящие лимиты Bot API растянули бы тест на минуты
+    monkeypatch.setattr(outbox_module, "GLOBAL_RATE", 10000)
+    monkeypatch.setattr(outbox_module, "PRIVATE_CHAT_RATE", 10000)
+
+
+def run(loop, bot, scenario, **kwargs):
+    async def main():
+        outbox = Outbox(bot, admin_id=ADMIN, **kwargs)
+        await outbox.start()
+        await scenario(outbox)
+        await outbox.close()
+        return outbox
+
+    return loop.run_until_complete(main())
+
+
+def test_messages_of_a_chat_keep_order_across_retry_after(loop):
+    bot = FakeBot(flood={"1:3", "2:0"})
+
+    async def scenario(outbox):
+        for i in range(10):
+            for chat_id in (1, 2, 3):
+                outbox.send(chat_id, f"{chat_id}:{i}")
+
+    outbox = run(loop, bot, scenario, workers=2)
+    assert sorted(bot.retried) == ["1:3", "2:0"]
+    for chat_id in (1, 2, 3):
+        assert [text for c, text, _ in bot.sent if c == chat_id] == [f"{chat_id}:{i}" for i in range(10)]
+    assert (outbox.sent, outbox.failed) == (30, 0)
+
+
+def test_admin_burst_is_coalesced_into_digest(loop):
+    bot = FakeBot()
+
+    async def scenario(outbox):
+        for i in range(5):
+            outbox.notify_admin(f"Бронирование #{i}")
+        await asyncio.sleep(0.1)
+
+    run(loop, bot, scenario, digest_window=0.05)
+    texts = [text for _, text, _ in bot.sent]
+    assert texts[0] == "Бронирование #0"
+    assert len(texts) == 2
+    assert texts[1].startswith("📬 Сводка (4):")
+    assert all(f"Бронирование #{i}" in texts[1] for i in range(1, 5))
+
+
+def test_close_drains_queue_and_pending_digest(loop):
+    bot = FakeBot()
+
+    async def scenario(outbox):
+        for i in range(50):
+            outbox.send(1000 + i, "Напоминание")
+        outbox.notify_admin("Бот запущен")
+        outbox.notify_admin("Новое бронирование")  # ждёт сводки через digest_window
+
+    run(loop, bot, scenario, digest_window=60)
+    assert len([text for _, text, _ in bot.sent if text == "Напоминание"]) == 50
+    assert [text for chat_id, text, _ in bot.sent if chat_id == ADMIN] == ["Бот запущен", "Новое бронирование"]
+
+
+def test_admin_notifications_are_plain_text(loop):
+    bot = FakeBot()
+
+    async def scenario(outbox):
+        outbox.notify_admin("👤 Пользователь: <Вася & Co>")
+        outbox.notify_admin("📝 Заметки: a<b")
+        outbox.notify_admin("📝 Заметки: <script>")
+
+    run(loop, bot, scenario)
+    assert len(bot.sent) == 2
+    assert all(kwargs == {"parse_mode": None} for _, _, kwargs in bot.sent)
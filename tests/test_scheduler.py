@@ -0,0 +1,64 @@
+import re
+from datetime import datetime, timedelta
+
+from apscheduler.jobstores.memory import MemoryJobStore
+
+import scheduler
+from config import REMINDER_MINUTES
+
+LEAD = timedelta(minutes=REMINDER_MINUTES)
+TICK = timedelta(minutes=1)
+
+
+class FakeOutbox:
+    def __init__(self, clock):
+        self.clock = clock
+        self.sent = []
+
+    def send(self, chat_id, text, **kwargs):
+        self.sent.append((self.clock[0], chat_id, text, kwargs))
+
+
+def test_jobs_are_kept_in_memory():
+    jobs = scheduler.create_scheduler()
+    assert isinstance(jobs._jobstores["default"], MemoryJobStore)
+    assert {"send_reminders", "complete_past_bookings"} <= {job.id for job in jobs.get_jobs()}
+
+
+def test_thousands_of_reminders_fire_on_time(database, loop, monkeypatch):
+    clock = [datetime(2030, 1, 7, 6, 0)]
+    outbox = FakeOutbox(clock)
+    monkeypatch.setattr(scheduler, "db", database)
+    monkeypatch.setattr(scheduler, "outbox", outbox)
+
+    async def scenario():
+        user_id = await database.add_user(100, "Тест", "test")
+        driver_ids = await database.add_drivers([{"name": f"Водитель {i}"} for i in range(100)])
+        origin = clock[0] + timedelta(minutes=90)
+        ids = await database.add_bookings([
+            {"driver_id": driver_id, "user_id": user_id,
+             "booking_time": origin + timedelta(minutes=40 * k + i % 40),
+             "end_time": origin + timedelta(minutes=40 * k + i % 40 + 30), "notes": "<b>"}
+            for i, driver_id in enumerate(driver_ids) for k in range(30)
+        ])
+        bookings = await database.get_all_bookings()
+        starts = {b.id: b.booking_time for b in bookings}
+        assert None not in ids and len(starts) == 3000
+
+        # минутные тики планировщика по поддельным часам до последней брони
+        while clock[0] <= max(starts.values()):
+            await scheduler.send_reminders(clock[0])
+            clock[0] += TICK
+        return starts
+
+    starts = loop.run_until_complete(scenario())
+    reminded = {}
+    for sent_at, chat_id, text, kwargs in outbox.sent:
+        booking_id = int(re.search(r"#(\d+)", text).group(1))
+        assert booking_id not in reminded
+        reminded[booking_id] = sent_at
+        assert chat_id == 100 and kwargs == {"parse_mode": None}
+    assert reminded.keys() == starts.keys()
+    for booking_id, sent_at in reminded.items():
+        # первый тик, на котором до начала осталось не больше LEAD
+        assert starts[booking_id] - LEAD <= sent_at < starts[booking_id] - LEAD + TICK
@@ -0,0 +1,42 @@
+import sqlite3
+from datetime import date, datetime, timedelta, timezone
+
+from aiogram.fsm.storage.base import StorageKey
+
+from storage import SQLiteStorage, dumps, loads
+
+
+def key(user_id):
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+def test_datetimes_round_trip():
+    data = {
+        "at": datetime(2030, 1, 7, 8, 30, 15, 123456),
+        "aware": datetime(2030, 1, 7, 8, 30, tzinfo=timezone(timedelta(hours=3))),
+        "day": date(2030, 1, 7),
+        "booking": [738000, 4, 6],
+    }
+    assert loads(dumps(data)) == data
+
+
+def test_flush_deletes_only_cleared_records(tmp_path, loop):
+    path = str(tmp_path / "fsm.db")
+    storage = SQLiteStorage(path, flush_interval=0)
+
+    async def scenario():
+        await storage.set_state(key(1), "BookingStates:ADDING_NOTES")
+        await storage.set_data(key(1), {"at": datetime(2030, 1, 7, 8, 30, 15)})
+        await storage.set_state(key(2), "BookingStates:ADDING_NOTES")
+        # пустая запись, которую этот процесс не трогал, остаётся как есть
+        conn = await storage._connection()
+        await conn.execute("INSERT INTO fsm (key, updated_at) VALUES ('foreign', 0)")
+
+        await storage.set_state(key(1), None)
+        await storage.set_data(key(1), {})
+        await storage.close()
+
+    loop.run_until_complete(scenario())
+    with sqlite3.connect(path) as conn:
+        keys = {row[0] for row in conn.execute("SELECT key FROM fsm")}
+    assert keys == {SQLiteStorage._key(key(2)), "foreign"}